@@ -0,0 +1,85 @@
+# Conditional GET and response caching for the read-only events endpoints
+# Every event and every user has a version stamp in the Django cache (microseconds since the
+# epoch of the last write), bumped by the events views once their transaction commits.
+# A response's ETag is derived from the stamps it depends on, so an unchanged poll is answered
+# with 304 - or, without If-None-Match, with the cached body - before the view runs any query.
+# There is no Last-Modified: at whole-second resolution a write in the same second as the
+# client's copy would still be answered with 304.
+
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, quote_etag
+
+from nightout import metrics
+
+
+def event_version_key(event_id):
+    return f'events:version:event:{event_id}'
+
+def user_version_key(user_id):
+    return f'events:version:user:{user_id}'
+
+
+# Give the events and users new version stamps once the current transaction commits
+# (immediately outside one), so a reader never caches old rows under the new stamp
+def bump_versions_on_commit(event_ids=(), user_ids=()):
+    keys = [event_version_key(event_id) for event_id in event_ids] + [user_version_key(user_id) for user_id in user_ids]
+    transaction.on_commit(lambda: cache.set_many(dict.fromkeys(keys, time.time_ns() // 1000), settings.EVENTS_CACHE_TTL))
+
+
+# Current stamp of each key; stamps that were never set (or expired) start now
+def get_versions(keys):
+    versions = cache.get_many(keys)
+    now = time.time_ns() // 1000
+    for key in keys:
+        if key not in versions:
+            # add() keeps a stamp another request set meanwhile
+            versions[key] = now if cache.add(key, now, settings.EVENTS_CACHE_TTL) else cache.get(key, now)
+    return versions
+
+
+# Serve a GET view with an ETag and a cache of its rendered 200 bodies.
+# version_keys(request, *args, **kwargs) lists the version keys the response depends on.
+# Bodies of requests with any of `uncached_params` aren't cached, for polls that ask with a new
+# value every time (e.g. a cursor) and so would never read them back.
+def versioned_response(version_keys, uncached_params=()):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            versions = get_versions(version_keys(request, *args, **kwargs))
+            etag = quote_etag(hashlib.sha1(repr(sorted(versions.items())).encode()).hexdigest())
+
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                metrics.record_cache('events_response', hit=True)
+                return not_modified
+
+            if any(param in request.GET for param in uncached_params):
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200:
+                    response['ETag'] = etag
+                    response['Cache-Control'] = 'private, no-cache'
+                return response
+
+            body_key = 'events:response:' + hashlib.sha1(f'{request.get_full_path()} {etag}'.encode()).hexdigest()
+            body = cache.get(body_key)
+            metrics.record_cache('events_response', hit=body is not None)
+            if body is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                cache.set(body_key, response.content, settings.EVENTS_CACHE_TTL)
+            else:
+                response = HttpResponse(body, content_type='application/json')
+
+            response['ETag'] = etag
+            response['Cache-Control'] = 'private, no-cache'  # Clients may keep it but must revalidate
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,45 @@
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Event, Invitation
+
+# Event column that counts the event's invitations in each RSVP status
+RSVP_COUNT_FIELDS = {
+    'Accepted': 'accepted_count',
+    'Rejected': 'rejected_count',
+    'Pending': 'pending_count',
+}
+
+
+# Count `count` new invitations in `status` against the event, in one UPDATE
+def add_rsvps(event_id, status, count=1):
+    field = RSVP_COUNT_FIELDS[status]
+    Event.objects.filter(pk=event_id).update(**{field: F(field) + count})
+
+
+# Move one invitation of the event from old_status to new_status, in one UPDATE
+def move_rsvp(event_id, old_status, new_status):
+    if old_status == new_status:
+        return
+    old_field, new_field = RSVP_COUNT_FIELDS[old_status], RSVP_COUNT_FIELDS[new_status]
+    Event.objects.filter(pk=event_id).update(**{old_field: F(old_field) - 1, new_field: F(new_field) + 1})
+
+
+# The real number of the outer event's invitations in `status`, as a correlated subquery
+def counted_rsvps(status):
+    invitations = (
+        Invitation.objects.filter(event=OuterRef('pk'), status=status)
+        .order_by().values('event').annotate(total=Count('pk')).values('total')
+    )
+    return Coalesce(Subquery(invitations), 0)
+
+
+# Rewrite the counters of every event in the queryset from the invitations table, in one UPDATE
+def recount_rsvps(events):
+    return events.update(**{field: counted_rsvps(status) for status, field in RSVP_COUNT_FIELDS.items()})
+
+
+# Events in the queryset whose counters disagree with their invitations
+def drifted_events(events):
+    actual = {f'actual_{field}': Count('invitations', filter=Q(invitations__status=status)) for status, field in RSVP_COUNT_FIELDS.items()}
+    return events.annotate(**actual).exclude(**{field: F(f'actual_{field}') for field in RSVP_COUNT_FIELDS.values()})
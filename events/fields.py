@@ -0,0 +1,32 @@
+import hashlib
+
+from django.db import models
+
+
+# Hex SHA-256 of a piece of text
+def content_hash(text):
+    return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
+
+# SHA-256 of another text field on the same model, recomputed on every save (bulk_create included)
+# Lets a unique constraint cover a fixed 64-character hash instead of an unbounded TextField
+class ContentHashField(models.CharField):
+    def __init__(self, *args, source=None, **kwargs):
+        self.source = source
+        kwargs.setdefault('max_length', 64)
+        kwargs.setdefault('editable', False)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        if kwargs.get('max_length') == 64:
+            del kwargs['max_length']
+        if kwargs.get('editable') is False:
+            del kwargs['editable']
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = content_hash(getattr(model_instance, self.source))
+        setattr(model_instance, self.attname, value)
+        return value
@@ -0,0 +1,105 @@
+# Outbox for outgoing email
+# Views call enqueue_mail() instead of send_mail(); the rows are sent in batches by
+# `python manage.py send_queued_mail`, which reuses one SMTP connection per batch and
+# retries failures with exponential backoff.
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+
+from nightout import metrics
+
+from .models import OutboxEmail
+
+
+# Same arguments as django.core.mail.send_mail, but only writes the message to the outbox
+def enqueue_mail(subject, message, from_email, recipient_list):
+    return OutboxEmail.objects.create(
+        subject=subject,
+        body=message,
+        from_email=from_email or '',
+        recipients=list(recipient_list),
+    )
+
+
+# Queue several messages with one insert; each item is a (subject, message, from_email, recipient_list) tuple
+def enqueue_mass_mail(datatuple):
+    return OutboxEmail.objects.bulk_create([
+        OutboxEmail(subject=subject, body=message, from_email=from_email or '', recipients=list(recipient_list))
+        for subject, message, from_email, recipient_list in datatuple
+    ])
+
+
+# Seconds to wait before the next try after `attempts` failures
+def retry_delay(attempts):
+    return min(settings.MAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), settings.MAIL_OUTBOX_MAX_DELAY)
+
+
+# Claim up to batch_size due messages for this worker
+# Claimed rows are marked Sending with a lease; if the worker dies they become due again when it runs out
+def claim_batch(batch_size):
+    now = timezone.now()
+    ids = list(
+        OutboxEmail.objects
+        .filter(status__in=[OutboxEmail.PENDING, OutboxEmail.SENDING], next_attempt_at__lte=now)
+        .order_by('next_attempt_at')
+        .values_list('id', flat=True)[:batch_size]
+    )
+    if not ids:
+        return []
+    lease_until = now + timedelta(seconds=settings.MAIL_OUTBOX_LEASE)
+    OutboxEmail.objects.filter(id__in=ids, next_attempt_at__lte=now).update(status=OutboxEmail.SENDING, next_attempt_at=lease_until)
+    # Only rows this worker actually claimed (another worker may have taken some in between)
+    return list(OutboxEmail.objects.filter(id__in=ids, status=OutboxEmail.SENDING, next_attempt_at=lease_until))
+
+
+# Record a failed try: back off, or give up after MAIL_OUTBOX_MAX_ATTEMPTS
+def mark_failed(email, error):
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= settings.MAIL_OUTBOX_MAX_ATTEMPTS:
+        email.status = OutboxEmail.FAILED
+    else:
+        email.status = OutboxEmail.PENDING
+        email.next_attempt_at = timezone.now() + timedelta(seconds=retry_delay(email.attempts))
+    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
+
+
+# Send one batch of due messages over a single SMTP connection
+# Returns (sent, failed) counts; (0, 0) means nothing was due
+def send_batch(batch_size=None):
+    batch = claim_batch(batch_size or settings.MAIL_OUTBOX_BATCH_SIZE)
+    if not batch:
+        return 0, 0
+
+    connection = get_connection(fail_silently=False)
+    try:
+        with metrics.external_call('smtp', kind='smtp'):
+            connection.open()
+    except Exception as error:
+        # Mail server unreachable - the whole batch backs off
+        for email in batch:
+            mark_failed(email, error)
+        return 0, len(batch)
+
+    sent = failed = 0
+    try:
+        for email in batch:
+            try:
+                with metrics.external_call('smtp', kind='smtp'):
+                    EmailMessage(email.subject, email.body, email.from_email or None, email.recipients, connection=connection).send()
+            except Exception as error:
+                mark_failed(email, error)
+                failed += 1
+                continue
+            email.status = OutboxEmail.SENT
+            email.attempts += 1
+            email.sent_at = timezone.now()
+            email.last_error = ''
+            email.save(update_fields=['status', 'attempts', 'sent_at', 'last_error'])
+            sent += 1
+    finally:
+        connection.close()
+    return sent, failed
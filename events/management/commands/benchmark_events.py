@@ -0,0 +1,157 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from events.counters import recount_rsvps
+from events.models import Event, Invitation, Message, Notification, User
+from events.views import message_cursor
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a throwaway SQLite database with events, invitations and messages, then time every events '
+        'read endpoint and print the EXPLAIN QUERY PLAN of each query it runs. Use --drop-index to see '
+        'what a single index is worth. The project database is not touched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=200, help='Events to create')
+        parser.add_argument('--users', type=int, default=500, help='Users to create')
+        parser.add_argument('--guests', type=int, default=20, help='Invitations per event')
+        parser.add_argument('--messages', type=int, default=50, help='Messages per event')
+        parser.add_argument('--notifications', type=int, default=10, help='Notifications per user')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed runs per endpoint')
+        parser.add_argument('--drop-index', action='append', default=[], metavar='NAME', help='Drop this index before measuring (repeatable)')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated data')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            self.stderr.write('This benchmark only runs against SQLite.')
+            return
+
+        # A fresh in-memory copy of the schema; destroyed again at the end
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.seed(options)
+            for name in options['drop_index']:
+                with connection.cursor() as cursor:
+                    cursor.execute(f'DROP INDEX IF EXISTS "{name}"')
+                self.stdout.write(f'Dropped index {name}')
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            # Time the views themselves, not the response cache in front of them
+            with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}):
+                self.measure(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def seed(self, options):
+        rng = random.Random(options['seed'])
+        now = timezone.now()
+        started = time.perf_counter()
+
+        users = User.objects.bulk_create([
+            User(username=f'user{i}', email=f'user{i}@example.com', first_name='User', last_name=str(i))
+            for i in range(options['users'])
+        ])
+        events = Event.objects.bulk_create([
+            Event(
+                title=f'Event {i}', description='Benchmark event', location='Portland, ME',
+                date=now + timedelta(days=rng.randint(-30, 60), minutes=i), organizer=rng.choice(users),
+            )
+            for i in range(options['events'])
+        ])
+        invitations = []
+        messages = []
+        for event in events:
+            guests = rng.sample(users, min(options['guests'], len(users)))
+            invitations += [
+                Invitation(event=event, user=guest, status=rng.choice(['Pending', 'Accepted', 'Rejected'])) for guest in guests
+            ]
+            messages += [
+                Message(event=event, user=rng.choice(guests), content=f'Message {j}', timestamp=now - timedelta(minutes=j))
+                for j in range(options['messages'])
+            ]
+        Invitation.objects.bulk_create(invitations, batch_size=1000)
+        recount_rsvps(Event.objects.all())
+        Message.objects.bulk_create(messages, batch_size=1000)
+        Notification.objects.bulk_create([
+            # Only the newest few are still unread, as on a real dashboard
+            Notification(
+                user=user, message=f'Notification {j}', timestamp=now - timedelta(minutes=j),
+                read_at=None if j < 3 else now - timedelta(minutes=j - 1),
+            )
+            for user in users for j in range(options['notifications'])
+        ], batch_size=1000)
+
+        self.stdout.write(
+            f'Seeded {len(users)} users, {len(events)} events, {len(invitations)} invitations, '
+            f'{len(messages)} messages, {Notification.objects.count()} notifications '
+            f'in {time.perf_counter() - started:.2f}s\n'
+        )
+
+    # (label, user to log in as, url, query params) for every events read endpoint
+    def endpoints(self):
+        event = Event.objects.order_by('id').first()
+        guest = Invitation.objects.filter(event=event).select_related('user').first().user
+        last_message = Message.objects.filter(event=event).order_by('-timestamp', '-id').values('id', 'timestamp')[5]
+        return [
+            ('view_invitations_by_status', event.organizer, reverse('view_invitations_by_status', args=[event.id]), {}),
+            ('view_invitations_by_status ?status', event.organizer, reverse('view_invitations_by_status', args=[event.id]), {'status': 'Accepted'}),
+            ('view_event_attendees', event.organizer, reverse('view_event_attendees', args=[event.id]), {}),
+            ('get_event_messages', guest, reverse('get_event_messages', args=[event.id]), {}),
+            ('get_event_messages ?since', guest, reverse('get_event_messages', args=[event.id]), {'since': message_cursor(last_message)}),
+            ('get_created_events', event.organizer, reverse('get_created_events'), {}),
+            ('get_collaborator_events', guest, reverse('get_collaborator_events'), {}),
+            # The unread notification count searches the user's notifications; SQLite picks the plain user_id
+            # index, --drop-index events_notification_user_id_4644c4f1 shows notification_user_time_idx serving it
+            ('get_dashboard', event.organizer, reverse('get_dashboard'), {}),
+            ('get_dashboard (guest)', guest, reverse('get_dashboard'), {}),
+        ]
+
+    def measure(self, options):
+        client = Client()
+        for label, user, url, params in self.endpoints():
+            client.force_login(user)
+            client.get(url, params)  # Warm up
+            timings = []
+            for _ in range(options['repeat']):
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    response = client.get(url, params)
+                    timings.append((time.perf_counter() - started) * 1000)
+
+            self.stdout.write(self.style.MIGRATE_HEADING(label))
+            self.stdout.write(
+                f'  status {response.status_code}, {len(queries)} queries, '
+                f'median {statistics.median(timings):.2f} ms, max {max(timings):.2f} ms'
+            )
+            for query in queries.captured_queries:
+                # Session and user loading is the same for every endpoint
+                if 'FROM "django_session"' in query['sql'] or 'FROM "auth_user" WHERE' in query['sql']:
+                    continue
+                self.stdout.write(f'  [{self.time_query(query["sql"], options["repeat"]):.3f} ms] {query["sql"]}')
+                with connection.cursor() as cursor:
+                    cursor.execute(f'EXPLAIN QUERY PLAN {query["sql"]}')
+                    for row in cursor.fetchall():
+                        self.stdout.write(f'      {row[-1]}')
+            self.stdout.write('')
+
+    # Median milliseconds to run and fetch a query (the captured per-query times are too coarse)
+    def time_query(self, sql, repeat):
+        timings = []
+        with connection.cursor() as cursor:
+            for _ in range(repeat):
+                started = time.perf_counter()
+                cursor.execute(sql)
+                cursor.fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
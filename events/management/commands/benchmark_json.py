@@ -0,0 +1,70 @@
+import statistics
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+from django.http import JsonResponse as DjangoJsonResponse
+from django.utils import timezone
+
+from nightout import fast_json
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the stock JsonResponse (DjangoJSONEncoder) with nightout.fast_json on large event and '
+        'message lists shaped like the events endpoints build them. Reports bytes/sec per encoder; no database needed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=2000, help='Rows in the event list payload')
+        parser.add_argument('--messages', type=int, default=5000, help='Rows in the message list payload')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed runs per encoder and payload')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        payloads = {
+            # get_created_events / get_collaborator_events: full .values() rows
+            'events': {'events': [{
+                'id': i, 'title': f'Event {i}', 'description': 'Benchmark event with a longer description ' * 3,
+                'date': now + timedelta(hours=i), 'location': 'Portland, ME', 'organizer_id': i % 97,
+                'accepted_count': i % 13, 'rejected_count': i % 5, 'pending_count': i % 7,
+            } for i in range(options['events'])]},
+            # get_event_messages
+            'messages': {'messages': [{
+                'id': i, 'user': f'user{i % 50}@example.com', 'content': f'Message {i}: see you there! 🎉',
+                'timestamp': now - timedelta(seconds=i), 'cursor': f'{1700000000000000 + i}-{i}',
+            } for i in range(options['messages'])], 'has_more': True, 'next_before': '1700000000000000-0', 'next_since': None},
+        }
+        encoders = {
+            'django JsonResponse': lambda data: DjangoJsonResponse(data).content,
+            'fast_json (stdlib)': self.with_serializer('stdlib'),
+            'fast_json (orjson)': self.with_serializer('orjson'),
+        }
+        if fast_json.orjson is None:
+            del encoders['fast_json (orjson)']
+            self.stdout.write('orjson is not installed; only the stdlib paths are measured')
+
+        for name, data in payloads.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{name} ({len(next(iter(data.values())))} rows)'))
+            baseline = None
+            for label, encode in encoders.items():
+                size = len(encode(data))
+                timings = []
+                for _ in range(options['repeat']):
+                    started = time.perf_counter()
+                    encode(data)
+                    timings.append(time.perf_counter() - started)
+                median = statistics.median(timings)
+                baseline = baseline or median
+                self.stdout.write(
+                    f'  {label:<22} {size / 1024:8.1f} KiB  median {median * 1000:7.2f} ms  '
+                    f'{size / median / 1024 / 1024:8.1f} MiB/s  x{baseline / median:.1f}'
+                )
+
+    # fast_json.JsonResponse with settings.JSON_SERIALIZER forced to `serializer`
+    def with_serializer(self, serializer):
+        def encode(data):
+            with mock.patch.object(fast_json.settings, 'JSON_SERIALIZER', serializer):
+                return fast_json.JsonResponse(data).content
+        return encode
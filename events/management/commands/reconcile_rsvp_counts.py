@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from events.counters import drifted_events, recount_rsvps
+from events.models import Event
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized RSVP counters of events from their invitations, reporting any that had drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', type=int, action='append', dest='event_ids', help='Only this event id (repeatable)')
+        parser.add_argument('--all', action='store_true', help='Rewrite every event, not just the drifted ones')
+        parser.add_argument('--dry-run', action='store_true', help='Report drifted events without fixing them')
+
+    def handle(self, *args, **options):
+        events = Event.objects.all()
+        if options['event_ids']:
+            events = events.filter(pk__in=options['event_ids'])
+
+        drifted = list(drifted_events(events).order_by('pk').values(
+            'pk', 'accepted_count', 'rejected_count', 'pending_count',
+            'actual_accepted_count', 'actual_rejected_count', 'actual_pending_count',
+        ))
+        for row in drifted:
+            self.stdout.write(
+                f"Event {row['pk']}: accepted {row['accepted_count']} -> {row['actual_accepted_count']}, "
+                f"rejected {row['rejected_count']} -> {row['actual_rejected_count']}, "
+                f"pending {row['pending_count']} -> {row['actual_pending_count']}"
+            )
+        if options['dry_run']:
+            self.stdout.write(f'{len(drifted)} event(s) drifted')
+            return
+
+        # Recount in SQL rather than writing the values read above, so RSVPs made meanwhile aren't lost
+        if not options['all']:
+            events = events.filter(pk__in=[row['pk'] for row in drifted])
+        updated = recount_rsvps(events)
+        self.stdout.write(f'{len(drifted)} event(s) drifted, {updated} recounted')
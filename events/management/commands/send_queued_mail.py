@@ -0,0 +1,25 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from events.mail import send_batch
+
+
+class Command(BaseCommand):
+    help = 'Send queued outbox email in batches, reusing one SMTP connection per batch. Runs until stopped unless --once is given.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.MAIL_OUTBOX_BATCH_SIZE, help='Messages sent per SMTP connection')
+        parser.add_argument('--interval', type=float, default=settings.MAIL_OUTBOX_POLL_INTERVAL, help='Seconds to sleep when nothing is due')
+        parser.add_argument('--once', action='store_true', help='Drain what is due now and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = send_batch(options['batch_size'])
+            if sent or failed:
+                self.stdout.write(f'Sent {sent}, failed {failed}')
+                continue  # More may be due - go straight to the next batch
+            if options['once']:
+                break
+            time.sleep(options['interval'])
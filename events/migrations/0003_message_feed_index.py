@@ -0,0 +1,17 @@
+# Generated by Django 4.2.15 on 2026-10-18 09:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0002_outboxemail'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['event', 'timestamp', 'id'], name='message_event_feed_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+from django.db import migrations
+
+import events.fields
+
+
+# Fill the new hash columns for rows that already exist
+def fill_hashes(apps, schema_editor):
+    for model_name, source, target in (('Message', 'content', 'content_hash'), ('Notification', 'message', 'message_hash')):
+        model = apps.get_model('events', model_name)
+        batch = []
+        for row in model.objects.only('id', source).iterator(chunk_size=1000):
+            setattr(row, target, events.fields.content_hash(getattr(row, source)))
+            batch.append(row)
+            if len(batch) == 1000:
+                model.objects.bulk_update(batch, [target])
+                batch = []
+        model.objects.bulk_update(batch, [target])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0004_access_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='content_hash',
+            field=events.fields.ContentHashField(default='', source='content'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='message_hash',
+            field=events.fields.ContentHashField(default='', source='message'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_hashes, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='message',
+            unique_together={('event', 'user', 'content_hash')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='notification',
+            unique_together={('user', 'message_hash')},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-18 09:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0005_content_hash_dedup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
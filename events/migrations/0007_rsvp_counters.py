@@ -0,0 +1,45 @@
+# Generated by Django 4.2.15 on 2026-10-18 09:53
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+# Count the invitations of events that already exist
+def fill_counts(apps, schema_editor):
+    Event = apps.get_model('events', 'Event')
+    Invitation = apps.get_model('events', 'Invitation')
+    counts = {}
+    for status, field in (('Accepted', 'accepted_count'), ('Rejected', 'rejected_count'), ('Pending', 'pending_count')):
+        invitations = (
+            Invitation.objects.filter(event=OuterRef('pk'), status=status)
+            .order_by().values('event').annotate(total=Count('pk')).values('total')
+        )
+        counts[field] = Coalesce(Subquery(invitations), 0)
+    Event.objects.update(**counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0006_notification_read_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='accepted_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='pending_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='rejected_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counts, migrations.RunPython.noop),
+    ]
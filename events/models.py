@@ -3,6 +3,7 @@ from django.contrib.auth.models import AbstractUser, Group, Permission
 from django.utils import timezone
 from django.db import models
 from django.contrib.auth.models import User
+from .fields import ContentHashField
 
 class Event(models.Model):
     title = models.CharField(max_length=200)
@@ -10,9 +11,17 @@ class Event(models.Model):
     date = models.DateTimeField()  # Change to DateTimeField for better date management
     location = models.CharField(max_length=200)
     organizer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='organized_events')
+    # Denormalized RSVP counts, kept in step by the invite/RSVP views (see events/counters.py)
+    # and rebuilt by the reconcile_rsvp_counts command
+    accepted_count = models.IntegerField(default=0)
+    rejected_count = models.IntegerField(default=0)
+    pending_count = models.IntegerField(default=0)
 
     class Meta:
         unique_together = ('title', 'date', 'location')  #
+        indexes = [
+            models.Index(fields=['organizer', 'date'], name='event_organizer_date_idx'),  # A user's own events, by date
+        ]
 
 class Invitation(models.Model):
     event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='invitations')
@@ -21,28 +30,67 @@ class Invitation(models.Model):
 
     class Meta:
         unique_together = ('event', 'user')  # Ensures each user can only have one invitation per event
+        indexes = [
+            models.Index(fields=['event', 'status'], name='invitation_event_status_idx'),  # Invitations of an event by RSVP status
+            models.Index(fields=['user', 'event'], name='invitation_user_event_idx'),  # Events a user is invited to
+        ]
 
 
 
 class Notification(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
     message = models.TextField()
+    message_hash = ContentHashField(source='message')  # SHA-256 of message, kept up to date on save
     timestamp = models.DateTimeField(default=timezone.now)
+    read_at = models.DateTimeField(null=True, blank=True)  # When the user saw it; None while unread
 
     class Meta:
-        unique_together = ('user', 'message')  # Ensures a user doesn't get the same message twice
+        unique_together = ('user', 'message_hash')  # Ensures a user doesn't get the same message twice
+        indexes = [
+            models.Index(fields=['user', 'timestamp'], name='notification_user_time_idx'),  # A user's latest notifications
+        ]
 
 
 class Message(models.Model):
     event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='messages')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='messages')
     content = models.TextField()
+    content_hash = ContentHashField(source='content')  # SHA-256 of content, kept up to date on save
     timestamp = models.DateTimeField(default=timezone.now)
 
     class Meta:
-        unique_together = ('event', 'user', 'content')  # Ensures the same user can't send duplicate messages for an event
+        unique_together = ('event', 'user', 'content_hash')  # Ensures the same user can't send duplicate messages for an event
+        indexes = [
+            models.Index(fields=['event', 'timestamp', 'id'], name='message_event_feed_idx'),  # Keyset pagination of an event's chat feed
+        ]
 
 
     def __str__(self):
         return f"Message from {self.user.email} at {self.timestamp}"
 
+
+# Outgoing email waiting to be sent by the send_queued_mail worker, so views never block on SMTP
+class OutboxEmail(models.Model):
+    PENDING = 'Pending'
+    SENDING = 'Sending'
+    SENT = 'Sent'
+    FAILED = 'Failed'
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    recipients = models.JSONField(default=list)  # List of email addresses
+    status = models.CharField(max_length=10, choices=[(PENDING, 'Pending'), (SENDING, 'Sending'), (SENT, 'Sent'), (FAILED, 'Failed')], default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)  # Not sent before this; also the claim lease while Sending
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),  # The worker's "what's due" query
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.recipients)} ({self.status})"
@@ -0,0 +1,253 @@
+# Real-time event updates (chat messages, RSVPs, invitations) pushed to connected participants
+# Everything runs in-process: views publish to the module-level broker, and WebSocket
+# connections (see nightout/asgi.py) and long-poll requests subscribe to it per event.
+# Nothing here needs Redis; each worker process delivers the updates its own views publish.
+# Long-poll clients that pass a message cursor also get chat messages from the database, polled
+# every REALTIME_DB_POLL_INTERVAL seconds, so chat reaches them across worker processes.
+
+import asyncio
+import json
+import re
+import threading
+from collections import OrderedDict, deque
+from http.cookies import SimpleCookie
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import transaction
+from django.db.models import Q
+from django.http.request import split_domain_port, validate_host
+from django.utils.http import is_same_domain
+
+
+# One subscriber's queue of updates, bound to the event loop it was created on
+# Publishers may run on any thread, so updates are handed over with call_soon_threadsafe
+class Subscription:
+    def __init__(self, broker, event_id):
+        self.broker = broker
+        self.event_id = event_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=settings.REALTIME_QUEUE_SIZE)
+
+    def deliver(self, update):
+        self.loop.call_soon_threadsafe(self._put, update)
+
+    def _put(self, update):
+        # A subscriber that can't keep up loses its oldest updates rather than growing without bound
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(update)
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    # Updates already queued, without waiting
+    def drain(self):
+        updates = []
+        while not self.queue.empty():
+            updates.append(self.queue.get_nowait())
+        return updates
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+# In-memory pub/sub, fanning each event's updates out to its subscribers
+# Every update gets a per-event sequence number, and the last REALTIME_BUFFER_SIZE updates of
+# an event are kept so a long-poll client can pick up what it missed between two polls.
+class InMemoryBroker:
+    def __init__(self, buffer_size=None, max_events=None):
+        self.buffer_size = buffer_size or settings.REALTIME_BUFFER_SIZE
+        self.max_events = max_events or settings.REALTIME_MAX_EVENTS
+        self._lock = threading.Lock()
+        self._subscribers = {}  # event_id -> set of Subscription
+        self._buffers = OrderedDict()  # event_id -> deque of recent updates, least recently published first
+        self._sequences = {}  # event_id -> last sequence number
+
+    # Must be called from a coroutine; the subscription receives updates on that coroutine's loop
+    def subscribe(self, event_id):
+        subscription = Subscription(self, event_id)
+        with self._lock:
+            self._subscribers.setdefault(event_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.event_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.event_id]
+
+    def publish(self, event_id, update_type, data):
+        with self._lock:
+            seq = self._sequences.get(event_id, 0) + 1
+            self._sequences[event_id] = seq
+            update = {'seq': seq, 'type': update_type, 'event_id': event_id, 'data': data}
+            buffer = self._buffers.get(event_id)
+            if buffer is None:
+                buffer = self._buffers[event_id] = deque(maxlen=self.buffer_size)
+            buffer.append(update)
+            self._buffers.move_to_end(event_id)
+            while len(self._buffers) > self.max_events:
+                old_event_id, _ = self._buffers.popitem(last=False)
+                self._sequences.pop(old_event_id, None)
+            subscribers = list(self._subscribers.get(event_id, ()))
+        for subscription in subscribers:
+            subscription.deliver(update)
+        return update
+
+    # (updates after sequence number `after`, whether some were already dropped from the buffer)
+    def updates_since(self, event_id, after):
+        with self._lock:
+            buffer = list(self._buffers.get(event_id, ()))
+            last_seq = self._sequences.get(event_id, 0)
+        oldest = buffer[0]['seq'] if buffer else last_seq + 1
+        # Updates between `after` and the oldest buffered one are gone; an `after` from the
+        # future (e.g. this worker restarted) can't be trusted either
+        missed = after < oldest - 1 or after > last_seq
+        return [update for update in buffer if update['seq'] > after], missed
+
+    def last_seq(self, event_id):
+        with self._lock:
+            return self._sequences.get(event_id, 0)
+
+
+broker = InMemoryBroker()
+
+
+# Publish once the surrounding transaction commits, so subscribers never see rolled-back writes
+def publish_on_commit(event_id, update_type, data):
+    transaction.on_commit(lambda: broker.publish(event_id, update_type, data))
+
+
+# The organizer and invited users may follow an event
+def is_participant(user, event_id):
+    from .models import Event
+    if not user.is_authenticated:
+        return False
+    return Event.objects.filter(Q(organizer=user) | Q(invitations__user=user), id=event_id).exists()
+
+
+# Updates after `after` for a long-poll request, waiting up to `timeout` seconds for the first one
+# (after=None waits for updates from now on)
+# Returns {'updates': [...], 'last_seq': n, 'reset': bool}; reset means some updates were missed
+# and the client should reload the event before polling again
+# With poll_messages, a function returning the new chat messages from the database, the wait also
+# ends once it returns any (checked every REALTIME_DB_POLL_INTERVAL seconds and after each update),
+# and they are returned under 'messages'
+async def wait_for_updates(event_id, after, timeout, poll_messages=None):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    messages = []
+    async with broker.subscribe(event_id) as subscription:
+        if after is None:
+            after = broker.last_seq(event_id)
+        # Subscribed first, so nothing published between this check and the wait is lost
+        updates, missed = broker.updates_since(event_id, after)
+        while True:
+            if poll_messages is not None:
+                messages = await sync_to_async(poll_messages)()
+            remaining = deadline - loop.time()
+            if updates or missed or messages or remaining <= 0:
+                break
+            if poll_messages is not None:
+                remaining = min(remaining, settings.REALTIME_DB_POLL_INTERVAL)
+            try:
+                updates = [await subscription.get(remaining)]
+            except asyncio.TimeoutError:
+                updates = []
+            updates += subscription.drain()
+            updates = [update for update in updates if update['seq'] > after]
+    last_seq = updates[-1]['seq'] if updates else max(after, broker.last_seq(event_id))
+    data = {'updates': updates, 'last_seq': last_seq, 'reset': missed}
+    if poll_messages is not None:
+        data['messages'] = messages
+    return data
+
+
+WEBSOCKET_PATH = re.compile(r'^/ws/events/(?P<event_id>\d+)/$')
+
+
+# The logged-in user of a WebSocket connection, from the session cookie of the handshake
+def websocket_user(scope):
+    cookies = SimpleCookie()
+    for name, value in scope.get('headers', []):
+        if name == b'cookie':
+            cookies.load(value.decode('latin1'))
+    session_key = cookies[settings.SESSION_COOKIE_NAME].value if settings.SESSION_COOKIE_NAME in cookies else None
+    session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    return get_user(SimpleNamespace(session=session))
+
+
+# Whether the page that opened a WebSocket may use it. Browsers send the session cookie with a
+# handshake whichever site starts it, so without this any site could open a socket as the logged-in
+# user (cross-site WebSocket hijacking). As with Django's CSRF origin check, the origin must be the
+# host the handshake was made to - itself in ALLOWED_HOSTS - or in CSRF_TRUSTED_ORIGINS.
+# The scheme isn't compared: behind a TLS-terminating proxy the handshake arrives as ws://.
+def origin_allowed(scope):
+    headers = dict(scope.get('headers', []))
+    origin = headers.get(b'origin', b'').decode('latin1')
+    host = headers.get(b'host', b'').decode('latin1')
+    if not origin:
+        return False
+    parsed = urlparse(origin)
+    if host and parsed.netloc == host and validate_host(split_domain_port(host)[0], settings.ALLOWED_HOSTS):
+        return True
+    if origin in settings.CSRF_TRUSTED_ORIGINS:
+        return True
+    return any(
+        parsed.scheme == urlparse(trusted).scheme and is_same_domain(parsed.netloc, urlparse(trusted).netloc.lstrip('*'))
+        for trusted in settings.CSRF_TRUSTED_ORIGINS if '*' in trusted
+    )
+
+
+# ASGI app for /ws/events/<event_id>/ - pushes every update of the event as a JSON text frame
+async def websocket_application(scope, receive, send):
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+
+    match = WEBSOCKET_PATH.match(scope['path'])
+    if match is None:
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+    event_id = int(match.group('event_id'))
+
+    if not origin_allowed(scope):
+        await send({'type': 'websocket.close', 'code': 4403})
+        return
+    user = await sync_to_async(websocket_user)(scope)
+    if not await sync_to_async(is_participant)(user, event_id):
+        await send({'type': 'websocket.close', 'code': 4403})
+        return
+
+    async with broker.subscribe(event_id) as subscription:
+        await send({'type': 'websocket.accept'})
+        await send({'type': 'websocket.send', 'text': json.dumps({'type': 'hello', 'last_seq': broker.last_seq(event_id)})})
+        receive_task = asyncio.ensure_future(receive())
+        try:
+            while True:
+                update_task = asyncio.ensure_future(subscription.get())
+                done, _ = await asyncio.wait({receive_task, update_task}, return_when=asyncio.FIRST_COMPLETED)
+                if update_task in done:
+                    await send({'type': 'websocket.send', 'text': json.dumps(update_task.result())})
+                else:
+                    update_task.cancel()
+                if receive_task in done:
+                    if receive_task.result()['type'] == 'websocket.disconnect':
+                        break
+                    # Anything the client sends (e.g. keep-alive pings) is ignored
+                    receive_task = asyncio.ensure_future(receive())
+        finally:
+            receive_task.cancel()
@@ -1,3 +1,670 @@
-from django.test import TestCase
+import asyncio
+import json
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from nightout import metrics
+
+from . import mail as outbox, realtime, views
+from .counters import add_rsvps, recount_rsvps
+from .fields import content_hash
+from .models import Event, Invitation, Message, Notification, OutboxEmail, User
+
+
+# The response cache keys on event and user ids, which the test database hands out again,
+# so every test starts from an empty in-memory cache
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'events-tests'},
+    'coordination': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'events-tests-coordination'},
+})
+class EventsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    # A user named `name` with the matching example.com address
+    @staticmethod
+    def make_user(name, **extra):
+        return User.objects.create_user(name, f'{name}@example.com', **extra)
+
+    # An event organized by `organizer` with each of `guests` invited, under the matching entry of
+    # `statuses` (Pending by default), and its RSVP counters in step
+    @staticmethod
+    def make_event(organizer, title='Dinner', guests=(), statuses=None):
+        event = Event.objects.create(
+            title=title, description='Night out', date=timezone.now(), location='Portland, ME', organizer=organizer,
+        )
+        statuses = statuses or ['Pending'] * len(guests)
+        Invitation.objects.bulk_create([Invitation(event=event, user=guest, status=status) for guest, status in zip(guests, statuses)])
+        recount_rsvps(Event.objects.filter(pk=event.pk))
+        return event
+
+
+# Query-count regression tests: every events endpoint must issue the same number of
+# queries whether the event has a couple of guests/messages or dozens.
+# The counts include the two queries login_required costs (session + user).
+class EventQueryCountTests(EventsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.organizer = cls.make_user('organizer')
+        cls.small_event = cls.make_busy_event('Small', guests=2)
+        cls.large_event = cls.make_busy_event('Large', guests=25)
+
+    # An event with `guests` invited users, every other one Accepted, and a message from each
+    @classmethod
+    def make_busy_event(cls, title, guests):
+        users = User.objects.bulk_create([
+            User(username=f'{title.lower()}-guest{i}', email=f'{title.lower()}-guest{i}@example.com') for i in range(guests)
+        ])
+        event = cls.make_event(cls.organizer, title, users, ['Accepted' if i % 2 else 'Pending' for i in range(guests)])
+        Message.objects.bulk_create([
+            Message(event=event, user=user, content=f'Message {i}') for i, user in enumerate(users)
+        ])
+        return event
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.organizer)
+
+    # Run the request against the small and the large event and check both cost `queries`
+    # The response cache is emptied first so the view itself is measured
+    def assertConstantQueries(self, queries, request):
+        for event in (self.small_event, self.large_event):
+            cache.clear()
+            with self.subTest(event=event.title), self.assertNumQueries(queries):
+                response = request(event)
+            self.assertLess(response.status_code, 400)
+
+    def test_view_invitations_by_status(self):
+        self.assertConstantQueries(3, lambda event: self.client.get(
+            reverse('view_invitations_by_status', args=[event.id])))
+
+    def test_view_invitations_filtered_by_status(self):
+        self.assertConstantQueries(3, lambda event: self.client.get(
+            reverse('view_invitations_by_status', args=[event.id]), {'status': 'Accepted'}))
+
+    def test_view_event_attendees(self):
+        self.assertConstantQueries(3, lambda event: self.client.get(
+            reverse('view_event_attendees', args=[event.id])))
+
+    def test_get_event_messages(self):
+        self.assertConstantQueries(3, lambda event: self.client.get(
+            reverse('get_event_messages', args=[event.id])))
+
+    def test_get_created_events(self):
+        self.assertConstantQueries(3, lambda event: self.client.get(reverse('get_created_events')))
+
+    def test_get_collaborator_events(self):
+        self.client.force_login(Invitation.objects.filter(event=self.large_event).first().user)
+        self.assertConstantQueries(4, lambda event: self.client.get(reverse('get_collaborator_events')))
+
+    def test_send_message_to_event(self):
+        self.assertConstantQueries(4, lambda event: self.client.post(
+            reverse('send_message_to_event', args=[event.id]),
+            {'message': f'See you at {event.title}'}, content_type='application/json'))
+
+    def test_invite_to_event(self):
+        self.make_user('invitee')
+        self.assertConstantQueries(7, lambda event: self.client.post(
+            reverse('invite_to_event', args=[event.id]),
+            {'email': 'invitee@example.com'}, content_type='application/json'))
+
+    def test_bulk_invite_to_event(self):
+        User.objects.bulk_create([User(username=f'bulk{i}', email=f'bulk{i}@example.com') for i in range(20)])
+        sizes = iter([2, 20])
+        # Includes the savepoint around the one INSERT, which lets a race with another invite be told apart
+        self.assertConstantQueries(12, lambda event: self.client.post(
+            reverse('bulk_invite_to_event', args=[event.id]),
+            {'emails': [f'bulk{i}@example.com' for i in range(next(sizes))]}, content_type='application/json'))
+
+    def test_rsvp_for_event(self):
+        guest = self.make_user('rsvp-guest')
+        self.client.force_login(guest)
+        self.assertConstantQueries(11, lambda event: self.client.post(
+            reverse('rsvp_for_event', args=[event.id]),
+            {'status': 'Accepted'}, content_type='application/json'))
+
+    def test_edit_event(self):
+        self.assertConstantQueries(4, lambda event: self.client.put(
+            reverse('edit_event', args=[event.id]),
+            {'description': 'Updated'}, content_type='application/json'))
+
+    def test_get_dashboard(self):
+        self.assertConstantQueries(5, lambda event: self.client.get(reverse('get_dashboard')))
+
+    def test_missing_event_is_404(self):
+        for name in ('view_invitations_by_status', 'view_event_attendees', 'get_event_messages'):
+            with self.subTest(name=name):
+                self.assertEqual(self.client.get(reverse(name, args=[0])).status_code, 404)
+
+    def test_empty_event_lists_nothing(self):
+        event = self.make_busy_event('Empty', guests=0)
+        response = self.client.get(reverse('get_event_messages', args=[event.id]))
+        self.assertEqual(response.json()['messages'], [])
+        response = self.client.get(reverse('view_invitations_by_status', args=[event.id]))
+        self.assertEqual(response.json(), {'invitations': []})
+
+
+class BulkInviteTests(EventsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.organizer = self.make_user('organizer')
+        self.guests = [self.make_user(f'guest{i}') for i in range(2)]
+        self.event = self.make_event(self.organizer, guests=self.guests[1:])
+        self.client.force_login(self.organizer)
+
+    def test_reports_every_entry_in_request_order(self):
+        emails = ['guest0@example.com', 'not-an-email', 5, None, 'guest0@example.com', 'nobody@example.com', 'guest1@example.com']
+        response = self.client.post(reverse('bulk_invite_to_event', args=[self.event.id]), {'emails': emails}, content_type='application/json')
+        self.assertEqual(response.json()['results'], [
+            {'email': 'guest0@example.com', 'result': 'invited'},
+            {'email': 'not-an-email', 'result': 'invalid_email'},
+            {'email': 5, 'result': 'invalid_email'},
+            {'email': None, 'result': 'invalid_email'},
+            {'email': 'nobody@example.com', 'result': 'user_not_found'},
+            {'email': 'guest1@example.com', 'result': 'already_invited'},
+        ])
+        self.assertEqual(set(Invitation.objects.values_list('user__email', flat=True)), {'guest0@example.com', 'guest1@example.com'})
+
+    def test_invitations_created_meanwhile_are_not_reported_or_mailed(self):
+        real_create_invitations = views.create_invitations
+        guest2 = self.make_user('guest2')
+
+        # Another request invites guest0 after this one checked who was already invited
+        def invite_concurrently(invitations):
+            Invitation.objects.create(event=self.event, user=self.guests[0])
+            return real_create_invitations(invitations)
+
+        with mock.patch('events.views.create_invitations', invite_concurrently):
+            response = self.client.post(reverse('bulk_invite_to_event', args=[self.event.id]),
+                                        {'emails': ['guest0@example.com', 'guest2@example.com']}, content_type='application/json')
+        self.assertEqual(response.json()['results'], [
+            {'email': 'guest0@example.com', 'result': 'already_invited'},
+            {'email': 'guest2@example.com', 'result': 'invited'},
+        ])
+        self.assertEqual(list(OutboxEmail.objects.values_list('recipients', flat=True)), [[guest2.email]])
+        self.assertEqual(Event.objects.get(pk=self.event.pk).pending_count, 2)  # guest1 and guest2; guest0 is the other request's to count
+
+    def test_rejects_anything_but_a_list(self):
+        response = self.client.post(reverse('bulk_invite_to_event', args=[self.event.id]), {'emails': 'guest0@example.com'}, content_type='application/json')
+        self.assertEqual((response.status_code, response.json()), (400, {'error': 'emails must be a non-empty list'}))
+
+
+class DashboardTests(EventsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.organizer = cls.make_user('organizer')
+        cls.guests = [cls.make_user(f'guest{i}') for i in range(4)]
+        cls.event = cls.make_event(cls.organizer, guests=cls.guests, statuses=['Accepted', 'Accepted', 'Rejected', 'Pending'])
+        Message.objects.create(event=cls.event, user=cls.guests[0], content='First', timestamp=timezone.now() - timedelta(minutes=5))
+        Message.objects.create(event=cls.event, user=cls.guests[1], content='Latest')
+        Notification.objects.create(user=cls.guests[2], message='You were invited')
+        recount_rsvps(Event.objects.filter(pk=cls.event.pk))
+
+    def test_organizer_sees_counts_and_latest_message(self):
+        self.client.force_login(self.organizer)
+        data = self.client.get(reverse('get_dashboard')).json()
+        self.assertEqual(data['collaborator_events'], [])
+        [event] = data['organized_events']
+        self.assertEqual(event['rsvp'], {'Accepted': 2, 'Rejected': 1, 'Pending': 1})
+        self.assertEqual((event['latest_message']['user'], event['latest_message']['content']), ('guest1@example.com', 'Latest'))
+
+    def test_collaborator_sees_full_counts_and_own_status(self):
+        self.client.force_login(self.guests[2])
+        data = self.client.get(reverse('get_dashboard')).json()
+        [event] = data['collaborator_events']
+        self.assertEqual(event['rsvp'], {'Accepted': 2, 'Rejected': 1, 'Pending': 1})
+        self.assertEqual(event['my_status'], 'Rejected')
+        self.assertEqual(data['unread_notifications'], 1)
+
+        self.client.post(reverse('mark_notifications_read'))
+        self.assertEqual(self.client.get(reverse('get_dashboard')).json()['unread_notifications'], 0)
+
+
+class RsvpCounterTests(EventsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.organizer = self.make_user('organizer')
+        self.guests = [self.make_user(f'guest{i}') for i in range(3)]
+        self.event = self.make_event(self.organizer)
+
+    def counts(self):
+        return Event.objects.values_list('accepted_count', 'rejected_count', 'pending_count').get(pk=self.event.pk)
+
+    def rsvp(self, guest, status):
+        self.client.force_login(guest)
+        return self.client.post(reverse('rsvp_for_event', args=[self.event.id]), {'status': status}, content_type='application/json')
+
+    def test_invites_and_rsvps_update_counters(self):
+        self.client.force_login(self.organizer)
+        self.client.post(reverse('invite_to_event', args=[self.event.id]), {'email': 'guest0@example.com'}, content_type='application/json')
+        self.client.post(reverse('bulk_invite_to_event', args=[self.event.id]),
+                         {'emails': ['guest0@example.com', 'guest1@example.com']}, content_type='application/json')
+        self.assertEqual(self.counts(), (0, 0, 2))
+
+        self.assertEqual(self.rsvp(self.guests[0], 'Accepted').status_code, 200)
+        self.assertEqual(self.rsvp(self.guests[1], 'Rejected').status_code, 200)
+        self.assertEqual(self.rsvp(self.guests[2], 'Accepted').status_code, 200)  # Uninvited guest RSVPs directly
+        self.assertEqual(self.counts(), (2, 1, 0))
+
+        self.assertEqual(self.rsvp(self.guests[0], 'Rejected').status_code, 400)  # Already responded
+        self.assertEqual(self.counts(), (2, 1, 0))
+
+    def test_edit_keeps_rsvps_counted_meanwhile(self):
+        real_get_object_or_404 = views.get_object_or_404
+
+        # A guest RSVPs after the edit has loaded the event, before it is saved
+        def load_then_rsvp(*args, **kwargs):
+            event = real_get_object_or_404(*args, **kwargs)
+            Invitation.objects.create(event=self.event, user=self.guests[0], status='Accepted')
+            add_rsvps(self.event.id, 'Accepted')
+            return event
+
+        self.client.force_login(self.organizer)
+        with mock.patch('events.views.get_object_or_404', load_then_rsvp):
+            response = self.client.put(reverse('edit_event', args=[self.event.id]), {'title': 'Drinks'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Event.objects.get(pk=self.event.pk).title, 'Drinks')
+        self.assertEqual(self.counts(), (1, 0, 0))
+
+    def test_listings_include_counters(self):
+        Invitation.objects.create(event=self.event, user=self.guests[0], status='Accepted')
+        recount_rsvps(Event.objects.all())
+        self.client.force_login(self.organizer)
+        [event] = self.client.get(reverse('get_created_events')).json()['events']
+        self.assertEqual((event['accepted_count'], event['rejected_count'], event['pending_count']), (1, 0, 0))
+
+    def test_reconcile_command_fixes_drift(self):
+        Invitation.objects.bulk_create([Invitation(event=self.event, user=guest, status='Accepted') for guest in self.guests])
+        out = StringIO()
+        call_command('reconcile_rsvp_counts', '--dry-run', stdout=out)
+        self.assertIn(f'Event {self.event.pk}: accepted 0 -> 3', out.getvalue())
+        self.assertEqual(self.counts(), (0, 0, 0))
+
+        call_command('reconcile_rsvp_counts', stdout=StringIO())
+        self.assertEqual(self.counts(), (3, 0, 0))
+        out = StringIO()
+        call_command('reconcile_rsvp_counts', '--dry-run', stdout=out)
+        self.assertEqual(out.getvalue().strip(), '0 event(s) drifted')
+
+
+class ResponseCacheTests(EventsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.organizer = cls.make_user('organizer')
+        cls.guest = cls.make_user('guest')
+        cls.event = cls.make_event(cls.organizer, guests=[cls.guest])
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.organizer)
+        self.url = reverse('view_invitations_by_status', args=[self.event.id])
+
+    def test_unchanged_poll_is_not_modified_without_queries(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)  # Whole seconds would hide writes made in the same second
+        with self.assertNumQueries(2):  # Only login_required's session + user
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        with self.assertNumQueries(2):
+            cached = self.client.get(self.url)
+        self.assertEqual((cached.status_code, cached.content, cached['ETag']), (200, response.content, response['ETag']))
+
+    def test_writes_change_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.force_login(self.guest)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('rsvp_for_event', args=[self.event.id]), {'status': 'Accepted'}, content_type='application/json')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['invitations'], [{'user': 'guest@example.com', 'status': 'Accepted'}])
+
+    def test_collaborator_list_follows_event_edits(self):
+        self.client.force_login(self.guest)
+        url = reverse('get_collaborator_events')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.client.force_login(self.organizer)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(reverse('edit_event', args=[self.event.id]), {'title': 'Drinks'}, content_type='application/json')
+        self.client.force_login(self.guest)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['events'][0]['title'], 'Drinks')
+
+    def test_new_event_changes_created_list(self):
+        url = reverse('get_created_events')
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('create_event'), {
+                'title': 'Brunch', 'description': 'Morning out', 'date': '2026-11-01T10:00:00Z', 'location': 'Portland, ME',
+            }, content_type='application/json')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual([event['title'] for event in response.json()['events']], ['Dinner', 'Brunch'])
+
+
+class MetricsTests(EventsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.organizer = self.make_user('organizer', is_staff=True)
+        self.client.force_login(self.organizer)
+
+    def test_requests_are_recorded_per_view(self):
+        self.client.get(reverse('get_created_events'))
+        self.client.get(reverse('get_created_events'))
+        text = self.client.get(reverse('prometheus_metrics')).content.decode()
+        self.assertIn('nightout_request_duration_seconds_bucket{method="GET",status="2xx",view="get_created_events",le="+Inf"}', text)
+        self.assertIn('nightout_request_db_queries_count{view="get_created_events"}', text)
+        self.assertIn('nightout_request_cache_lookups_total{result="hit",view="get_created_events"}', text)
+
+    def test_caches_limiters_and_pools_report_gauges(self):
+        text = self.client.get(reverse('prometheus_metrics')).content.decode()
+        self.assertIn('nightout_cache_local_entries{cache="geocode"} ', text)
+        self.assertIn('nightout_singleflight_in_flight{group="place_details"} 0', text)
+        self.assertIn('nightout_rate_limit_remaining{limiter="google_places",window="second"} ', text)
+        self.assertIn('nightout_http_pool_requests{} ', text)
+
+    def test_queries_are_counted(self):
+        with mock.patch.object(metrics.request_db_queries, 'observe') as observe:
+            self.client.get(reverse('get_created_events'))
+        observe.assert_called_once_with(3, view='get_created_events')
+
+    def test_endpoint_needs_staff_or_token(self):
+        self.client.force_login(self.make_user('guest'))
+        self.assertEqual(self.client.get(reverse('prometheus_metrics')).status_code, 403)
+        with self.settings(METRICS_TOKEN='secret'):
+            response = self.client.get(reverse('prometheus_metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+
+class ContentHashTests(EventsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = cls.make_user('organizer')
+        cls.event = cls.make_event(cls.user, 'Hash')
+
+    def test_duplicate_messages_are_rejected_by_hash(self):
+        content = 'Meet at the pier. ' * 500
+        message = Message.objects.create(event=self.event, user=self.user, content=content)
+        self.assertEqual(message.content_hash, content_hash(content))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Message.objects.create(event=self.event, user=self.user, content=content)
+
+    def test_bulk_create_fills_hashes(self):
+        notifications = Notification.objects.bulk_create([
+            Notification(user=self.user, message='Event updated'),
+            Notification(user=self.user, message='Event cancelled'),
+        ])
+        self.assertEqual([n.message_hash for n in notifications], [content_hash('Event updated'), content_hash('Event cancelled')])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Notification.objects.bulk_create([Notification(user=self.user, message='Event updated')])
+
+
+class MessageFeedTests(EventsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.organizer = cls.make_user('organizer')
+        cls.event = cls.make_event(cls.organizer, 'Feed')
+        # Pairs of messages share a timestamp so the id tie-breaker is exercised
+        start = timezone.now() - timedelta(hours=1)
+        Message.objects.bulk_create([
+            Message(event=cls.event, user=cls.organizer, content=f'Message {i}', timestamp=start + timedelta(minutes=i // 2))
+            for i in range(7)
+        ])
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.organizer)
+        self.url = reverse('get_event_messages', args=[self.event.id])
+
+    def contents(self, response):
+        return [message['content'] for message in response.json()['messages']]
+
+    def test_pages_backwards_with_before_cursor(self):
+        pages = []
+        params = {'limit': 3}
+        while True:
+            data = self.client.get(self.url, params).json()
+            pages.append([message['content'] for message in data['messages']])
+            if not data['next_before']:
+                break
+            params['before'] = data['next_before']
+        self.assertEqual(pages, [
+            ['Message 6', 'Message 5', 'Message 4'],
+            ['Message 3', 'Message 2', 'Message 1'],
+            ['Message 0'],
+        ])
+
+    def test_since_returns_only_newer_messages(self):
+        first = self.client.get(self.url, {'limit': 2}).json()
+        self.assertEqual(self.contents(self.client.get(self.url, {'since': first['next_since']})), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('send_message_to_event', args=[self.event.id]), {'message': 'Late arrival'}, content_type='application/json')
+        response = self.client.get(self.url, {'since': first['next_since']})
+        self.assertEqual(self.contents(response), ['Late arrival'])
+        self.assertEqual(self.contents(self.client.get(self.url, {'since': response.json()['next_since']})), [])
+
+    def test_since_polls_are_not_cached(self):
+        since = self.client.get(self.url, {'limit': 2}).json()['next_since']
+        with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            response = self.client.get(self.url, {'since': since})
+        self.assertEqual((response.status_code, self.contents(response)), (200, []))
+        self.assertIn('ETag', response)
+        cache_set.assert_not_called()
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(self.url, {'before': 'nope'}).status_code, 400)
+
+
+class RealtimeTests(EventsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.organizer = cls.make_user('organizer')
+        cls.guest = cls.make_user('guest')
+        cls.outsider = cls.make_user('outsider')
+        cls.event = cls.make_event(cls.organizer, 'Live', guests=[cls.guest])
+
+    def setUp(self):
+        super().setUp()
+        # A fresh in-memory broker per test
+        patcher = mock.patch.object(realtime, 'broker', realtime.InMemoryBroker())
+        self.broker = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.url = reverse('poll_event_updates', args=[self.event.id])
+
+    def test_send_message_publishes_update(self):
+        self.client.force_login(self.guest)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('send_message_to_event', args=[self.event.id]), {'message': 'On my way'}, content_type='application/json')
+        updates, missed = self.broker.updates_since(self.event.id, 0)
+        self.assertFalse(missed)
+        self.assertEqual([(update['type'], update['data']['content']) for update in updates], [('message', 'On my way')])
+
+    def test_long_poll_returns_buffered_updates(self):
+        self.broker.publish(self.event.id, 'rsvp', {'user': 'guest@example.com', 'status': 'Accepted'})
+        self.broker.publish(self.event.id, 'rsvp', {'user': 'other@example.com', 'status': 'Rejected'})
+        self.client.force_login(self.organizer)
+        data = self.client.get(self.url, {'after': 1, 'timeout': 0}).json()
+        self.assertEqual([update['seq'] for update in data['updates']], [2])
+        self.assertEqual(data['last_seq'], 2)
+        self.assertFalse(data['reset'])
+
+    def test_long_poll_times_out_empty(self):
+        self.client.force_login(self.guest)
+        data = self.client.get(self.url, {'timeout': 0}).json()
+        self.assertEqual(data, {'updates': [], 'last_seq': 0, 'reset': False})
+
+    def test_long_poll_flags_missed_updates(self):
+        broker = realtime.InMemoryBroker(buffer_size=2)
+        for i in range(4):
+            broker.publish(self.event.id, 'message', {'content': f'Message {i}'})
+        updates, missed = broker.updates_since(self.event.id, 1)
+        self.assertTrue(missed)
+        self.assertEqual([update['seq'] for update in updates], [3, 4])
+
+    def test_long_poll_reads_messages_from_the_database(self):
+        # Sent through another worker process: in the database, never published to this one's broker
+        since = views.message_cursor({'id': 0, 'timestamp': timezone.now() - timedelta(minutes=1)})
+        Message.objects.create(event=self.event, user=self.organizer, content='Running late')
+        self.client.force_login(self.guest)
+        data = self.client.get(self.url, {'since': since, 'timeout': 0}).json()
+        self.assertEqual([m['content'] for m in data['messages']], ['Running late'])
+        self.assertEqual(data['next_since'], data['messages'][0]['cursor'])
+        self.assertEqual(data['updates'], [])
+
+        since = data['next_since']
+        data = self.client.get(self.url, {'since': since, 'timeout': 0}).json()
+        self.assertEqual((data['messages'], data['next_since']), ([], since))
+
+    async def test_long_poll_rechecks_the_database_while_waiting(self):
+        await sync_to_async(self.client.force_login)(self.guest)
+        since = views.message_cursor({'id': 0, 'timestamp': timezone.now() - timedelta(minutes=1)})
+        polls = []
+
+        def poll_messages():
+            polls.append(None)
+            if len(polls) == 3:
+                Message.objects.create(event=self.event, user=self.organizer, content='Here now')
+            return views.messages_since(self.event.id, views.parse_message_cursor(since))
+
+        with self.settings(REALTIME_DB_POLL_INTERVAL=0.01):
+            data = await realtime.wait_for_updates(self.event.id, None, 5, poll_messages=poll_messages)
+        self.assertEqual([m['content'] for m in data['messages']], ['Here now'])
+        self.assertEqual(len(polls), 3)
+
+    def test_long_poll_rejects_malformed_cursor(self):
+        self.client.force_login(self.guest)
+        self.assertEqual(self.client.get(self.url, {'since': 'nope', 'timeout': 0}).status_code, 400)
+
+    def test_long_poll_is_for_participants_only(self):
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.client.get(self.url, {'timeout': 0}).status_code, 403)
+
+    async def test_websocket_pushes_published_updates(self):
+        await sync_to_async(self.client.force_login)(self.guest)
+        cookie = f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'
+        scope = {'type': 'websocket', 'path': f'/ws/events/{self.event.id}/', 'headers': [
+            (b'host', b'testserver'), (b'origin', b'https://testserver'), (b'cookie', cookie.encode()),
+        ]}
+        incoming = asyncio.Queue()
+        outgoing = asyncio.Queue()
+        await incoming.put({'type': 'websocket.connect'})
+        connection = asyncio.ensure_future(realtime.websocket_application(scope, incoming.get, outgoing.put))
+
+        self.assertEqual((await asyncio.wait_for(outgoing.get(), 5))['type'], 'websocket.accept')
+        self.assertEqual(json.loads((await asyncio.wait_for(outgoing.get(), 5))['text'])['type'], 'hello')
+        self.broker.publish(self.event.id, 'message', {'content': 'Table for six'})
+        frame = json.loads((await asyncio.wait_for(outgoing.get(), 5))['text'])
+        self.assertEqual(frame['data'], {'content': 'Table for six'})
+
+        await incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(connection, 5)
+        self.assertEqual(self.broker._subscribers, {})
+
+    async def test_websocket_rejects_outsiders(self):
+        scope = {'type': 'websocket', 'path': f'/ws/events/{self.event.id}/', 'headers': [(b'host', b'testserver'), (b'origin', b'http://testserver')]}
+        incoming = asyncio.Queue()
+        outgoing = asyncio.Queue()
+        await incoming.put({'type': 'websocket.connect'})
+        await realtime.websocket_application(scope, incoming.get, outgoing.put)
+        self.assertEqual(outgoing.get_nowait(), {'type': 'websocket.close', 'code': 4403})
+
+
+    @override_settings(CSRF_TRUSTED_ORIGINS=['https://app.example.com', 'https://*.nightout.example'])
+    async def test_websocket_rejects_cross_site_origins(self):
+        await sync_to_async(self.client.force_login)(self.guest)
+        cookie = f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'.encode()
+        for origin, allowed in [
+            (b'https://testserver', True),
+            (b'https://app.example.com', True),
+            (b'https://m.nightout.example', True),
+            (b'https://evil.example', False),
+            (b'https://testserver.evil.example', False),
+            (None, False),
+        ]:
+            headers = [(b'host', b'testserver'), (b'cookie', cookie)] + ([(b'origin', origin)] if origin else [])
+            with self.subTest(origin=origin):
+                self.assertEqual(realtime.origin_allowed({'headers': headers}), allowed)
+
+        scope = {'type': 'websocket', 'path': f'/ws/events/{self.event.id}/', 'headers': [
+            (b'host', b'testserver'), (b'origin', b'https://evil.example'), (b'cookie', cookie),
+        ]}
+        incoming = asyncio.Queue()
+        outgoing = asyncio.Queue()
+        await incoming.put({'type': 'websocket.connect'})
+        await realtime.websocket_application(scope, incoming.get, outgoing.put)
+        self.assertEqual(outgoing.get_nowait(), {'type': 'websocket.close', 'code': 4403})
+
+
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.emails = [outbox.enqueue_mail('Invitation', 'Join us', None, [f'guest{i}@example.com']) for i in range(3)]
+
+    def statuses(self):
+        return list(OutboxEmail.objects.order_by('id').values_list('status', 'attempts'))
+
+    def test_send_batch_sends_due_messages_once(self):
+        self.assertEqual(outbox.send_batch(), (3, 0))
+        self.assertEqual([message.to for message in mail.outbox], [[f'guest{i}@example.com'] for i in range(3)])
+        self.assertEqual(self.statuses(), [(OutboxEmail.SENT, 1)] * 3)
+        self.assertEqual(outbox.send_batch(), (0, 0))
+
+    def test_claimed_messages_wait_for_the_lease(self):
+        self.assertEqual(len(outbox.claim_batch(2)), 2)
+        self.assertEqual([email.id for email in outbox.claim_batch(10)], [self.emails[2].id])
+        self.assertEqual(outbox.claim_batch(10), [])
+
+        # A worker that died mid-batch leaves its claim behind until the lease runs out
+        OutboxEmail.objects.filter(id=self.emails[0].id).update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual([email.id for email in outbox.claim_batch(10)], [self.emails[0].id])
+
+    @override_settings(MAIL_OUTBOX_RETRY_DELAY=30, MAIL_OUTBOX_MAX_DELAY=100, MAIL_OUTBOX_MAX_ATTEMPTS=3)
+    def test_failures_back_off_then_give_up(self):
+        def send(message):
+            if message.to == ['guest1@example.com']:
+                raise OSError('Mailbox unavailable')
+            return 1
+
+        with mock.patch('django.core.mail.EmailMessage.send', autospec=True, side_effect=send):
+            started = timezone.now()
+            self.assertEqual(outbox.send_batch(), (2, 1))
+            failing = OutboxEmail.objects.get(id=self.emails[1].id)
+            self.assertEqual((failing.status, failing.attempts, failing.last_error), (OutboxEmail.PENDING, 1, 'Mailbox unavailable'))
+            self.assertGreaterEqual(failing.next_attempt_at, started + timedelta(seconds=30))
+
+            # Not due again until the backoff has passed
+            self.assertEqual(outbox.send_batch(), (0, 0))
+            for _ in (2, 3):
+                OutboxEmail.objects.filter(id=failing.id).update(next_attempt_at=timezone.now())
+                self.assertEqual(outbox.send_batch(), (0, 1))
+        self.assertEqual(self.statuses()[1], (OutboxEmail.FAILED, 3))
+        self.assertEqual([outbox.retry_delay(attempts) for attempts in (1, 2, 3)], [30, 60, 100])
+
+    def test_unreachable_server_backs_off_the_whole_batch(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open', side_effect=OSError('Connection refused')):
+            self.assertEqual(outbox.send_batch(), (0, 3))
+        self.assertEqual(self.statuses(), [(OutboxEmail.PENDING, 1)] * 3)
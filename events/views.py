@@ -1,15 +1,35 @@
 from django.shortcuts import get_object_or_404
-from django.http import JsonResponse
+from nightout.fast_json import JsonResponse
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required
-from .models import Event, Invitation, User, Message
+from .models import Event, Invitation, User, Message, Notification
 from .forms import EventForm, InvitationForm, RSVPForm
 from django.views.decorators.csrf import csrf_exempt
 import json
-from django.core.mail import send_mail
+from .mail import enqueue_mail, enqueue_mass_mail
+from .realtime import publish_on_commit, is_participant, wait_for_updates
+from .counters import add_rsvps, move_rsvp
+from .caching import bump_versions_on_commit, event_version_key, user_version_key, versioned_response
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django import forms
 from nightout import settings
-from django.http import HttpResponseForbidden
+from django.http import HttpResponseForbidden, HttpResponseNotAllowed
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+from datetime import datetime, timedelta, timezone as dt_timezone
 
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+# Rows of a per-event query as a list. The event's existence is only checked when there are
+# no rows, so listing a non-empty event costs a single query; a missing event raises Http404.
+def event_rows_or_404(rows, event_id):
+    rows = list(rows)
+    if not rows:
+        get_object_or_404(Event.objects.only('id'), id=event_id)
+    return rows
 
 @csrf_exempt
 @login_required
@@ -22,6 +42,7 @@ def create_event(request):
             event = form.save(commit=False)
             event.organizer = request.user
             event.save()
+            bump_versions_on_commit(user_ids=[request.user.id])
             return JsonResponse({'status': 'success', 'event_id': event.id})
         else:
             print("Form errors:", form.errors)  # Debug: Print form errors
@@ -29,6 +50,44 @@ def create_event(request):
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
 
+# Version keys the cached GET responses depend on (see events/caching.py).
+# Writes bump the event and its organizer, and a user whenever they join an event.
+def event_versions(request, event_id):
+    return [event_version_key(event_id)]
+
+def created_events_versions(request):
+    return [user_version_key(request.user.id)]
+
+# The list shows every event the user is invited to, so it also depends on each of those events;
+# finding them is one covering-index lookup instead of the join the view runs
+def collaborator_events_versions(request):
+    event_ids = Invitation.objects.filter(user=request.user).values_list('event_id', flat=True)
+    return [user_version_key(request.user.id)] + [event_version_key(event_id) for event_id in event_ids]
+
+# (subject, message, from_email, recipient_list) of the email telling a user they were invited
+def invitation_email(event, user, inviter, email):
+    subject = 'You Have Been Invited to an Event!'
+    message = f'Hello {user.username},\n\nYou have been invited to the event "{event.title}" by {inviter.username}. Please check your account for more details.'
+    return subject, message, settings.DEFAULT_FROM_EMAIL, [email]
+
+# Insert invitations and return those that went in. Normally that's one INSERT; if another request
+# invited some of the same users meanwhile, they're inserted one by one to find out which are ours.
+def create_invitations(invitations):
+    try:
+        with transaction.atomic():
+            Invitation.objects.bulk_create(invitations)
+        return invitations
+    except IntegrityError:
+        created = []
+        for invitation in invitations:
+            try:
+                with transaction.atomic():
+                    invitation.save(force_insert=True)
+            except IntegrityError:
+                continue
+            created.append(invitation)
+        return created
+
 @csrf_exempt
 @login_required
 @require_http_methods(["POST"])
@@ -43,14 +102,12 @@ def invite_to_event(request, event_id):
             try:
                 user = User.objects.get(email=email)
                 invitation = Invitation.objects.create(event=event, user=user)
+                add_rsvps(event.id, invitation.status)
+                bump_versions_on_commit([event.id], [event.organizer_id, user.id])
+                publish_on_commit(event.id, 'invitation', {'user': user.email, 'status': invitation.status})
                 
-                # Send email notification
-                subject = 'You Have Been Invited to an Event!'
-                message = f'Hello {user.username},\n\nYou have been invited to the event "{event.title}" by {request.user.username}. Please check your account for more details.'
-                from_email = settings.DEFAULT_FROM_EMAIL
-                recipient_list = [email]
-
-                send_mail(subject, message, from_email, recipient_list)
+                # Queue email notification (sent by the send_queued_mail worker)
+                enqueue_mail(*invitation_email(event, user, request.user, email))
 
                 return JsonResponse({'status': 'success'})
             except User.DoesNotExist:
@@ -60,6 +117,82 @@ def invite_to_event(request, event_id):
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
 
+# Invite a list of users at once: {"emails": ["a@example.com", ...]}
+# Returns a result per email: invited, already_invited, user_not_found or invalid_email
+@csrf_exempt
+@login_required
+@require_http_methods(["POST"])
+def bulk_invite_to_event(request, event_id):
+    try:
+        event = get_object_or_404(Event, id=event_id, organizer=request.user)
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+
+    emails = data.get('emails')
+    if not isinstance(emails, list) or not emails:
+        return JsonResponse({'error': 'emails must be a non-empty list'}, status=400)
+    if len(emails) > settings.BULK_INVITE_MAX:
+        return JsonResponse({'error': f'At most {settings.BULK_INVITE_MAX} emails per request'}, status=400)
+
+    # Validate every address up front, keeping the first occurrence of duplicates
+    # results holds one {'email', 'result'} entry per address in request order; entries maps addresses to them
+    results = []
+    entries = {}
+    valid_emails = []
+    email_field = forms.EmailField()
+    for email in emails:
+        if not isinstance(email, str):
+            # Numbers, null, objects... can't be addresses, but are still reported back
+            results.append({'email': email, 'result': 'invalid_email'})
+            continue
+        if email in entries:
+            continue
+        entries[email] = {'email': email, 'result': 'user_not_found'}
+        results.append(entries[email])
+        try:
+            email_field.clean(email)
+        except ValidationError:
+            entries[email]['result'] = 'invalid_email'
+            continue
+        valid_emails.append(email)
+
+    with transaction.atomic():
+        # One query for all the users; if several accounts share an email the oldest one is invited
+        users_by_email = {}
+        for user in User.objects.filter(email__in=valid_emails).order_by('id'):
+            users_by_email.setdefault(user.email, user)
+
+        already_invited = set(
+            Invitation.objects.filter(event=event, user__in=list(users_by_email.values())).values_list('user_id', flat=True)
+        )
+        new_invitations = {}
+        for email, user in users_by_email.items():
+            if user.id in already_invited:
+                entries[email]['result'] = 'already_invited'
+            else:
+                new_invitations[email] = Invitation(event=event, user=user)
+                already_invited.add(user.id)
+
+        # Invitations another request created meanwhile stay theirs: reported as already_invited, no second email
+        invited = {invitation.user_id for invitation in create_invitations(list(new_invitations.values()))}
+        new_emails = []
+        for email, invitation in new_invitations.items():
+            if invitation.user_id in invited:
+                entries[email]['result'] = 'invited'
+                new_emails.append(invitation_email(event, invitation.user, request.user, email))
+            else:
+                entries[email]['result'] = 'already_invited'
+        new_invitations = [invitation for invitation in new_invitations.values() if invitation.user_id in invited]
+        if new_invitations:
+            add_rsvps(event.id, 'Pending', len(new_invitations))
+        bump_versions_on_commit([event.id], [event.organizer_id] + [invitation.user_id for invitation in new_invitations])
+        enqueue_mass_mail(new_emails)
+        for invitation in new_invitations:
+            publish_on_commit(event.id, 'invitation', {'user': invitation.user.email, 'status': invitation.status})
+
+    return JsonResponse({'status': 'success', 'results': results})
+
 @csrf_exempt
 @login_required
 @require_http_methods(["POST"])
@@ -69,15 +202,24 @@ def rsvp_for_event(request, event_id):
     
     if form.is_valid():
         status = form.cleaned_data['status']
-        event = get_object_or_404(Event, id=event_id)
+        event = get_object_or_404(Event.objects.select_related('organizer'), id=event_id)
         
-        invitation, created = Invitation.objects.get_or_create(event=event, user=request.user)
-        
-        if created or invitation.status == "Pending":  # New or no previous response
-            invitation.status = status
-            invitation.save()
+        with transaction.atomic():
+            invitation, created = Invitation.objects.get_or_create(event=event, user=request.user, defaults={'status': status})
+            if created:
+                add_rsvps(event.id, status)
+                responded = True
+            else:
+                # Only a Pending invitation can be answered; the conditional UPDATE keeps concurrent RSVPs from both counting
+                responded = Invitation.objects.filter(pk=invitation.pk, status='Pending').update(status=status) == 1
+                if responded:
+                    move_rsvp(event.id, 'Pending', status)
+
+        if responded:  # New or no previous response
+            bump_versions_on_commit([event.id], [event.organizer_id] + ([request.user.id] if created else []))
+            publish_on_commit(event.id, 'rsvp', {'user': request.user.email, 'status': status})
             
-            # Send notification to the event organizer
+            # Queue notification to the event organizer
             subject = 'RSVP Status Updated'
             message = (f'Hello {event.organizer.username},\n\n'
                        f'{request.user.username} has updated their RSVP status to "{status}" for your event "{event.title}".\n\n'
@@ -85,7 +227,7 @@ def rsvp_for_event(request, event_id):
             from_email = settings.DEFAULT_FROM_EMAIL
             recipient_list = [event.organizer.email]
 
-            send_mail(subject, message, from_email, recipient_list)
+            enqueue_mail(subject, message, from_email, recipient_list)
 
             return JsonResponse({'status': 'success', 'rsvp_status': status})
         else:
@@ -96,23 +238,23 @@ def rsvp_for_event(request, event_id):
 @csrf_exempt
 @login_required
 @require_http_methods(["GET"])
+@versioned_response(event_versions)
 def view_invitations_by_status(request, event_id):
-    print(request.GET.get('status'))
     status = request.GET.get('status')
     if status not in [None, 'Accepted', 'Rejected', 'Pending']:
         return JsonResponse({'error': 'Invalid status'}, status=400)
-    
-    event = get_object_or_404(Event, id=event_id)
-    invitations = Invitation.objects.filter(event=event)
-    
+
+    # One query joining the user's email in, instead of one user lookup per invitation
+    invitations = Invitation.objects.filter(event_id=event_id)
     if status:
         invitations = invitations.filter(status=status)
-    
+    invitations = event_rows_or_404(invitations.values('user__email', 'status'), event_id)
+
     invitation_list = [{
-        'user': invitation.user.email,
-        'status': invitation.status
+        'user': invitation['user__email'],
+        'status': invitation['status']
     } for invitation in invitations]
-    
+
     return JsonResponse({'invitations': invitation_list})
 
 
@@ -120,10 +262,13 @@ def view_invitations_by_status(request, event_id):
 @csrf_exempt
 @login_required
 @require_http_methods(["GET"])
+@versioned_response(event_versions)
 def view_event_attendees(request, event_id):
-    event = get_object_or_404(Event, id=event_id)
-    invitations = Invitation.objects.filter(event=event).select_related('user')
-    attendees = [{'email': invitation.user.email, 'first_name': invitation.user.first_name, 'last_name': invitation.user.last_name} for invitation in invitations]
+    invitations = event_rows_or_404(
+        Invitation.objects.filter(event_id=event_id).values('user__email', 'user__first_name', 'user__last_name'),
+        event_id,
+    )
+    attendees = [{'email': invitation['user__email'], 'first_name': invitation['user__first_name'], 'last_name': invitation['user__last_name']} for invitation in invitations]
     return JsonResponse({'attendees': attendees})
 
 @csrf_exempt
@@ -135,53 +280,240 @@ def send_message_to_event(request, event_id):
     message_content = data.get('message')
     if message_content:
         # Save the message to the database
-        Message.objects.create(
+        message = Message.objects.create(
             event=event,
             user=request.user,
             content=message_content
         )
+        bump_versions_on_commit([event.id])
+        # Push it to everyone following the event
+        publish_on_commit(event.id, 'message', {
+            'id': message.id,
+            'user': request.user.email,
+            'content': message.content,
+            'timestamp': message.timestamp.isoformat(),
+            'cursor': message_cursor({'id': message.id, 'timestamp': message.timestamp}),
+        })
         return JsonResponse({'status': 'success'})
     return JsonResponse({'error': 'No message provided'}, status=400)
 
 @csrf_exempt
 @login_required
 @require_http_methods(["GET"])
+@versioned_response(created_events_versions)
 def get_created_events(request):
-    events = Event.objects.filter(organizer=request.user).values()
+    events = Event.objects.filter(organizer=request.user).order_by('date').values()
     return JsonResponse({'events': list(events)})
 
 @csrf_exempt
 @login_required
 @require_http_methods(["GET"])
+@versioned_response(collaborator_events_versions)
 def get_collaborator_events(request):
     events = Event.objects.filter(invitations__user=request.user).values()
     return JsonResponse({'events': list(events)})
 
 
+# Message cursors are "<timestamp in epoch microseconds>-<id>", the (timestamp, id) keyset position of a message
+def message_cursor(message):
+    delta = message['timestamp'] - EPOCH
+    return f"{(delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds}-{message['id']}"
+
+# (timestamp, id) of a message cursor; raises ValueError if it is malformed
+def parse_message_cursor(cursor):
+    microseconds, message_id = cursor.split('-')
+    return EPOCH + timedelta(microseconds=int(microseconds)), int(message_id)
+
+# Chat messages of an event after a (timestamp, id) cursor, oldest first, in the shape they are published in
+# Read from the database, so a long-poll sees messages sent through any worker process
+def messages_since(event_id, since):
+    timestamp, message_id = since
+    rows = Message.objects.filter(event_id=event_id).filter(
+        Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+    ).order_by('timestamp', 'id').values('id', 'user__email', 'content', 'timestamp')[:settings.MESSAGES_MAX_PAGE_SIZE]
+    return [
+        {
+            'id': message['id'],
+            'user': message['user__email'],
+            'content': message['content'],
+            'timestamp': message['timestamp'].isoformat(),
+            'cursor': message_cursor(message),
+        }
+        for message in rows
+    ]
+
+# Chat feed of an event, paginated on (timestamp, id) so every page is an index range scan
+#   ?limit=N             newest N messages, newest first
+#   ?before=<cursor>     the next N older messages (use next_before from the previous page)
+#   ?since=<cursor>      only messages newer than the cursor, oldest first (use next_since to keep polling)
 @login_required
 @require_http_methods(["GET"])
+@versioned_response(event_versions, uncached_params=['since'])
 def get_event_messages(request, event_id):
-    event = get_object_or_404(Event, id=event_id)
-    messages = event.messages.all().order_by('-timestamp')  # Fetch messages for the event
+    try:
+        limit = int(request.GET.get('limit', settings.MESSAGES_PAGE_SIZE))
+        before = parse_message_cursor(request.GET['before']) if request.GET.get('before') else None
+        since = parse_message_cursor(request.GET['since']) if request.GET.get('since') else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid limit or cursor'}, status=400)
+    if not 1 <= limit <= settings.MESSAGES_MAX_PAGE_SIZE:
+        return JsonResponse({'error': f'limit must be between 1 and {settings.MESSAGES_MAX_PAGE_SIZE}'}, status=400)
+    if before and since:
+        return JsonResponse({'error': 'Use either before or since, not both'}, status=400)
+
+    messages = Message.objects.filter(event_id=event_id)
+    if since:
+        timestamp, message_id = since
+        messages = messages.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)).order_by('timestamp', 'id')
+    else:
+        if before:
+            timestamp, message_id = before
+            messages = messages.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+        messages = messages.order_by('-timestamp', '-id')
+
+    # Fetch messages for the event with their authors' emails in one query; one extra row tells us if there are more
+    rows = list(messages.values('id', 'user__email', 'content', 'timestamp')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        event_rows_or_404(rows, event_id)
+
     messages_list = [
         {
-            'user': message.user.email,
-            'content': message.content,
-            'timestamp': message.timestamp.isoformat()
+            'id': message['id'],
+            'user': message['user__email'],
+            'content': message['content'],
+            'timestamp': message['timestamp'].isoformat()
         }
-        for message in messages
+        for message in rows
     ]
-    return JsonResponse({'messages': messages_list})
+    if since:
+        next_since = message_cursor(rows[-1]) if rows else request.GET['since']
+        next_before = None
+    else:
+        next_since = message_cursor(rows[0]) if rows else None
+        next_before = message_cursor(rows[-1]) if has_more else None
+    return JsonResponse({
+        'messages': messages_list,
+        'has_more': has_more,
+        'next_before': next_before,
+        'next_since': next_since,
+    })
+
+
+# Annotate an Event queryset with its latest chat message (the RSVP counts are columns of Event)
+# Everything is computed in the same SQL statement with correlated subqueries
+def with_event_summary(events):
+    latest_message = Message.objects.filter(event=OuterRef('pk')).order_by('-timestamp', '-id')
+    return events.annotate(
+        latest_message_user=Subquery(latest_message.values('user__email')[:1]),
+        latest_message_content=Subquery(latest_message.values('content')[:1]),
+        latest_message_timestamp=Subquery(latest_message.values('timestamp')[:1]),
+    ).order_by('date')
+
+# Dashboard entry for one annotated event row
+def event_summary(row):
+    summary = {
+        'id': row['id'],
+        'title': row['title'],
+        'description': row['description'],
+        'date': row['date'],
+        'location': row['location'],
+        'rsvp': {
+            'Accepted': row['accepted_count'],
+            'Rejected': row['rejected_count'],
+            'Pending': row['pending_count'],
+        },
+        'latest_message': None,
+    }
+    if row['latest_message_timestamp'] is not None:
+        summary['latest_message'] = {
+            'user': row['latest_message_user'],
+            'content': row['latest_message_content'],
+            'timestamp': row['latest_message_timestamp'],
+        }
+    if 'my_status' in row:
+        summary['my_status'] = row['my_status']
+    return summary
+
+EVENT_SUMMARY_FIELDS = (
+    'id', 'title', 'description', 'date', 'location', 'accepted_count', 'rejected_count', 'pending_count',
+    'latest_message_user', 'latest_message_content', 'latest_message_timestamp',
+)
+
+# Everything the home page needs in one request: the user, their organized and collaborating
+# events with RSVP counts and latest message, and their unread notification count.
+# Costs a fixed number of queries however many events there are.
+@csrf_exempt
+@login_required
+@require_http_methods(["GET"])
+def get_dashboard(request):
+    user = request.user
+    organized = with_event_summary(Event.objects.filter(organizer=user)).values(*EVENT_SUMMARY_FIELDS)
+    # Filter with a subquery, not a join, so the RSVP counts still see every invitation of the event
+    collaborating = with_event_summary(
+        Event.objects.filter(id__in=Invitation.objects.filter(user=user).values('event_id'))
+    ).annotate(
+        my_status=Subquery(Invitation.objects.filter(event=OuterRef('pk'), user=user).values('status')[:1]),
+    ).values(*EVENT_SUMMARY_FIELDS, 'my_status')
+
+    return JsonResponse({
+        'user': {
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'email': user.email,
+        },
+        'organized_events': [event_summary(row) for row in organized],
+        'collaborator_events': [event_summary(row) for row in collaborating],
+        'unread_notifications': Notification.objects.filter(user=user, read_at__isnull=True).count(),
+    })
+
+# Mark all of the user's notifications as read
+@csrf_exempt
+@login_required
+@require_http_methods(["POST"])
+def mark_notifications_read(request):
+    updated = Notification.objects.filter(user=request.user, read_at__isnull=True).update(read_at=timezone.now())
+    return JsonResponse({'status': 'success', 'marked_read': updated})
+
+# Long-poll fallback for real-time updates, for clients that can't hold a WebSocket open
+#   GET ?after=<seq>&timeout=<seconds>  waits until there is an update newer than `after` or the timeout passes
+#   &since=<message cursor>             also returns chat messages newer than the cursor, read from the
+#                                       database, with next_since to poll from next time
+# Without `after` it only waits for updates from now on. A response with reset=true means updates
+# were missed, so the client should reload the event before polling again from last_seq.
+# Updates are only seen by the worker process their view ran in; chat messages polled with `since`
+# arrive whichever process they were sent through.
+async def poll_event_updates(request, event_id):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    if not await sync_to_async(lambda: request.user.is_authenticated)():
+        return JsonResponse({'error': 'User not authenticated'}, status=401)
+    if not await sync_to_async(is_participant)(request.user, event_id):
+        return JsonResponse({'error': 'You are not part of this event.'}, status=403)
+
+    try:
+        after = int(request.GET['after']) if request.GET.get('after') else None
+        timeout = min(float(request.GET.get('timeout', settings.REALTIME_POLL_TIMEOUT)), settings.REALTIME_POLL_TIMEOUT)
+        since = parse_message_cursor(request.GET['since']) if request.GET.get('since') else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid after, timeout or cursor'}, status=400)
+
+    if since is None:
+        return JsonResponse(await wait_for_updates(event_id, after, max(timeout, 0)))
+    data = await wait_for_updates(event_id, after, max(timeout, 0), poll_messages=lambda: messages_since(event_id, since))
+    data['next_since'] = data['messages'][-1]['cursor'] if data['messages'] else request.GET['since']
+    return JsonResponse(data)
 
 
 @csrf_exempt
 @login_required
 def edit_event(request, event_id):
     # Fetch the event, ensure it exists, and belongs to the requesting user (organizer)
-    event = get_object_or_404(Event, id=event_id)
+    event = get_object_or_404(Event.objects.select_related('organizer'), id=event_id)
 
     # Check if the logged-in user is the organizer of the event
-    if event.organizer != request.user:
+    if event.organizer_id != request.user.id:
         return HttpResponseForbidden(JsonResponse({'error': 'You are not allowed to edit this event.'}, status=403))
 
     if request.method == 'PUT':  # Using PUT for editing/updating the resource
@@ -205,7 +537,9 @@ def edit_event(request, event_id):
         event.description = description
         event.date = date
         event.location = location
-        event.save()
+        # Only the edited fields, so RSVPs counted since the event was loaded aren't written back over
+        event.save(update_fields=['title', 'description', 'date', 'location'])
+        bump_versions_on_commit([event.id], [event.organizer_id])
 
         # Return updated event data as JSON
         return JsonResponse({
@@ -1,12 +1,18 @@
+import math
 import requests
 from django.conf import settings
-from django.http import JsonResponse
+from nightout.fast_json import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from requests_oauthlib import OAuth2Session
 from django.shortcuts import redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login as auth_login, logout as auth_logout
 from django.contrib.auth import get_user_model
+from nightout import http_client, metrics
+from nightout.ratelimit import RateLimited, RateLimiter
+
+# Budget for sign-in calls to Google, shared by every worker
+oauth_quota = RateLimiter('google_oauth', settings.GOOGLE_OAUTH_QPS)
 
 # OAuth2 Client Setup
 oauth = OAuth2Session(client_id=settings.GOOGLE_CLIENT_ID, redirect_uri=settings.GOOGLE_REDIRECT_URI)
@@ -34,21 +40,30 @@ def google_callback(request):
         state=state,
         redirect_uri=settings.GOOGLE_REDIRECT_URI
     )
+    http_client.mount_shared_adapter(oauth)  # Reuse pooled connections to Google
 
     code = request.GET.get('code')
     if not code:
         return JsonResponse({'error': 'Authorization code is missing.'}, status=400)
 
-    # Fetch the token
-    token = oauth.fetch_token(
-        'https://oauth2.googleapis.com/token',
-        client_secret=settings.GOOGLE_CLIENT_SECRET,
-        code=code
-    )
-    print("token")
-    print(token)
-    # Get user info
-    response = oauth.get('https://www.googleapis.com/oauth2/v2/userinfo')
+    try:
+        # Fetch the token
+        oauth_quota.acquire()
+        with metrics.external_call('google_oauth'):
+            oauth.fetch_token(  # The session keeps the token for the userinfo call below
+                'https://oauth2.googleapis.com/token',
+                client_secret=settings.GOOGLE_CLIENT_SECRET,
+                code=code,
+                timeout=settings.HTTP_TIMEOUT
+            )
+        # Get user info
+        oauth_quota.acquire()
+        with metrics.external_call('google_userinfo'):
+            response = oauth.get('https://www.googleapis.com/oauth2/v2/userinfo', timeout=settings.HTTP_TIMEOUT)
+    except RateLimited as error:
+        response = JsonResponse({'error': 'Too many sign-ins right now, please try again shortly.'}, status=503)
+        response['Retry-After'] = str(math.ceil(error.retry_after))
+        return response
     user_info = response.json()
 
     # Get or create the user
@@ -2,6 +2,8 @@
 ASGI config for nightout project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests go to Django; WebSocket connections to /ws/events/<event_id>/ get
+real-time event updates (see events/realtime.py).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
@@ -13,4 +15,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'nightout.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from events.realtime import websocket_application  # noqa: E402 - needs the app registry set up above
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        await websocket_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
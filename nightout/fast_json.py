@@ -0,0 +1,39 @@
+# JSON encoding for API responses: orjson when it is installed (and JSON_SERIALIZER allows it),
+# the standard library otherwise. Both produce the same document - compact, UTF-8, and with
+# dates, times, decimals and UUIDs written the way DjangoJSONEncoder writes them.
+
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson writes these natively, but in its own format (microseconds, "+00:00");
+# passing them through to DjangoJSONEncoder keeps responses identical to the stdlib path
+ORJSON_OPTIONS = (
+    orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    if orjson is not None else 0
+)
+
+django_default = DjangoJSONEncoder().default
+
+
+# Encode data to JSON bytes; `default` handles types the encoder doesn't know
+def dumps(data, default=django_default):
+    if orjson is not None and settings.JSON_SERIALIZER == 'orjson':
+        return orjson.dumps(data, default=default, option=ORJSON_OPTIONS)
+    return json.dumps(data, default=default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+# Drop-in for django.http.JsonResponse that encodes with dumps()
+class JsonResponse(HttpResponse):
+    def __init__(self, data, safe=True, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError('In order to allow non-dict objects to be serialized set the safe parameter to False.')
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps(data), **kwargs)
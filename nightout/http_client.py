@@ -0,0 +1,89 @@
+# Shared, process-wide HTTP layer for outbound calls to Google APIs
+# Every caller goes through the same requests.Session / HTTPAdapter, so TCP+TLS
+# connections to googleapis.com are pooled and kept alive between requests instead
+# of paying a fresh handshake on each call.
+
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import metrics
+
+_lock = threading.RLock()
+_adapter = None
+_session = None
+
+
+# Build the adapter holding the connection pools, with retry/backoff on 5xx
+# 429 is not retried here: it goes back to the caller, whose rate limiter holds every worker back
+def _build_adapter():
+    retry = Retry(
+        total=settings.HTTP_MAX_RETRIES,
+        backoff_factor=settings.HTTP_BACKOFF_FACTOR,
+        status_forcelist=(500, 502, 503, 504),
+        respect_retry_after_header=True,
+        raise_on_status=False,  # Hand the last response back to the caller instead of raising
+    )
+    return HTTPAdapter(
+        pool_connections=settings.HTTP_POOL_HOSTS,  # Number of per-host pools kept
+        pool_maxsize=settings.HTTP_POOL_MAXSIZE,  # Keep-alive connections kept per host
+        max_retries=retry,
+    )
+
+
+# The shared adapter, created lazily so each gunicorn worker builds its own after fork
+def get_adapter():
+    global _adapter
+    if _adapter is None:
+        with _lock:
+            if _adapter is None:
+                _adapter = _build_adapter()
+    return _adapter
+
+
+# Mount the shared adapter on a session (e.g. an OAuth2Session) so it uses the same pools
+def mount_shared_adapter(session):
+    adapter = get_adapter()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# The shared session used for plain API calls
+def get_session():
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = mount_shared_adapter(requests.Session())
+    return _session
+
+
+# GET through the shared session with the default timeout
+def get(url, params=None, timeout=None, **kwargs):
+    if timeout is None:
+        timeout = settings.HTTP_TIMEOUT
+    return get_session().get(url, params=params, timeout=timeout, **kwargs)
+
+
+# TCP connections opened and requests sent through the shared pools of this process;
+# every request beyond the first on a connection reused a pooled one
+def pool_counts():
+    connections = requests_sent = 0
+    if _adapter is not None:
+        pools = _adapter.poolmanager.pools
+        with pools.lock:
+            items = list(pools._container.values())
+        for pool in items:
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+    return connections, requests_sent
+
+
+pool_connections = metrics.Gauge('nightout_http_pool_connections', 'TCP connections opened by the outbound HTTP pools of this worker')
+pool_connections.set_function(lambda: pool_counts()[0])
+pool_requests = metrics.Gauge('nightout_http_pool_requests', 'Requests sent through the outbound HTTP pools of this worker')
+pool_requests.set_function(lambda: pool_counts()[1])
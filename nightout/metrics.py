@@ -0,0 +1,292 @@
+# Request instrumentation: per-request latency, DB queries, outbound calls (Google, SMTP) and cache
+# lookups, aggregated into per-view histograms and served in the Prometheus text format, along
+# with the gauges and counters the caches, rate limiters and HTTP pools report themselves into.
+# Everything lives in the worker process - with several gunicorn workers each scrape sees the
+# worker that answered it, so scrape every worker (or sum over the pid label) for totals.
+
+import bisect
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+registry = []
+
+
+def format_labels(key):
+    return ','.join(f'{name}="{value}"' for name, value in key)
+
+
+# Counter with arbitrary labels; label sets are created on first use
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.series = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            series = dict(self.series)
+        for key, value in sorted(series.items()):
+            yield f'{self.name}{{{format_labels(key)}}} {value}'
+
+
+# Histogram with fixed upper bounds; counts are kept per bucket and made cumulative on export
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}  # labels -> [count per bucket..., +Inf count, sum]
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        for key, values in sorted(series.items()):
+            labels = format_labels(key)
+            separator = ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                yield f'{self.name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}'
+            yield f'{self.name}_sum{{{labels}}} {values[-1]}'
+            yield f'{self.name}_count{{{labels}}} {cumulative}'
+
+
+# Gauge read at scrape time: each label set has a function returning its current value
+# (None leaves the series out), so caches, limiters etc. report themselves without being listed here
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.series = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def set_function(self, function, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = function
+
+    def samples(self):
+        with self.lock:
+            series = dict(self.series)
+        for key, function in sorted(series.items(), key=lambda item: item[0]):
+            value = function()
+            if value is not None:
+                yield f'{self.name}{{{format_labels(key)}}} {value}'
+
+
+request_duration = Histogram('nightout_request_duration_seconds', 'Total time to answer a request')
+request_db_queries = Histogram('nightout_request_db_queries', 'Database queries run per request', COUNT_BUCKETS)
+request_db_duration = Histogram('nightout_request_db_duration_seconds', 'Time per request spent in database queries')
+request_external_calls = Counter('nightout_request_external_calls_total', 'Outbound calls made while answering requests')
+request_external_duration = Histogram('nightout_request_external_duration_seconds', 'Time per request spent in outbound calls, by kind')
+request_cache_lookups = Counter('nightout_request_cache_lookups_total', 'Cache lookups made while answering requests')
+external_call_duration = Histogram('nightout_external_call_duration_seconds', 'Duration of each outbound call, by service (requests and background work)')
+cache_lookups = Counter('nightout_cache_lookups_total', 'Cache lookups by cache and result (requests and background work)')
+
+
+# What one request has cost so far; shared with the executor threads working for it
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.external = {}  # kind -> [calls, seconds]
+        self.cache = {'hit': 0, 'miss': 0}
+
+    def add_query(self, seconds):
+        with self.lock:
+            self.db_queries += 1
+            self.db_seconds += seconds
+
+    def add_external(self, kind, seconds):
+        with self.lock:
+            totals = self.external.setdefault(kind, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def add_cache(self, result):
+        with self.lock:
+            self.cache[result] += 1
+
+
+# Metrics of the request being handled in this context, None outside a request
+current = contextvars.ContextVar('request_metrics', default=None)
+
+
+# Database execute wrapper installed on every connection; only times queries made for a request
+def record_query(execute, sql, params, many, context):
+    metrics = current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(time.perf_counter() - started)
+
+
+def install_query_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+connection_created.connect(install_query_recorder)
+
+
+# Time an outbound call: `service` names it in the global histogram (google_geocode, smtp, ...),
+# `kind` is what it adds up under in the request's totals (http, smtp)
+@contextmanager
+def external_call(service, kind='http'):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        external_call_duration.observe(elapsed, service=service)
+        metrics = current.get()
+        if metrics is not None:
+            metrics.add_external(kind, elapsed)
+
+
+# Count a cache lookup against the cache and the current request
+def record_cache(cache, hit):
+    result = 'hit' if hit else 'miss'
+    cache_lookups.inc(cache=cache, result=result)
+    metrics = current.get()
+    if metrics is not None:
+        metrics.add_cache(result)
+
+
+# ThreadPoolExecutor whose tasks run in a copy of the submitter's context, so the queries,
+# calls and cache lookups they make count against the request that submitted them
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+# Records every request into the histograms above. Works for sync and async views alike.
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        # Connections opened before the middleware was loaded missed connection_created
+        for connection in connections.all(initialized_only=True):
+            install_query_recorder(connection)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.finish(request, response, metrics, started)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.finish(request, response, metrics, started)
+
+    # Record the request now, or once a streaming response has sent its last chunk.
+    # File responses are recorded as they're handed over: wrapping them would stop the server
+    # from sending the file with sendfile and copy every chunk through Python instead.
+    def finish(self, request, response, metrics, started):
+        if not response.streaming or getattr(response, 'file_to_stream', None) is not None:
+            self.record(request, response, metrics, time.perf_counter() - started)
+        elif response.is_async:
+            response.streaming_content = self.record_after_async(response.streaming_content, request, response, metrics, started)
+        else:
+            response.streaming_content = self.record_after(response.streaming_content, request, response, metrics, started)
+        return response
+
+    def record_after(self, content, request, response, metrics, started):
+        try:
+            yield from content
+        finally:
+            self.record(request, response, metrics, time.perf_counter() - started)
+
+    async def record_after_async(self, content, request, response, metrics, started):
+        try:
+            async for chunk in content:
+                yield chunk
+        finally:
+            self.record(request, response, metrics, time.perf_counter() - started)
+
+    def record(self, request, response, metrics, elapsed):
+        # Label by route, not path, so the number of series stays bounded
+        view = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+        request_duration.observe(elapsed, view=view, method=request.method, status=f'{response.status_code // 100}xx')
+        request_db_queries.observe(metrics.db_queries, view=view)
+        request_db_duration.observe(metrics.db_seconds, view=view)
+        for kind, (calls, seconds) in metrics.external.items():
+            request_external_calls.inc(calls, view=view, kind=kind)
+            request_external_duration.observe(seconds, view=view, kind=kind)
+        for result, count in metrics.cache.items():
+            if count:
+                request_cache_lookups.inc(count, view=view, result=result)
+
+
+# Every metric in the Prometheus text exposition format
+def render():
+    lines = [
+        '# HELP nightout_process_info Worker process that produced these metrics',
+        '# TYPE nightout_process_info gauge',
+        f'nightout_process_info{{pid="{os.getpid()}"}} 1',
+    ]
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
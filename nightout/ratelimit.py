@@ -0,0 +1,152 @@
+# Rate limiting of Google API calls, shared by every worker through the 'coordination' Django cache
+# Each limiter allows `rate` calls per one-second window (a token bucket refilled every second)
+# and, optionally, `daily_quota` calls per quota day. Interactive calls may use the whole budget;
+# background work (cache refreshes, prefetching) gets a share of each second and has to leave a
+# reserve of the daily quota. A call over budget waits for the next window for a short while
+# before giving up with RateLimited.
+# Counting relies on cache incr(), which is atomic on memcached/Redis; on the file cache
+# concurrent workers may occasionally let a few extra calls through.
+
+import contextvars
+import math
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache
+
+from nightout import metrics
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# Priority of the Google calls made in this context
+priority = contextvars.ContextVar('google_call_priority', default=INTERACTIVE)
+
+# Google resets daily quotas at midnight Pacific Time
+QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+
+limiter_calls = metrics.Counter('nightout_rate_limit_calls_total', 'Calls through the rate limiters by priority and outcome')
+limiter_wait = metrics.Histogram('nightout_rate_limit_wait_seconds', 'Time calls spent queued for rate limit budget')
+limiter_remaining = metrics.Gauge('nightout_rate_limit_remaining', 'Calls left in the current window of each rate limiter')
+
+
+class RateLimited(Exception):
+    def __init__(self, limiter, retry_after):
+        super().__init__(f'{limiter} rate limit reached, retry in {retry_after:.1f}s')
+        self.limiter = limiter
+        self.retry_after = retry_after
+
+
+# Run the Google calls made inside the block at background priority
+@contextmanager
+def background():
+    token = priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        priority.reset(token)
+
+
+# Current quota day and the seconds left in it
+def quota_day(now):
+    local = datetime.fromtimestamp(now, QUOTA_TIMEZONE)
+    midnight = datetime.combine(local.date() + timedelta(days=1), datetime.min.time(), QUOTA_TIMEZONE)
+    return local.strftime('%Y%m%d'), midnight.timestamp() - now
+
+
+# incr() that starts a missing (or just expired) counter
+# Backends without a native incr (the file and database caches) implement it as get() and set()
+# with the default timeout, which would let a daily counter expire after a few idle minutes;
+# their counters get their TTL back with touch()
+def count_call(shared, key, ttl):
+    shared.add(key, 0, ttl)
+    try:
+        count = shared.incr(key)
+    except ValueError:
+        shared.set(key, 1, ttl)
+        return 1
+    if type(shared).incr is BaseCache.incr:
+        shared.touch(key, ttl)
+    return count
+
+def uncount_call(shared, key):
+    try:
+        shared.decr(key)
+    except ValueError:
+        pass
+
+
+class RateLimiter:
+    def __init__(self, name, rate, daily_quota=0, backend='coordination'):
+        self.name = name
+        self.rate = rate
+        self.daily_quota = daily_quota  # 0 for no daily limit
+        self.backend = backend
+        limiter_remaining.set_function(self.remaining_this_second, limiter=name, window='second')
+        if daily_quota:
+            limiter_remaining.set_function(self.remaining_today, limiter=name, window='day')
+
+    def _key(self, *parts):
+        return ':'.join(('ratelimit', self.name) + parts)
+
+    # Take budget for one call at the current priority, waiting for it if that's quick enough
+    def acquire(self):
+        level = priority.get()
+        max_wait = settings.GOOGLE_QUEUE_WAIT if level == INTERACTIVE else settings.GOOGLE_BACKGROUND_QUEUE_WAIT
+        started = time.monotonic()
+        queued = False
+        while True:
+            wait = self._take(level)
+            waited = time.monotonic() - started
+            if wait is None:
+                limiter_calls.inc(limiter=self.name, priority=level, outcome='queued' if queued else 'immediate')
+                if queued:
+                    limiter_wait.observe(waited, limiter=self.name, priority=level)
+                return
+            if waited + wait > max_wait:
+                limiter_calls.inc(limiter=self.name, priority=level, outcome='rejected')
+                raise RateLimited(self.name, wait)
+            queued = True
+            time.sleep(wait)
+
+    # Count the call, or return the seconds until budget may be available
+    def _take(self, level):
+        shared = caches[self.backend]
+        now = time.time()
+
+        cooldown_until = shared.get(self._key('cooldown'))
+        if cooldown_until is not None and cooldown_until > now:
+            return cooldown_until - now
+
+        limit = self.rate if level == INTERACTIVE else max(1, int(self.rate * settings.GOOGLE_BACKGROUND_SHARE))
+        window = self._key('second', str(int(now)))
+        if count_call(shared, window, 2) > limit:
+            uncount_call(shared, window)
+            return math.floor(now) + 1 - now
+
+        if self.daily_quota:
+            day, seconds_left = quota_day(now)
+            limit = self.daily_quota if level == INTERACTIVE else int(self.daily_quota * (1 - settings.GOOGLE_DAILY_RESERVE))
+            day_key = self._key('day', day)
+            if count_call(shared, day_key, 2 * 24 * 3600) > limit:
+                uncount_call(shared, day_key)
+                uncount_call(shared, window)
+                return seconds_left
+        return None
+
+    # Google said we're over its limit: hold every worker's calls back for `seconds`
+    def penalize(self, seconds):
+        caches[self.backend].set(self._key('cooldown'), time.time() + seconds, math.ceil(seconds) + 1)
+
+    # Calls left in the current second
+    def remaining_this_second(self):
+        return self.rate - caches[self.backend].get(self._key('second', str(int(time.time()))), 0)
+
+    # Calls left in the current quota day
+    def remaining_today(self):
+        day, _ = quota_day(time.time())
+        return self.daily_quota - caches[self.backend].get(self._key('day', day), 0)
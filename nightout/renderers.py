@@ -0,0 +1,17 @@
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+
+from nightout.fast_json import dumps
+
+
+# JSONRenderer that encodes through nightout.fast_json (orjson when available)
+# Pretty-printed or ASCII-only output, which orjson can't produce, goes through the stock renderer
+class FastJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}) or not api_settings.UNICODE_JSON:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Same escaping the stock renderer applies, so the output is safe to embed in <script>
+        return dumps(data, default=self.encoder_class().default).replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
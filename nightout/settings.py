@@ -1,4 +1,5 @@
 import os
+import sys
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -8,6 +9,10 @@ load_dotenv()
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Files the app writes at runtime (file cache, place photos). Only the app's user may write here - the file cache
+# unpickles what it reads, so it must never live in a shared directory like /tmp
+STATE_DIR = Path(os.getenv('STATE_DIR', BASE_DIR / 'var'))
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
 
@@ -17,6 +22,10 @@ GOOGLE_PLACES_API_KEY = os.getenv('SECRET_KEY')
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.getenv('DEBUG', 'False') == 'True'
 
+# Django's signing key (sessions, CSRF, password reset tokens, photo URL signatures). Must be set in
+# production; with DEBUG=True or under "manage.py test" a fixed, insecure key is used when it isn't
+SECRET_KEY = os.getenv('DJANGO_SECRET_KEY') or ('django-insecure-dev-only' if DEBUG or sys.argv[1:2] == ['test'] else None)
+
 ALLOWED_HOSTS = ['*','nighout.onrender.com']
 
 # Application definition
@@ -39,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "nightout.metrics.MetricsMiddleware",  # First, so request latency covers the rest of the stack
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -131,8 +141,103 @@ GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
 GOOGLE_REDIRECT_URI = os.getenv('GOOGLE_REDIRECT_URI')
 
+# Request instrumentation and the Prometheus endpoint (nightout/metrics.py)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # Bearer token a scraper can use instead of a staff login
+
+# JSON encoding of API responses (nightout/fast_json.py)
+JSON_SERIALIZER = os.getenv('JSON_SERIALIZER', 'orjson')  # 'orjson' (used when installed) or 'stdlib'
+
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'nightout.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
+# Shared outbound HTTP client (nightout/http_client.py)
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '5'))  # Default seconds per outbound call
+HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', '10'))  # Number of hosts to keep connection pools for
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '16'))  # Keep-alive connections per host
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '2'))  # Retries on 5xx and connection errors (a 429 is left to the rate limiter)
+HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', '0.3'))  # Exponential backoff between retries
+
+# Cache backends shared by all workers on the host
+# 'default' holds data (geocode and place details caches, cached responses); 'coordination' holds
+# the rate limiter counters and single-flight locks, which culling the data cache must not drop
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', str(STATE_DIR / 'cache')),  # Created with mode 0700
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', '20000')),
+        },
+    },
+    'coordination': {
+        'BACKEND': os.getenv('COORDINATION_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.getenv('COORDINATION_CACHE_LOCATION', str(STATE_DIR / 'coordination')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('COORDINATION_CACHE_MAX_ENTRIES', '20000')),
+        },
+    },
+}
+
+# Geocode cache (places/cache.py)
+GEOCODE_CACHE_SIZE = int(os.getenv('GEOCODE_CACHE_SIZE', '1024'))  # Entries kept in each worker's memory
+GEOCODE_CACHE_TTL = int(os.getenv('GEOCODE_CACHE_TTL', str(7 * 24 * 3600)))  # Seconds a found location is kept
+GEOCODE_NEGATIVE_TTL = int(os.getenv('GEOCODE_NEGATIVE_TTL', '3600'))  # Seconds an unknown location is kept
+
+# Place Details cache (places/views.py)
+PLACES_DETAILS_CACHE_SIZE = int(os.getenv('PLACES_DETAILS_CACHE_SIZE', '2048'))  # Entries kept in each worker's memory
+PLACES_DETAILS_TTL = int(os.getenv('PLACES_DETAILS_TTL', str(24 * 3600)))  # Seconds details are considered fresh
+PLACES_DETAILS_STALE_TTL = int(os.getenv('PLACES_DETAILS_STALE_TTL', str(6 * 24 * 3600)))  # Extra seconds stale details are served while refreshing
+PLACES_DETAILS_REFRESH_BACKOFF = int(os.getenv('PLACES_DETAILS_REFRESH_BACKOFF', '600'))  # Seconds before a failed background refresh is tried again
+
+# Google Places search settings
+PLACES_MAX_WORKERS = int(os.getenv('PLACES_MAX_WORKERS', '16'))  # Worker threads for concurrent Google calls
+PLACES_BACKGROUND_WORKERS = int(os.getenv('PLACES_BACKGROUND_WORKERS', '2'))  # Worker threads for background refreshes and prefetches
+PLACES_REQUEST_TIMEOUT = float(os.getenv('PLACES_REQUEST_TIMEOUT', '3'))  # Seconds per upstream call
+PLACES_SEARCH_TIMEOUT = float(os.getenv('PLACES_SEARCH_TIMEOUT', '5'))  # Deadline in seconds for a whole search
+PLACES_CURSOR_TTL = int(os.getenv('PLACES_CURSOR_TTL', '300'))  # Seconds a "load more" cursor stays valid
+PLACES_CURSOR_CACHE_SIZE = int(os.getenv('PLACES_CURSOR_CACHE_SIZE', '1024'))  # Cursors kept in each worker's memory
+PLACES_PAGE_TOKEN_ATTEMPTS = int(os.getenv('PLACES_PAGE_TOKEN_ATTEMPTS', '3'))  # Tries for a next_page_token that isn't valid yet
+PLACES_PAGE_TOKEN_DELAY = float(os.getenv('PLACES_PAGE_TOKEN_DELAY', '1'))  # Seconds between those tries
+PLACES_MAX_LIMIT = int(os.getenv('PLACES_MAX_LIMIT', '60'))  # Largest 'limit' a search may ask for
+PLACES_MAX_CATEGORIES = int(os.getenv('PLACES_MAX_CATEGORIES', '5'))  # Most business types one search may combine
+PLACES_FLIGHT_RESULT_TTL = int(os.getenv('PLACES_FLIGHT_RESULT_TTL', '5'))  # Seconds one worker's upstream result is shared with the others
+PLACES_FLIGHT_LOCK_TTL = int(os.getenv('PLACES_FLIGHT_LOCK_TTL', '15'))  # Seconds other workers wait on the worker making a call (longer than a text search with page-token retries)
+PLACES_FLIGHT_POLL_INTERVAL = float(os.getenv('PLACES_FLIGHT_POLL_INTERVAL', '0.05'))  # Seconds between their checks for its result
+PLACES_LOCAL_RADIUS_MILES = float(os.getenv('PLACES_LOCAL_RADIUS_MILES', '5'))  # Radius for answering searches from stored places
+PLACES_LOCAL_MIN_RESULTS = int(os.getenv('PLACES_LOCAL_MIN_RESULTS', '10'))  # Stored places needed to skip Google
+PLACES_LOCAL_MAX_AGE = int(os.getenv('PLACES_LOCAL_MAX_AGE', str(7 * 24 * 3600)))  # Seconds before a stored place must be re-fetched
+
+# Place photo proxy (places/photos.py)
+PHOTO_CACHE_DIR = os.getenv('PHOTO_CACHE_DIR', str(STATE_DIR / 'photos'))  # Shared by the workers on a host
+PHOTO_CACHE_MAX_BYTES = int(os.getenv('PHOTO_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))  # Disk space photos may use before the least recently used are deleted
+PHOTO_MAX_BYTES = int(os.getenv('PHOTO_MAX_BYTES', str(10 * 1024 * 1024)))  # Largest single photo accepted from Google
+PHOTO_WIDTHS = [int(width) for width in os.getenv('PHOTO_WIDTHS', '100,200,400,800,1600').split(',')]  # Widths photos are stored at, ascending
+PHOTO_DEFAULT_WIDTH = int(os.getenv('PHOTO_DEFAULT_WIDTH', '400'))  # Width when the client doesn't ask for one
+PHOTO_MAX_AGE = int(os.getenv('PHOTO_MAX_AGE', str(30 * 24 * 3600)))  # Seconds clients and proxies may keep a photo
+PHOTO_NEGATIVE_TTL = int(os.getenv('PHOTO_NEGATIVE_TTL', '3600'))  # Seconds a photo Google couldn't serve is remembered
+
+# Itinerary planner (places/itinerary.py)
+ITINERARY_MAX_STOPS = int(os.getenv('ITINERARY_MAX_STOPS', '50'))  # Most places one itinerary may visit
+ITINERARY_STAY_MINUTES = int(os.getenv('ITINERARY_STAY_MINUTES', '60'))  # Time spent at each stop unless the request says otherwise
+ITINERARY_HORIZON_MINUTES = int(os.getenv('ITINERARY_HORIZON_MINUTES', str(12 * 60)))  # How long after the start a stop may open and still be visited; stops opening later count as closed
+ITINERARY_SPEED_MPH = float(os.getenv('ITINERARY_SPEED_MPH', '15'))  # Average travel speed between stops
+
 SESSION_ENGINE = 'django.contrib.sessions.backends.db'
 
+# Google API rate limiting shared by all workers (nightout/ratelimit.py)
+GOOGLE_PLACES_QPS = int(os.getenv('GOOGLE_PLACES_QPS', '50'))  # Places/Geocoding calls per second across all workers
+GOOGLE_PLACES_DAILY_QUOTA = int(os.getenv('GOOGLE_PLACES_DAILY_QUOTA', '0'))  # Calls per quota day (midnight Pacific); 0 for no limit
+GOOGLE_OAUTH_QPS = int(os.getenv('GOOGLE_OAUTH_QPS', '20'))  # Sign-in token/userinfo calls per second
+GOOGLE_BACKGROUND_SHARE = float(os.getenv('GOOGLE_BACKGROUND_SHARE', '0.5'))  # Part of each second's budget background work may use
+GOOGLE_DAILY_RESERVE = float(os.getenv('GOOGLE_DAILY_RESERVE', '0.1'))  # Part of the daily quota kept for interactive searches
+GOOGLE_QUEUE_WAIT = float(os.getenv('GOOGLE_QUEUE_WAIT', '1'))  # Seconds an interactive call may wait for budget
+GOOGLE_BACKGROUND_QUEUE_WAIT = float(os.getenv('GOOGLE_BACKGROUND_QUEUE_WAIT', '10'))  # Seconds a background call may wait
+GOOGLE_OVER_LIMIT_COOLDOWN = float(os.getenv('GOOGLE_OVER_LIMIT_COOLDOWN', '2'))  # Seconds all calls pause after Google answers OVER_QUERY_LIMIT/429
+
 # Email settings
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = os.getenv('EMAIL_HOST')
@@ -142,5 +247,28 @@ EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
-
-
+# Outbox email worker (events/mail.py, `python manage.py send_queued_mail`)
+MAIL_OUTBOX_BATCH_SIZE = int(os.getenv('MAIL_OUTBOX_BATCH_SIZE', '50'))  # Messages sent per SMTP connection
+MAIL_OUTBOX_POLL_INTERVAL = float(os.getenv('MAIL_OUTBOX_POLL_INTERVAL', '2'))  # Seconds between checks when idle
+MAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('MAIL_OUTBOX_MAX_ATTEMPTS', '8'))  # Tries before a message is marked Failed
+MAIL_OUTBOX_RETRY_DELAY = int(os.getenv('MAIL_OUTBOX_RETRY_DELAY', '30'))  # Seconds before the first retry, doubled each time
+MAIL_OUTBOX_MAX_DELAY = int(os.getenv('MAIL_OUTBOX_MAX_DELAY', '3600'))  # Longest wait between retries
+MAIL_OUTBOX_LEASE = int(os.getenv('MAIL_OUTBOX_LEASE', '300'))  # Seconds a claimed batch is held before another worker may retry it
+
+BULK_INVITE_MAX = int(os.getenv('BULK_INVITE_MAX', '100'))  # Emails accepted by one bulk invite request
+
+# Event chat feed pagination (events.views.get_event_messages)
+MESSAGES_PAGE_SIZE = int(os.getenv('MESSAGES_PAGE_SIZE', '50'))
+MESSAGES_MAX_PAGE_SIZE = int(os.getenv('MESSAGES_MAX_PAGE_SIZE', '200'))
+
+# Conditional GET / response caching of the read-only events endpoints (events/caching.py)
+# Version stamps and rendered bodies expire after this long, which also bounds how stale a
+# response can get after a write that bypasses the events views (admin, shell, migrations)
+EVENTS_CACHE_TTL = int(os.getenv('EVENTS_CACHE_TTL', '600'))
+
+# Real-time event updates (events/realtime.py)
+REALTIME_BUFFER_SIZE = int(os.getenv('REALTIME_BUFFER_SIZE', '100'))  # Recent updates kept per event for long-poll catch-up
+REALTIME_MAX_EVENTS = int(os.getenv('REALTIME_MAX_EVENTS', '1000'))  # Events whose recent updates are kept
+REALTIME_QUEUE_SIZE = int(os.getenv('REALTIME_QUEUE_SIZE', '100'))  # Undelivered updates kept per subscriber
+REALTIME_POLL_TIMEOUT = float(os.getenv('REALTIME_POLL_TIMEOUT', '25'))  # Longest a long-poll request waits
+REALTIME_DB_POLL_INTERVAL = float(os.getenv('REALTIME_DB_POLL_INTERVAL', '2'))  # How often a long-poll checks the database for chat messages
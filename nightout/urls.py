@@ -17,12 +17,14 @@ Including another URLconf
 from django.urls import path, include
 from django.urls import path
 from gAuth.views import say_hi
+from .views import prometheus_metrics
 
 urlpatterns = [
     path('api/', include('gAuth.urls')),  # Include aAuth URLs
     path('api/', include('places.urls')), # Include places URLs
     path('accounts/', include('django.contrib.auth.urls')),
     path('api/', include('events.urls')),
+    path('api/metrics/', prometheus_metrics, name='prometheus_metrics'),  # Request metrics, Prometheus text format
     path('', say_hi, name='sayhi'),  
 ]
 
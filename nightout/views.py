@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import require_http_methods
+
+from . import metrics
+
+
+# Prometheus scrape endpoint for this worker's request metrics
+# Open to staff users, or to a scraper sending "Authorization: Bearer <METRICS_TOKEN>"
+@require_http_methods(["GET"])
+def prometheus_metrics(request):
+    token = settings.METRICS_TOKEN
+    if not request.user.is_staff and not (token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')):
+        return HttpResponse('Forbidden\n', status=403, content_type='text/plain')
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,121 @@
+# Caches for Google API results
+# A small in-process LRU with TTL sits in front of the shared Django cache backend,
+# so repeat lookups in the same worker cost a dict access and other workers can
+# still reuse what one of them fetched.
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from nightout import metrics
+
+# Sentinel returned on a cache miss, so a cached None can still be told apart
+MISSING = object()
+
+# Format of the entries TieredCache keeps in the shared backend, bumped when it changes
+# 2: (expires_at, value), so a worker promoting an entry keeps its remaining TTL
+SHARED_VERSION = 2
+
+local_entries = metrics.Gauge('nightout_cache_local_entries', 'Entries in the in-process tier of each cache')
+local_removals = metrics.Counter('nightout_cache_local_removals_total', 'Entries dropped from the in-process tier of each cache, by reason')
+shared_lookups = metrics.Counter('nightout_cache_shared_lookups_total', 'Lookups that missed the in-process tier and went to the shared backend')
+
+
+# In-process LRU cache whose entries expire after a TTL, reported to the metrics under `name`
+class TTLCache:
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+        local_entries.set_function(self.__len__, cache=name)
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                local_removals.inc(cache=self.name, reason='expired')
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                local_removals.inc(cache=self.name, reason='evicted')
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Two-tier cache: in-process TTLCache first, then the shared Django cache backend
+class TieredCache:
+    def __init__(self, name, maxsize, ttl, backend='default'):
+        self.name = name
+        self.ttl = ttl
+        self.backend = backend
+        self.local = TTLCache(name, maxsize, ttl)
+
+    # Backend keys are hashed so any string is safe to use (memcached limits length/characters)
+    def _shared_key(self, key):
+        return f"{self.name}:{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+
+    def get(self, key, default=MISSING):
+        value = self.local.get(key)
+        if value is not MISSING:
+            metrics.record_cache(self.name, hit=True)
+            return value
+        entry = caches[self.backend].get(self._shared_key(key), MISSING, version=SHARED_VERSION)
+        remaining = MISSING if entry is MISSING else entry[0] - time.time()
+        hit = remaining is not MISSING and remaining > 0
+        metrics.record_cache(self.name, hit=hit)
+        shared_lookups.inc(cache=self.name, result='hit' if hit else 'miss')
+        if not hit:
+            return default
+        # Promote to the local tier so the next lookup in this worker stays in-process,
+        # for no longer than the entry has left (a short negative entry stays short)
+        value = entry[1]
+        self.local.set(key, value, remaining)
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self.local.set(key, value, ttl)
+        caches[self.backend].set(self._shared_key(key), (time.time() + ttl, value), ttl, version=SHARED_VERSION)
+
+    def delete(self, key):
+        self.local.delete(key)
+        caches[self.backend].delete(self._shared_key(key), version=SHARED_VERSION)
+
+
+# Normalize a free-form location so trivially different spellings share a cache entry
+# e.g. "  Kennebunkport ,ME " and "kennebunkport, me" both become "kennebunkport, me"
+def normalize_location(location):
+    if not location:
+        return ''
+    location = re.sub(r'\s+', ' ', location.strip().lower())
+    location = re.sub(r'\s*,\s*', ', ', location)
+    return location.strip(' ,.')
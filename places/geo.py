@@ -0,0 +1,84 @@
+# Geohash spatial index for the Place table
+# Points are encoded into base32 geohash strings; every point inside a geohash cell shares
+# the cell's prefix, so "places near X" becomes a handful of indexed prefix range scans
+# over the 3x3 block of cells around X, followed by an exact distance check.
+
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+MAX_PRECISION = 12
+KM_PER_DEGREE_LAT = 110.574
+KM_PER_DEGREE_LNG = 111.320  # At the equator, shrinks with cos(latitude)
+
+
+# Encode a coordinate into a geohash of the given length
+def encode(lat, lng, precision=MAX_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True  # Bits alternate between longitude (even) and latitude (odd)
+    while len(geohash) < precision:
+        value, bounds = (lng, lng_range) if even else (lat, lat_range)
+        mid = (bounds[0] + bounds[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            bounds[0] = mid
+        else:
+            bits = bits << 1
+            bounds[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(geohash)
+
+
+# Height and width in degrees of a geohash cell of the given length
+def cell_size(precision):
+    total_bits = 5 * precision
+    lng_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lng_bits)
+
+
+# Longest geohash whose cells are at least radius_km across at this latitude,
+# so the 3x3 block of cells around a point covers the whole search circle
+def precision_for_radius(radius_km, lat):
+    lng_scale = max(math.cos(math.radians(lat)), 0.01)
+    for precision in range(MAX_PRECISION, 0, -1):
+        lat_deg, lng_deg = cell_size(precision)
+        if lat_deg * KM_PER_DEGREE_LAT >= radius_km and lng_deg * KM_PER_DEGREE_LNG * lng_scale >= radius_km:
+            return precision
+    return 1
+
+
+# The cell containing the point and its 8 neighbours
+def neighbourhood(lat, lng, precision):
+    lat_deg, lng_deg = cell_size(precision)
+    cells = []
+    for dlat in (-1, 0, 1):
+        cell_lat = min(max(lat + dlat * lat_deg, -90.0), 90.0)
+        for dlng in (-1, 0, 1):
+            cell_lng = (lng + dlng * lng_deg + 180.0) % 360.0 - 180.0
+            cell = encode(cell_lat, cell_lng, precision)
+            if cell not in cells:
+                cells.append(cell)
+    return cells
+
+
+# Place queryset limited to the geohash cells around a point (a superset of the search circle)
+def nearby_places(lat, lng, radius_km, queryset=None):
+    from django.db.models import Q
+    from .models import Place
+
+    if queryset is None:
+        queryset = Place.objects.all()
+    query = Q()
+    for cell in neighbourhood(lat, lng, precision_for_radius(radius_km, lat)):
+        # '~' sorts after every base32 character, so this range is exactly the cell's prefix
+        query |= Q(geohash__gte=cell, geohash__lt=cell + '~')
+    return queryset.filter(query)
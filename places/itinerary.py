@@ -0,0 +1,194 @@
+# Visiting order for a night out with several stops
+# All pairwise distances are computed at once into a matrix, a first route is built by going
+# to the nearest stop that can still be visited, and 2-opt then untangles it: reversing a
+# stretch of the route whenever that shortens it without making more stops closed on arrival
+# or the night end later. Good enough for ~50 stops in a few milliseconds.
+# Times are minutes after the start of the night, on the wall clock of the places. Only opening
+# windows that start within the night's horizon count, so a place that's closed tonight is
+# reported closed instead of being scheduled for when it opens days later.
+
+import bisect
+
+import numpy as np
+
+WEEK = 7 * 24 * 60
+MAX_CHECKS = 100  # Improving 2-opt moves whose schedule is checked per round, best first
+
+
+# Miles between every pair of points (haversine), as an N x N matrix
+def distance_matrix(lats, lngs):
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lng = np.radians(np.asarray(lngs, dtype=float))
+    dlat = lat[None, :] - lat[:, None]
+    dlng = lng[None, :] - lng[:, None]
+
+    a = np.sin(dlat / 2)**2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlng / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return 6371.0 * c * 0.621371
+
+
+# Minutes since Sunday midnight, the start of Google's opening hours week
+def minute_of_week(moment):
+    return ((moment.weekday() + 1) % 7) * 1440 + moment.hour * 60 + moment.minute
+
+
+# Opening windows of a place from Google's opening_hours, as sorted (opens, closes) minutes
+# relative to `start`, that are open at some point between `start` and `horizon` minutes later.
+# [] when there are none, None when the place is always open or its hours are unknown.
+def opening_windows(opening_hours, start, horizon):
+    periods = (opening_hours or {}).get('periods')
+    if not periods:
+        return None
+    offset = minute_of_week(start)
+    windows = []
+    has_periods = False
+    for period in periods:
+        if 'open' not in period:
+            continue
+        if 'close' not in period:
+            return None  # Google's way of saying open 24 hours
+        opens = period['open']['day'] * 1440 + int(period['open']['time'][:2]) * 60 + int(period['open']['time'][2:])
+        closes = period['close']['day'] * 1440 + int(period['close']['time'][:2]) * 60 + int(period['close']['time'][2:])
+        if closes <= opens:
+            closes += WEEK  # e.g. Saturday 20:00 to Sunday 02:00
+        for shift in (-WEEK, 0, WEEK):
+            window = (opens + shift - offset, closes + shift - offset)
+            if window[0] <= horizon and window[1] > 0:
+                windows.append(window)
+        has_periods = True
+    if not has_periods:
+        return None
+    windows.sort()
+    return [opens for opens, _ in windows], [closes for _, closes in windows]
+
+
+# When a visit arriving at `arrival` can start so it fits inside an opening window,
+# or None if the place won't be open long enough for it
+def visit_start(windows, arrival, stay):
+    if windows is None:
+        return arrival
+    opens, closes = windows
+    for i in range(bisect.bisect_left(closes, arrival + stay), len(closes)):
+        start = max(arrival, opens[i])
+        if closes[i] >= start + stay:
+            return start
+    return None
+
+
+# Timetable of a route: (stops closed on arrival, minute the last visit ends, [(arrive, start, leave, open)])
+# A stop that can't be fitted into its opening hours is still visited on arrival, and counted
+def schedule(route, travel, windows, stay):
+    closed = 0
+    time = 0.0
+    position = 0
+    visits = []
+    for stop in route:
+        arrival = time + travel[position][stop]
+        start = visit_start(windows[stop], arrival, stay)
+        is_open = start is not None
+        if not is_open:
+            closed += 1
+            start = arrival
+        time = start + stay
+        visits.append((arrival, start, time, is_open))
+        position = stop
+    return closed, time, visits
+
+
+# First route: from the origin, repeatedly go to the stop where the next visit can start
+# soonest, preferring stops that will be open
+def nearest_neighbour(travel, windows, stay):
+    unvisited = list(range(1, len(travel)))
+    route = []
+    time = 0.0
+    position = 0
+    while unvisited:
+        best = None
+        for stop in unvisited:
+            arrival = time + travel[position][stop]
+            start = visit_start(windows[stop], arrival, stay)
+            key = (1, arrival) if start is None else (0, start)
+            if best is None or key < best[0]:
+                best = (key, stop)
+        (_, start), stop = best
+        route.append(stop)
+        unvisited.remove(stop)
+        time = start + stay
+        position = stop
+    return route
+
+
+# Whether reversing route[i..j] keeps the schedule at least as good: no more stops closed on arrival,
+# and the night ending no later unless fewer stops are closed. Only the route from i on is timed,
+# starting from the current timetable (leaves, closed_through), and once it is past j and no later
+# and no more closed than the current route at the same point, the rest can only go as well -
+# arriving earlier never makes a visit start later.
+def reversal_keeps_schedule(route, i, j, leaves, closed_through, travel, windows, stay):
+    closed = closed_through[i - 1] if i else 0
+    time = leaves[i - 1] if i else 0.0
+    position = route[i - 1] if i else 0
+    for k in range(i, len(route)):
+        stop = route[i + j - k] if k <= j else route[k]
+        arrival = time + travel[position][stop]
+        start = visit_start(windows[stop], arrival, stay)
+        if start is None:
+            closed += 1
+            if closed > closed_through[-1]:
+                return False
+            start = arrival
+        time = start + stay
+        position = stop
+        if k >= j and time <= leaves[k] + 1e-9 and closed <= closed_through[k]:
+            return True
+    return closed < closed_through[-1]
+
+
+# Improve a route with 2-opt moves: reverse route[i..j] when that shortens it and the schedule
+# gets no worse. Savings of all moves come from one vectorized pass over the distance matrix.
+def two_opt(route, distances, travel, windows, stay):
+    n = len(route)
+    positions = np.arange(n)
+    while n > 1:
+        _, _, visits = schedule(route, travel, windows, stay)
+        leaves = [leave for _, _, leave, _ in visits]
+        closed_through = np.cumsum([not is_open for *_, is_open in visits]).tolist()
+
+        path = np.array([0] + route)
+        before = path[:-1]  # Stop before position i
+        first = path[1:]  # Stop at position i
+        after = np.append(path[2:], -1)  # Stop after position j, -1 past the end
+        has_after = after >= 0
+        after_safe = np.where(has_after, after, 0)
+
+        # delta[i, j], the change in length from reversing route[i..j]: edges (before i, i) and (j, after j) become (before i, j) and (i, after j)
+        delta = distances[before[:, None], first[None, :]] - distances[before, first][:, None]
+        delta += np.where(
+            has_after[None, :],
+            distances[first[:, None], after_safe[None, :]] - distances[first, after_safe][None, :],
+            0.0,
+        )
+        delta[positions[:, None] >= positions[None, :]] = 0.0
+
+        improved = False
+        candidates = np.argsort(delta, axis=None)[:MAX_CHECKS]
+        for i, j in zip(*np.unravel_index(candidates, delta.shape)):
+            if delta[i, j] >= -1e-9:
+                break
+            if reversal_keeps_schedule(route, int(i), int(j), leaves, closed_through, travel, windows, stay):
+                route = route[:i] + route[i:j + 1][::-1] + route[j + 1:]
+                improved = True
+                break
+        if not improved:
+            break
+    return route
+
+
+# Visiting order for the stops at (lats[1:], lngs[1:]) starting from (lats[0], lngs[0])
+# windows[k] are the opening windows of point k (None for the origin); stay is minutes per stop
+# and speed_mph the average travel speed. Returns (route of point indices, distance matrix, schedule).
+def plan_route(lats, lngs, windows, stay, speed_mph):
+    distances = distance_matrix(lats, lngs)
+    travel = (distances / speed_mph * 60).tolist()  # Minutes; nested lists index faster in the timing loops
+    route = nearest_neighbour(travel, windows, stay)
+    route = two_opt(route, distances, travel, windows, stay)
+    return route, distances, schedule(route, travel, windows, stay)
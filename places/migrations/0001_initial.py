@@ -0,0 +1,33 @@
+# Generated by Django 4.2.15 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Place',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('place_id', models.CharField(max_length=255, unique=True)),
+                ('name', models.CharField(blank=True, max_length=255)),
+                ('lat', models.FloatField()),
+                ('lng', models.FloatField()),
+                ('geohash', models.CharField(max_length=12)),
+                ('types', models.CharField(blank=True, max_length=500)),
+                ('rating', models.FloatField(blank=True, null=True)),
+                ('price_level', models.IntegerField(blank=True, null=True)),
+                ('details', models.JSONField(blank=True, default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['geohash'], name='place_geohash_idx')],
+            },
+        ),
+    ]
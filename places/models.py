@@ -1,3 +1,23 @@
 from django.db import models
 
-# Create your models here.
+
+# A place we've seen in a Google search, kept so nearby searches can be answered locally
+class Place(models.Model):
+    place_id = models.CharField(max_length=255, unique=True)  # Google place_id
+    name = models.CharField(max_length=255, blank=True)
+    lat = models.FloatField()
+    lng = models.FloatField()
+    geohash = models.CharField(max_length=12)  # Spatial index key, see places/geo.py
+    types = models.CharField(max_length=500, blank=True)  # Comma-wrapped types, e.g. ",bar,restaurant,"
+    rating = models.FloatField(null=True, blank=True)
+    price_level = models.IntegerField(null=True, blank=True)  # 0 (free) to 4 (most expensive)
+    details = models.JSONField(default=dict, blank=True)  # Raw Place Details result
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['geohash'], name='place_geohash_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.place_id})"
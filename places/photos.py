@@ -0,0 +1,178 @@
+# On-disk cache of place photos fetched from Google
+# Each photo is stored once per width under PHOTO_CACHE_DIR and served straight from the file,
+# so repeat views cost no Google call and the web server can send it with sendfile.
+# Photos are written under a temporary name and renamed into place, so workers sharing the
+# directory never see a partial file. When the directory grows past PHOTO_CACHE_MAX_BYTES the
+# least recently used photos are deleted; a photo's mtime is bumped when it's used (at most daily).
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from nightout import metrics
+
+# Google photo references are URL-safe tokens of a few hundred characters
+REFERENCE_PATTERN = re.compile(r'^[A-Za-z0-9_-]{10,1000}$')
+
+# Image formats Google serves, by their leading bytes
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG', 'image/png'),
+    (b'GIF8', 'image/gif'),
+)
+
+TEMP_PREFIX = '.tmp-'
+TEMP_MAX_AGE = 3600  # Seconds before a temporary file left by a crashed worker is removed
+TOUCH_INTERVAL = 24 * 3600  # Seconds between mtime bumps of a photo in use
+
+photo_cache_bytes = metrics.Gauge('nightout_photo_cache_bytes', 'Bytes of photos on disk, as last counted by this worker plus what it wrote since')
+photo_evictions = metrics.Counter('nightout_photo_cache_evictions_total', 'Photos deleted to keep the cache under its size limit')
+
+
+class PhotoTooLarge(Exception):
+    pass
+
+
+class PhotoCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None  # Bytes on disk when last counted, plus what this worker wrote since
+        self.lock = threading.Lock()
+        self.pruning = threading.Lock()
+        photo_cache_bytes.set_function(lambda: self.size)
+
+    # File name of a photo at a width; also its ETag, since the stored photo never changes
+    def key(self, reference, width):
+        return hashlib.sha256(f'{reference}:{width}'.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    # Path of a stored photo, None if it has to be fetched
+    def get(self, key):
+        path = self.path(key)
+        try:
+            modified = os.stat(path).st_mtime
+        except FileNotFoundError:
+            metrics.record_cache('place_photos', hit=False)
+            return None
+        if time.time() - modified > TOUCH_INTERVAL:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass  # Pruned by another worker just now; the caller's open() will tell
+        metrics.record_cache('place_photos', hit=True)
+        return path
+
+    # Store a photo from an iterable of byte chunks and return its path
+    # Raises PhotoTooLarge (and stores nothing) past PHOTO_MAX_BYTES
+    def put(self, key, chunks):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TEMP_PREFIX)
+        size = 0
+        try:
+            with os.fdopen(descriptor, 'wb') as photo:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > settings.PHOTO_MAX_BYTES:
+                        raise PhotoTooLarge(key)
+                    photo.write(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self._added(size)
+        return path
+
+    def _added(self, size):
+        with self.lock:
+            counted = self.size is not None
+            if counted:
+                self.size += size
+            over = counted and self.size > self.max_bytes
+        # The first photo this worker stores counts what's on disk (including that photo)
+        if not counted or over:
+            self.prune()
+
+    # Delete least recently used photos until the cache is back under 90% of its limit
+    def prune(self):
+        if not self.pruning.acquire(blocking=False):
+            return  # Another thread of this worker is already at it
+        try:
+            photos = []
+            now = time.time()
+            for folder in os.scandir(self.directory):
+                if not folder.is_dir():
+                    continue
+                for entry in os.scandir(folder.path):
+                    try:
+                        stat = entry.stat()
+                        if entry.name.startswith(TEMP_PREFIX):
+                            if now - stat.st_mtime > TEMP_MAX_AGE:
+                                os.unlink(entry.path)
+                            continue
+                    except FileNotFoundError:
+                        continue
+                    photos.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in photos)
+            if total > self.max_bytes:
+                photos.sort()
+                for _, size, path in photos:
+                    if total <= self.max_bytes * 0.9:
+                        break
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        continue  # Another worker removed it first
+                    total -= size
+                    photo_evictions.inc()
+            with self.lock:
+                self.size = total
+        finally:
+            self.pruning.release()
+
+
+# HMAC of a photo reference under SECRET_KEY, sent along with it in the photo URLs we hand out.
+# The photo endpoint only fetches signed references, so it can't be used as an open proxy that
+# spends our Google quota and disk on any reference a client makes up.
+def sign_reference(reference):
+    return salted_hmac('places.photos.reference', reference, algorithm='sha256').hexdigest()
+
+
+def signature_valid(reference, signature):
+    return bool(signature) and constant_time_compare(sign_reference(reference), signature)
+
+
+# Content type of a stored photo from its first bytes
+def sniff_content_type(head):
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return 'application/octet-stream'
+
+
+# The nearest stored width at or above the requested one, so each photo has a handful of sizes
+def photo_width(requested):
+    widths = settings.PHOTO_WIDTHS
+    try:
+        requested = int(requested)
+    except (TypeError, ValueError):
+        return settings.PHOTO_DEFAULT_WIDTH
+    for width in widths:
+        if width >= requested:
+            return width
+    return widths[-1]
@@ -0,0 +1,11 @@
+from nightout.renderers import FastJSONRenderer
+
+
+# Lets clients ask for application/x-ndjson (streamed search results)
+# Streamed searches bypass rendering; this only renders plain responses such as errors, as one JSON line
+class NDJSONRenderer(FastJSONRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return super().render(data, accepted_media_type, renderer_context) + b'\n'
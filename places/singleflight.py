@@ -0,0 +1,99 @@
+# Single-flight coalescing of identical upstream calls
+# Identical lookups made at the same time - by threads of one worker, or by different workers
+# - share one upstream call and its result instead of each calling Google themselves.
+# Across workers this relies on the shared 'coordination' Django cache: add() elects the worker
+# that makes the call, and its result is published there for a few seconds for the others to pick up.
+# add() is atomic on memcached/Redis; on the file cache two workers may occasionally both call.
+
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.core.cache import caches
+
+from nightout import metrics
+from .cache import MISSING
+
+flight_calls = metrics.Counter('nightout_singleflight_calls_total', 'Coalesced upstream lookups by group and outcome')
+flights_in_progress = metrics.Gauge('nightout_singleflight_in_flight', 'Calls this worker is making that others may be waiting on, by group')
+
+
+class SingleFlight:
+    def __init__(self, name, backend='coordination'):
+        self.name = name
+        self.backend = backend
+        self.in_flight = {}  # key -> Future of the call this worker is making
+        self.lock = threading.Lock()
+        flights_in_progress.set_function(lambda: len(self.in_flight), group=name)
+
+    def _shared_key(self, key, suffix):
+        return f"flight:{self.name}:{hashlib.sha1(key.encode('utf-8')).hexdigest()}:{suffix}"
+
+    # fn(*args), unless the same key is already being fetched - then that call's result (or exception)
+    # deadline is the caller's time.monotonic() deadline: past it, a call another worker is making
+    # is no longer waited for, and this worker makes its own
+    def do(self, key, fn, *args, deadline=None):
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+        if not leader:
+            self._count('shared_local')
+            return future.result()
+
+        try:
+            result = self._call_once_across_workers(key, fn, args, deadline)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def _call_once_across_workers(self, key, fn, args, deadline):
+        shared = caches[self.backend]
+        lock_key = self._shared_key(key, 'lock')
+        result_key = self._shared_key(key, 'result')
+
+        # Another worker fetched it moments ago
+        result = shared.get(result_key, MISSING)
+        if result is not MISSING:
+            self._count('shared_remote')
+            return result
+
+        # Wait for the worker holding the lock, as long as it may need for its call but no later than
+        # the caller's deadline; if it fails or dies (its lock vanishes or expires without a result),
+        # or the deadline passes, make the call here instead
+        give_up_at = time.monotonic() + settings.PLACES_FLIGHT_LOCK_TTL
+        if deadline is not None:
+            give_up_at = min(give_up_at, deadline)
+        while True:
+            owns_lock = shared.add(lock_key, os.getpid(), settings.PLACES_FLIGHT_LOCK_TTL)
+            if owns_lock or time.monotonic() >= give_up_at:
+                break
+            time.sleep(settings.PLACES_FLIGHT_POLL_INTERVAL)
+            result = shared.get(result_key, MISSING)
+            if result is not MISSING:
+                self._count('shared_remote')
+                return result
+
+        try:
+            result = fn(*args)
+            shared.set(result_key, result, settings.PLACES_FLIGHT_RESULT_TTL)
+        finally:
+            if owns_lock:
+                shared.delete(lock_key)
+        self._count('calls')
+        return result
+
+    # calls: upstream calls this worker made; shared_local: lookups that waited on another thread
+    # of this worker; shared_remote: lookups answered by another worker's call
+    def _count(self, outcome):
+        flight_calls.inc(group=self.name, outcome=outcome)
@@ -1,3 +1,703 @@
-from django.test import TestCase
+import json
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import requests
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.renderers import JSONRenderer
+
+from nightout import http_client, ratelimit
+from nightout.renderers import FastJSONRenderer
+from . import cache as places_cache
+from . import geo, itinerary, photos, singleflight, views
+from .models import Place
+
+
+# Stand-in for a requests.Response from the Google APIs
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+
+    def json(self):
+        return self.data
+
+
+# Google Geocoding/Places as seen through nightout.http_client.get: the text search finds
+# `places` as (place_id, lat, lng, rating, price_level) - or `places[business_type]` if it is a
+# dict - and `next_places` on a second page if given; details_hook(place_id) runs inside each
+# Place Details call, e.g. to hold it back
+class FakeGoogle:
+    def __init__(self, places, details_hook=None, next_places=None):
+        self.places = places
+        self.next_places = next_places
+        self.details_hook = details_hook
+        self.calls = Counter()
+
+    def get(self, url, params=None, **kwargs):
+        service = url.split('/')[-2]
+        self.calls[service] += 1
+        if service == 'geocode':
+            return FakeResponse({'status': 'OK', 'results': [{'geometry': {'location': {'lat': 43.3, 'lng': -70.4}}}]})
+        if service == 'textsearch':
+            page = self.next_places if 'pagetoken' in params else self.places
+            if isinstance(page, dict):
+                page = page[params['query'].split(' in ')[0]]
+            return FakeResponse({'status': 'OK', 'results': [
+                {'place_id': place_id, 'types': ['bar'], 'rating': rating, 'price_level': price_level,
+                 'geometry': {'location': {'lat': lat, 'lng': lng}}}
+                for place_id, lat, lng, rating, price_level in page
+            ], **({'next_page_token': 'page2'} if self.next_places and 'pagetoken' not in params else {})})
+        if self.details_hook is not None:
+            self.details_hook(params['place_id'])
+        return FakeResponse({'status': 'OK', 'result': {'name': params['place_id'], 'rating': 4}})
+
+
+# The places caches keep an in-process tier next to the Django cache, so both are emptied per test
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'places-tests'},
+    'coordination': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'places-tests-coordination'},
+})
+class PlacesTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        caches['coordination'].clear()
+        for tiered in (views.geocode_cache, views.details_cache, views.cursor_cache, views.missing_photos, views.refresh_failures):
+            tiered.local.clear()
+
+    # POST a search with Google faked; a streamed response is read into response.lines while it still is
+    def search(self, google, **data):
+        with mock.patch('nightout.http_client.get', google.get):
+            response = self.client.post(reverse('search_businesses'), {'location': 'Kennebunkport, ME', 'business_type': 'bar', **data}, content_type='application/json')
+            if response.streaming:
+                response.lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+            # "Load more" prefetches run in the background; let them finish before Google stops being faked
+            for prefetch in list(views.prefetching.values()):
+                prefetch.result(timeout=5)
+        return response
+
+
+class TieredCacheTests(PlacesTestCase):
+
+    def test_promotion_keeps_the_remaining_ttl(self):
+        writer = places_cache.TieredCache('tiered-tests', 10, 3600)
+        reader = places_cache.TieredCache('tiered-tests', 10, 3600)
+        writer.set('key', 'value', 60)
+        self.assertEqual(reader.get('key'), 'value')
+        expires_at, _ = reader.local._data['key']
+        self.assertLessEqual(expires_at - time.monotonic(), 60)
+
+
+class PaginationTests(PlacesTestCase):
+
+    places = [(f'place{i}', 43.3 + i / 100, -70.4, 4.0, 2) for i in range(5)]
+
+    def test_next_page_comes_from_the_prefetched_cursor(self):
+        google = FakeGoogle(self.places)
+        first = self.search(google, limit=3)
+        self.assertEqual([place['name'] for place in first.json()], ['place0', 'place1', 'place2'])
+        # The prefetch already looked up the details of the places left for the next page
+        calls = google.calls.copy()
+        self.assertEqual(calls['details'], 5)
+
+        second = self.search(google, cursor=first['X-Next-Cursor'], limit=3)
+        self.assertEqual([place['name'] for place in second.json()], ['place3', 'place4'])
+        self.assertEqual(google.calls, calls)
+        self.assertNotIn('X-Next-Cursor', second)  # Last page
+
+    def test_next_google_page_is_prefetched(self):
+        google = FakeGoogle(self.places, next_places=[('place5', 43.36, -70.4, 4.0, 2)])
+        first = self.search(google, limit=5)
+        self.assertEqual(google.calls['textsearch'], 2)
+
+        second = self.search(google, cursor=first['X-Next-Cursor'], limit=5)
+        self.assertEqual([place['name'] for place in second.json()], ['place5'])
+        self.assertEqual((google.calls['textsearch'], google.calls['details']), (2, 6))
+        self.assertNotIn('X-Next-Cursor', second)
+
+    def test_unknown_or_expired_cursor_is_rejected(self):
+        google = FakeGoogle(self.places)
+        self.assertEqual(self.search(google, cursor='unknown').status_code, 400)
+
+        cursor = self.search(google, limit=3)['X-Next-Cursor']
+        cache.clear()
+        views.cursor_cache.local.clear()  # Past PLACES_CURSOR_TTL
+        response = self.search(google, cursor=cursor)
+        self.assertEqual((response.status_code, response.json()), (400, {'error': 'Invalid or expired cursor'}))
+
+
+class LocalSearchTests(PlacesTestCase):
+
+    places = [(f'google{i}', 43.3 + i / 100, -70.4, 4.0, 2) for i in range(3)]
+
+    def setUp(self):
+        super().setUp()
+        views.geocode_cache.set(places_cache.normalize_location('Kennebunkport, ME'), (43.3, -70.4))
+
+    # `count` bars stored by earlier searches, each a little further north of the origin
+    def store_places(self, count):
+        Place.objects.bulk_create([
+            Place(place_id=f'stored{i}', name=f'Stored {i}', lat=43.3 + i / 1000, lng=-70.4, geohash=geo.encode(43.3 + i / 1000, -70.4),
+                  types=',bar,', rating=4.0, details={'name': f'Stored {i}'})
+            for i in range(count)
+        ])
+
+    def test_enough_fresh_stored_places_answer_without_google(self):
+        self.store_places(settings.PLACES_LOCAL_MIN_RESULTS)
+        google = FakeGoogle(self.places)
+        response = self.search(google)
+        self.assertEqual([place['name'] for place in response.json()], [f'Stored {i}' for i in range(settings.PLACES_LOCAL_MIN_RESULTS)])
+        self.assertEqual(sum(google.calls.values()), 0)
+
+    def test_stale_stored_places_fall_back_to_google(self):
+        self.store_places(settings.PLACES_LOCAL_MIN_RESULTS)
+        Place.objects.update(updated_at=timezone.now() - timedelta(seconds=settings.PLACES_LOCAL_MAX_AGE + 1))
+        google = FakeGoogle(self.places)
+        response = self.search(google)
+        self.assertEqual([place['name'] for place in response.json()], ['google0', 'google1', 'google2'])
+        self.assertEqual(google.calls['textsearch'], 1)
+
+    def test_too_few_stored_places_fall_back_to_google(self):
+        self.store_places(settings.PLACES_LOCAL_MIN_RESULTS - 1)
+        google = FakeGoogle(self.places)
+        self.search(google)
+        self.assertEqual(google.calls['textsearch'], 1)
+        # The Google results are stored for the next search
+        self.assertTrue(Place.objects.filter(place_id='google0', types__contains=',bar,').exists())
+
+
+class StaleDetailsTests(PlacesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        views.details_cache.set('place0', {
+            'fields': views.DETAILS_FIELDS,
+            'fetched_at': time.time() - settings.PLACES_DETAILS_TTL - 1,
+            'data': {'name': 'Old name'},
+        })
+
+    # Look the place up through get_cached_place_details and wait for the refresh it starts
+    def lookup(self, google):
+        with mock.patch('nightout.http_client.get', google.get):
+            details = views.get_cached_place_details('place0')
+            deadline = time.monotonic() + 5
+            while 'place0' in views.refreshing and time.monotonic() < deadline:
+                time.sleep(0.01)
+        return details
+
+    def test_stale_details_are_served_and_refreshed(self):
+        google = FakeGoogle([])
+        self.assertEqual(self.lookup(google), {'name': 'Old name'})
+        self.assertEqual(google.calls['details'], 1)
+        self.assertEqual(views.get_cached_place_details('place0'), {'name': 'place0', 'rating': 4})
+
+    def test_refresh_runs_off_the_search_pool(self):
+        google = FakeGoogle([])
+        with mock.patch.object(views, 'executor') as search_pool:
+            self.lookup(google)
+        search_pool.submit.assert_not_called()
+        self.assertEqual(google.calls['details'], 1)
+
+    def test_failed_refresh_backs_off(self):
+        google = mock.Mock(**{'get.return_value': FakeResponse({'status': 'UNKNOWN_ERROR'})})
+        self.assertEqual(self.lookup(google), {'name': 'Old name'})
+        self.assertEqual(self.lookup(google), {'name': 'Old name'})
+        self.assertEqual(google.get.call_count, 1)
+        self.assertIsNot(views.refresh_failures.get('place0'), places_cache.MISSING)
+
+
+class SingleFlightTests(PlacesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.flight = singleflight.SingleFlight('flight-tests')
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.calls = 0
+        self.followers_before = self.followers()
+
+    # Lookups so far that waited on another thread's call in this group
+    def followers(self):
+        return singleflight.flight_calls.series.get((('group', 'flight-tests'), ('outcome', 'shared_local')), 0)
+
+    # Upstream call that stays in flight until released, then returns or raises `outcome`
+    def slow_call(self, outcome):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    # flight.do(key, slow_call, outcome) in a thread; its result or exception is appended to the list
+    def call_in_thread(self, key, outcome):
+        results = []
+
+        def run():
+            try:
+                results.append(self.flight.do(key, self.slow_call, outcome))
+            except Exception as error:
+                results.append(error)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return thread, results
+
+    # Start a leader and a follower on the same key, then let the leader's call finish
+    def leader_and_follower(self, outcome):
+        leader, leader_results = self.call_in_thread('key', outcome)
+        self.assertTrue(self.started.wait(5))
+        follower, follower_results = self.call_in_thread('key', outcome)
+        deadline = time.monotonic() + 5
+        while self.followers() == self.followers_before and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.release.set()
+        leader.join(5)
+        follower.join(5)
+        return leader_results, follower_results
+
+    def test_concurrent_lookups_share_one_call(self):
+        leader_results, follower_results = self.leader_and_follower('value')
+        self.assertEqual((leader_results, follower_results, self.calls), (['value'], ['value'], 1))
+        self.assertEqual(self.followers(), self.followers_before + 1)
+
+    def test_failure_reaches_the_followers(self):
+        error = ValueError('upstream failed')
+        leader_results, follower_results = self.leader_and_follower(error)
+        self.assertEqual(self.calls, 1)
+        self.assertIs(leader_results[0], error)
+        self.assertIs(follower_results[0], error)
+
+    def test_failed_key_is_released(self):
+        self.release.set()
+        with self.assertRaises(ValueError):
+            self.flight.do('key', self.slow_call, ValueError('upstream failed'))
+        self.assertEqual(self.flight.in_flight, {})
+        # Neither the in-process future nor the cross-worker lock is left behind, so a retry calls right away
+        started = time.monotonic()
+        self.assertEqual(self.flight.do('key', self.slow_call, 'value'), 'value')
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.calls, 2)
+
+
+    @override_settings(PLACES_FLIGHT_LOCK_TTL=30, PLACES_FLIGHT_POLL_INTERVAL=0.01)
+    def test_stops_waiting_for_another_worker_at_the_deadline(self):
+        # Another worker holds the lock and never publishes its result
+        caches['coordination'].add(self.flight._shared_key('key', 'lock'), 'other-worker', 30)
+        self.release.set()
+        started = time.monotonic()
+        self.assertEqual(self.flight.do('key', self.slow_call, 'value', deadline=started + 0.1), 'value')
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.calls, 1)
+        # The other worker's lock is left to it
+        self.assertEqual(caches['coordination'].get(self.flight._shared_key('key', 'lock')), 'other-worker')
+
+
+# Stands in for the time module inside nightout.ratelimit; sleep() moves the clock instead of waiting
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@override_settings(GOOGLE_QUEUE_WAIT=0, GOOGLE_BACKGROUND_QUEUE_WAIT=0, GOOGLE_BACKGROUND_SHARE=0.5, GOOGLE_DAILY_RESERVE=0.2)
+class RateLimiterTests(PlacesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock(1_700_000_000.25)
+        patcher = mock.patch('nightout.ratelimit.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # How many of `calls` acquires at `level` get budget before the first RateLimited
+    def acquired(self, limiter, calls, level=ratelimit.INTERACTIVE):
+        token = ratelimit.priority.set(level)
+        try:
+            for count in range(calls):
+                try:
+                    limiter.acquire()
+                except ratelimit.RateLimited:
+                    return count
+            return calls
+        finally:
+            ratelimit.priority.reset(token)
+
+    def test_budget_refills_every_second(self):
+        limiter = ratelimit.RateLimiter('limiter-tests', 3)
+        self.assertEqual(self.acquired(limiter, 5), 3)
+        with self.assertRaises(ratelimit.RateLimited) as raised:
+            limiter.acquire()
+        self.assertAlmostEqual(raised.exception.retry_after, 0.75)
+        self.clock.now += 1
+        self.assertEqual(self.acquired(limiter, 5), 3)
+
+    def test_background_calls_get_a_share_of_each_second(self):
+        limiter = ratelimit.RateLimiter('limiter-tests', 4)
+        self.assertEqual(self.acquired(limiter, 4, ratelimit.BACKGROUND), 2)
+        self.assertEqual(self.acquired(limiter, 4), 2)
+
+    def test_background_calls_leave_the_daily_reserve(self):
+        limiter = ratelimit.RateLimiter('limiter-tests', 100, daily_quota=10)
+        self.assertEqual(self.acquired(limiter, 10, ratelimit.BACKGROUND), 8)
+        self.assertEqual(self.acquired(limiter, 10), 2)
+        with self.assertRaises(ratelimit.RateLimited) as raised:
+            limiter.acquire()
+        self.assertEqual(raised.exception.retry_after, ratelimit.quota_day(self.clock.now)[1])  # Until midnight Pacific
+
+    def test_daily_count_outlives_the_default_timeout_on_the_file_cache(self):
+        # The file cache's incr() writes the counter back with the default 300s timeout
+        with tempfile.TemporaryDirectory() as location, self.settings(CACHES={
+            'default': settings.CACHES['default'],
+            'coordination': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location},
+        }):
+            limiter = ratelimit.RateLimiter('limiter-tests', 100, daily_quota=10)
+            self.assertEqual(self.acquired(limiter, 3), 3)
+            with mock.patch('time.time', return_value=time.time() + 3600):
+                self.assertEqual(limiter.remaining_today(), 7)
+
+    def test_calls_over_budget_queue_then_fail(self):
+        limiter = ratelimit.RateLimiter('limiter-tests', 1)
+        limiter.acquire()
+        with self.settings(GOOGLE_QUEUE_WAIT=1):
+            limiter.acquire()  # Waits for the next second
+        self.assertEqual(self.clock.sleeps, [0.75])
+        with self.settings(GOOGLE_QUEUE_WAIT=0.5):
+            with self.assertRaises(ratelimit.RateLimited):
+                limiter.acquire()  # The next second is further off than it may wait
+        self.assertEqual(self.clock.sleeps, [0.75])
+
+    def test_penalty_holds_every_call_back(self):
+        limiter = ratelimit.RateLimiter('limiter-tests', 100)
+        limiter.penalize(2)
+        with self.assertRaises(ratelimit.RateLimited) as raised:
+            limiter.acquire()
+        self.assertEqual(raised.exception.retry_after, 2)
+        self.clock.now += 2
+        self.assertEqual(self.acquired(limiter, 1), 1)
+
+    def test_google_429_starts_the_cooldown(self):
+        # Retrying it in the HTTP layer would only send Google more calls while we're over its limit
+        self.assertNotIn(429, http_client.get_adapter().max_retries.status_forcelist)
+        with mock.patch('nightout.http_client.get', return_value=FakeResponse({}, status_code=429)):
+            with self.assertRaises(ratelimit.RateLimited):
+                views.google_get('google_geocode', 'https://maps.googleapis.com/maps/api/geocode/json', {})
+        with self.assertRaises(ratelimit.RateLimited) as raised:
+            views.places_quota.acquire()
+        self.assertEqual(raised.exception.retry_after, settings.GOOGLE_OVER_LIMIT_COOLDOWN)
+
+
+class PlacePhotoTests(PlacesTestCase):
+
+    reference = 'CmRaAAAA' + 'x' * 40
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(views, 'photo_cache', photos.PhotoCache(directory.name, 1024 * 1024))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Google's answer to the photo request, streamed as a JPEG
+        self.google_photo = mock.MagicMock(status_code=200, headers={'Content-Type': 'image/jpeg'})
+        self.google_photo.__enter__.return_value = self.google_photo
+        self.google_photo.iter_content.return_value = [b'\xff\xd8\xff' + b'jpeg' * 10]
+
+    def get(self, url):
+        with mock.patch('nightout.http_client.get', return_value=self.google_photo) as google:
+            response = self.client.get(url)
+        self.addCleanup(response.close)
+        return response, google.call_count
+
+    def test_photo_urls_from_search_results_are_served(self):
+        url = views.format_place(RequestFactory().get('/'), {'photos': [{'photo_reference': self.reference}]}, 1.0)['photo_url']
+        self.assertTrue(url.startswith(f"http://testserver{reverse('place_photo', args=[self.reference])}?sig="))
+        response, google_calls = self.get(url + '&width=200')
+        self.assertEqual((response.status_code, response['Content-Type'], google_calls), (200, 'image/jpeg', 1))
+        self.assertTrue(response.getvalue().startswith(b'\xff\xd8\xff'))
+
+    def test_search_results_link_photos_absolutely(self):
+        google = FakeGoogle([('place0', 43.3, -70.4, 4.0, 2)])
+        details = FakeResponse({'status': 'OK', 'result': {'name': 'place0', 'photos': [{'photo_reference': self.reference}]}})
+        search = mock.Mock(get=lambda url, params=None, **kwargs: details if 'details' in url else google.get(url, params, **kwargs))
+        photo_url = self.search(search).json()[0]['photo_url']
+        self.assertTrue(photo_url.startswith(f"http://testserver{reverse('place_photo', args=[self.reference])}?sig="))
+
+    def test_unsigned_references_are_refused(self):
+        url = reverse('place_photo', args=[self.reference])
+        forged = f"{url}?sig={photos.sign_reference('CmRaAAAA' + 'y' * 40)}"
+        for attempt in (url, forged, url + '?sig='):
+            response, google_calls = self.get(attempt)
+            self.assertEqual((response.status_code, google_calls), (403, 0))
+
+
+# Google opening_hours with one period per (open day, open time, close day, close time); days from 0 = Sunday
+def opening_hours(*periods):
+    return {'periods': [
+        {'open': {'day': open_day, 'time': opens}, 'close': {'day': close_day, 'time': closes}}
+        for open_day, opens, close_day, closes in periods
+    ]}
+
+
+class ItineraryTests(TestCase):
+
+    saturday_night = datetime(2024, 6, 1, 21, 0)
+
+    def test_distance_matrix(self):
+        distances = itinerary.distance_matrix([0, 0, 0], [0, 1, 2])
+        np.testing.assert_allclose(distances, distances.T)
+        np.testing.assert_allclose(np.diag(distances), 0)
+        np.testing.assert_allclose(distances[0], [0, 69.093, 138.186], atol=0.01)
+
+    def test_opening_windows_wrap_around_the_week(self):
+        # Saturday 20:00 to Sunday 02:00, seen from Sunday 01:00: opened 5 hours ago, closes in one
+        hours = opening_hours((6, '2000', 0, '0200'))
+        self.assertEqual(itinerary.opening_windows(hours, datetime(2024, 6, 2, 1, 0), 720), ([-300], [60]))
+
+    def test_opening_windows_stop_at_the_horizon(self):
+        hours = opening_hours((1, '1800', 1, '2300'))  # Mondays only
+        self.assertEqual(itinerary.opening_windows(hours, self.saturday_night, 720), ([], []))
+        self.assertEqual(itinerary.opening_windows(hours, self.saturday_night, 3 * 1440), ([2700], [3000]))
+        self.assertIsNone(itinerary.opening_windows({'periods': [{'open': {'day': 0, 'time': '0000'}}]}, self.saturday_night, 720))
+        self.assertIsNone(itinerary.opening_windows(None, self.saturday_night, 720))
+
+    def test_visit_start(self):
+        windows = ([-300, 1200], [60, 1500])
+        self.assertEqual(itinerary.visit_start(windows, 0, 30), 0)
+        self.assertEqual(itinerary.visit_start(windows, 0, 90), 1200)  # Too short a visit before closing, so wait for the next opening
+        self.assertEqual(itinerary.visit_start(windows, 1480, 30), None)
+        self.assertEqual(itinerary.visit_start(([], []), 0, 30), None)
+        self.assertEqual(itinerary.visit_start(None, 42, 30), 42)
+
+    def test_two_opt_untangles_the_route(self):
+        distances = itinerary.distance_matrix([0] * 5, [0, 1, 2, 3, 4])
+        travel = (distances / 15 * 60).tolist()
+        route = itinerary.two_opt([1, 3, 2, 4], distances, travel, [None] * 5, 30)
+        self.assertEqual(route, [1, 2, 3, 4])
+
+    def test_two_opt_keeps_a_detour_that_catches_opening_hours(self):
+        # Stop 3 closes 2.5 hours in: the route gets shorter, but stops short of the straight line
+        # [1, 2, 3], which would reach stop 3 too late
+        distances = itinerary.distance_matrix([0] * 4, [0, 0.1, 0.2, 0.3])
+        travel = (distances / 15 * 60).tolist()
+        windows = [None, None, None, ([-60], [150])]
+        route = itinerary.two_opt([3, 1, 2], distances, travel, windows, 30)
+        self.assertEqual(route, [1, 3, 2])
+        self.assertEqual(itinerary.schedule(route, travel, windows, 30)[0], 0)
+
+
+class PlanItineraryTests(PlacesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for place_id, lng, hours in (
+            ('late_bar', -70.39, opening_hours((6, '2000', 0, '0200'))),
+            ('monday_club', -70.38, opening_hours((1, '1800', 1, '2300'))),
+        ):
+            Place.objects.create(
+                place_id=place_id, name=place_id, lat=43.3, lng=lng, geohash=geo.encode(43.3, lng), types=',bar,',
+                details={'opening_hours': hours},
+            )
+
+    def plan(self, **data):
+        data = {'origin': {'lat': 43.3, 'lng': -70.4}, 'place_ids': ['late_bar', 'monday_club'], 'start': '2024-06-01T21:00', **data}
+        return self.client.post(reverse('plan_itinerary'), data, content_type='application/json')
+
+    def test_stop_closed_tonight_is_reported_closed(self):
+        data = self.plan().json()
+        stops = {stop['place_id']: stop for stop in data['stops']}
+        self.assertEqual((stops['late_bar']['open'], stops['monday_club']['open'], data['closed_stops']), (True, False, 1))
+        # Not scheduled for when it opens on Monday
+        self.assertEqual(stops['monday_club']['start'], stops['monday_club']['arrive'])
+        self.assertLess(stops['monday_club']['start'], '2024-06-02T06:00')
+
+    def test_stay_minutes(self):
+        stop = self.plan().json()['stops'][0]
+        self.assertEqual(datetime.fromisoformat(stop['leave']) - datetime.fromisoformat(stop['start']), timedelta(minutes=settings.ITINERARY_STAY_MINUTES))
+        stop = self.plan(stay_minutes=90).json()['stops'][0]
+        self.assertEqual(datetime.fromisoformat(stop['leave']) - datetime.fromisoformat(stop['start']), timedelta(minutes=90))
+        self.assertEqual(self.plan(stay_minutes=0).status_code, 400)
+
+    def test_start_is_required(self):
+        response = self.plan(start=None)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('start is required', response.json()['error'])
+
+
+class GeoTests(TestCase):
+
+    def test_encode(self):
+        self.assertEqual(geo.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(geo.encode(-25.382708, -49.265506, 8), '6gkzwgjz')
+
+    def test_neighbourhood_is_the_cell_and_its_neighbours(self):
+        cells = geo.neighbourhood(43.3, -70.4, 5)
+        self.assertEqual(len(cells), 9)
+        self.assertIn(geo.encode(43.3, -70.4, 5), cells)
+
+    def test_nearby_places_finds_places_across_cell_edges(self):
+        # Latitude 45 is the edge between the top-level cells "drv" and "f2j", which share no prefix
+        for place_id, lat in (('north', 45.001), ('south', 44.999), ('far', 46.0)):
+            Place.objects.create(place_id=place_id, name=place_id, lat=lat, lng=-70.4, geohash=geo.encode(lat, -70.4), types=',bar,')
+        found = set(geo.nearby_places(44.9995, -70.4, 1).values_list('place_id', flat=True))
+        self.assertEqual(found, {'north', 'south'})
+
+    def test_haversine_many(self):
+        # One degree of longitude along the equator, and no distance to the origin itself
+        distances = views.haversine_many(0, 0, [0, 0, 1], [1, 0, 0])
+        np.testing.assert_allclose(distances, [69.093, 0, 69.093], atol=0.01)
+
+
+class RankCandidatesTests(TestCase):
+
+    distances = np.array([3.0, 1.0, 2.0, 9.0])
+    ratings = [4.0, None, 4.5, 5.0]
+    prices = [2, 1, None, 3]
+
+    def test_keeps_incoming_order_without_sort(self):
+        self.assertEqual(views.rank_candidates(self.distances, self.ratings, self.prices).tolist(), [0, 1, 2, 3])
+
+    def test_sorts_with_unknown_values_last(self):
+        self.assertEqual(views.rank_candidates(self.distances, self.ratings, self.prices, sort='distance').tolist(), [1, 2, 0, 3])
+        self.assertEqual(views.rank_candidates(self.distances, self.ratings, self.prices, sort='rating').tolist(), [3, 2, 0, 1])
+        self.assertEqual(views.rank_candidates(self.distances, self.ratings, self.prices, sort='price').tolist(), [1, 0, 3, 2])
+
+    def test_filters_by_distance_and_cuts_to_limit(self):
+        ranked = views.rank_candidates(self.distances, self.ratings, self.prices, sort='rating', max_distance=5, limit=2)
+        self.assertEqual(ranked.tolist(), [2, 0])
+
+
+class RendererTests(TestCase):
+
+    data = {
+        'price': Decimal('12.50'),
+        'label': gettext_lazy('Open now'),
+        'at': datetime(2026, 5, 1, 21, 30, 0, 250000, tzinfo=dt_timezone.utc),
+        'note': 'line\u2028break',
+    }
+
+    def test_renders_what_the_stock_renderer_does(self):
+        # Decimals, lazy strings and datetimes go through the encoder's fallbacks, with either serializer
+        expected = JSONRenderer().render(self.data)
+        for serializer in ('orjson', 'stdlib'):
+            with self.subTest(serializer=serializer), self.settings(JSON_SERIALIZER=serializer):
+                self.assertEqual(FastJSONRenderer().render(self.data), expected)
+
+    def test_indented_output_uses_the_stock_renderer(self):
+        rendered = FastJSONRenderer().render(self.data, 'application/json; indent=2')
+        self.assertEqual(rendered, JSONRenderer().render(self.data, 'application/json; indent=2'))
+        self.assertIn(b'\n  "price"', rendered)
+
+
+class SearchTests(PlacesTestCase):
+
+    places = [(f'place{i}', 43.3 + i / 100, -70.4, 4.0, 2) for i in range(5)]
+
+    def test_details_are_fetched_concurrently(self):
+        # Every lookup waits for all the others, which only works if they run at the same time
+        barrier = threading.Barrier(len(self.places), timeout=5)
+        google = FakeGoogle(self.places, details_hook=lambda place_id: barrier.wait())
+        response = self.search(google)
+        self.assertEqual([place['name'] for place in response.json()], [place_id for place_id, *_ in self.places])
+        self.assertEqual(google.calls['details'], len(self.places))
+
+    def test_slow_details_are_left_out_at_the_deadline(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        google = FakeGoogle(self.places, details_hook=lambda place_id: place_id == 'place2' and release.wait(5))
+        with override_settings(PLACES_SEARCH_TIMEOUT=0.5):
+            response = self.search(google)
+        self.assertEqual([place['name'] for place in response.json()], ['place0', 'place1', 'place3', 'place4'])
+
+    def test_streamed_search_sends_a_line_per_place_then_a_summary(self):
+        response = self.search(FakeGoogle(self.places), stream=True, limit=3)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        *places, summary = response.lines
+        self.assertEqual([(line['index'], line['place']['name']) for line in places], [(0, 'place0'), (1, 'place1'), (2, 'place2')])
+        self.assertEqual(summary, {'done': True, 'count': 3, 'next_cursor': response['X-Next-Cursor']})
+        self.assertTrue(summary['next_cursor'])
+
+    def test_streamed_search_ends_with_the_summary_at_the_deadline(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        google = FakeGoogle(self.places, details_hook=lambda place_id: place_id == 'place2' and release.wait(5))
+        with override_settings(PLACES_SEARCH_TIMEOUT=0.5):
+            response = self.search(google, stream=True)
+        *places, summary = response.lines
+        self.assertEqual(sorted(line['place']['name'] for line in places), ['place0', 'place1', 'place3', 'place4'])
+        self.assertEqual(summary, {'done': True, 'count': 4, 'next_cursor': None})
+
+    def test_repeat_search_uses_cached_geocode_and_details(self):
+        google = FakeGoogle(self.places)
+        self.search(google, max_distance=100)
+        self.search(google, business_type='pub')
+        self.assertEqual((google.calls['geocode'], google.calls['textsearch'], google.calls['details']), (1, 2, len(self.places)))
+
+
+class CategorySearchTests(PlacesTestCase):
+
+    places = {
+        'bar': [('shared', 43.30, -70.4, 4.0, 2), ('bar_only', 43.31, -70.4, 4.0, 2)],
+        'pub': [('shared', 43.30, -70.4, 4.0, 2), ('pub_only', 43.32, -70.4, 4.0, 2)],
+    }
+
+    def test_place_found_by_two_categories_appears_once(self):
+        google = FakeGoogle(self.places)
+        data = self.search(google, business_type=['bar', 'pub']).json()
+        self.assertEqual(
+            [(place['name'], place['categories']) for place in data['places']],
+            [('shared', ['bar', 'pub']), ('bar_only', ['bar']), ('pub_only', ['pub'])],
+        )
+        self.assertEqual(data['categories'], {'bar': [0, 1], 'pub': [0, 2]})
+        self.assertEqual((google.calls['geocode'], google.calls['textsearch'], google.calls['details']), (1, 2, 3))
+
+    # FakeGoogle whose text searches for the given categories fail to connect
+    def failing(self, *business_types):
+        google = FakeGoogle(self.places)
+
+        def get(url, params=None, **kwargs):
+            if params.get('query', '').split(' in ')[0] in business_types:
+                raise requests.ConnectionError('connection reset')
+            return google.get(url, params, **kwargs)
+
+        return mock.Mock(get=get)
+
+    def test_failed_category_leaves_partial_results(self):
+        response = self.search(self.failing('pub'), business_type=['bar', 'pub'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([place['name'] for place in response.json()['places']], ['shared', 'bar_only'])
+        self.assertEqual(response.json()['categories'], {'bar': [0, 1]})
+
+    def test_every_category_failing_is_a_bad_gateway(self):
+        response = self.search(self.failing('bar', 'pub'), business_type=['bar', 'pub'])
+        self.assertEqual(response.status_code, 502)
+
+    def test_malformed_business_type_list_is_rejected(self):
+        for business_types in (['bar', 3], ['bar', ''], [], ['bar', ['pub']]):
+            with self.subTest(business_types=business_types):
+                response = self.search(FakeGoogle(self.places), business_type=business_types)
+                self.assertEqual(response.status_code, 400)
@@ -1,6 +1,8 @@
 from django.urls import path
-from .views import search_businesses
+from .views import place_photo, plan_itinerary, search_businesses
 
 urlpatterns = [
     path('search/', search_businesses, name='search_businesses'),
+    path('photos/<str:reference>/', place_photo, name='place_photo'),
+    path('itinerary/', plan_itinerary, name='plan_itinerary'),
 ]
@@ -2,124 +2,915 @@
 # Business Search must be done with POST and needs 'location' and 'business-type' parameters
 # Example: curl -X POST http://localhost:8000/api/search/ -H "Content-Type: application/json" -d '{"location":"Kennebunkport, ME", "business-type":"restaurant"}'
 # Returns JSON with business name, address, rating, phone number, opening hours, and a photo url that can be displayed on front end
+# Streaming: add "stream": true (or send Accept: application/x-ndjson) to get one JSON line per place as soon as its details arrive,
+# e.g. {"index": 3, "place": {...}}, followed by a final {"done": true, "count": 10, "next_cursor": "..."} line
+# Pagination: when more results are available the response carries an X-Next-Cursor header; POST {"cursor": "<value>"}
+# (plus any max_distance/sort/limit) to get the next page
+# Several categories: send "business_types": ["bar", "night_club"] to get {"places": [...], "categories": {"bar": [0, 2], ...}},
+# one merged list (each place tagged with the categories that found it, 'limit' per category) and each category's positions in it
+# Photos: photo_url points at GET /api/photos/<photo_reference>/?sig=<signature> (optionally &width=200), which serves the
+# photo from our own cache - the Google API key never reaches the client, and only references we signed are fetched
+# Itinerary: POST /api/itinerary/ with {"location": "Kennebunkport, ME" (or "origin": {"lat": .., "lng": ..}), "place_ids": [...],
+# "start": "2024-06-01T20:00", "stay_minutes": 60} to get the places of earlier searches in a good visiting order, with their times.
+# "start" is required and read on the places' local clock; "stay_minutes" is optional
 
-import requests
 from django.conf import settings
-from rest_framework.decorators import api_view
+from nightout import http_client, metrics, ratelimit
+from nightout.ratelimit import RateLimited, RateLimiter
+from .cache import TieredCache, MISSING, normalize_location
+from .singleflight import SingleFlight
+from .itinerary import opening_windows, plan_route
+from .photos import PhotoCache, PhotoTooLarge, REFERENCE_PATTERN, photo_width, sign_reference, signature_valid, sniff_content_type
+from .geo import encode as geohash_encode, nearby_places
+from .models import Place
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control, quote_etag
+from nightout.fast_json import dumps
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
+import uuid
+from django.views.decorators.http import require_http_methods
+from django.utils import timezone
+from datetime import datetime, timedelta
+from rest_framework.decorators import api_view, renderer_classes
+from rest_framework.settings import api_settings
+from .renderers import NDJSONRenderer
 from rest_framework.response import Response
-import math # Imported math for haversine formula to calculate distance from origin to each place
+import math
+import numpy as np # Vectorized haversine and ranking over many candidate places
+import threading
+import time
+from concurrent.futures import Future, as_completed, TimeoutError as FutureTimeout
+import requests
+
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+TEXT_SEARCH_URL = "https://maps.googleapis.com/maps/api/place/textsearch/json"
+DETAILS_URL = "https://maps.googleapis.com/maps/api/place/details/json"
+PHOTO_URL = "https://maps.googleapis.com/maps/api/place/photo"
+DETAILS_FIELDS = 'name,formatted_address,rating,formatted_phone_number,opening_hours,photos,price_level'
+
+# Shared worker pool for outbound Google calls, so the geocode/textsearch pair and the
+# Place Details lookups of a search run concurrently instead of one after another.
+# Tasks run in the submitting request's context, so their calls count against it (nightout/metrics.py)
+executor = metrics.ContextThreadPoolExecutor(max_workers=settings.PLACES_MAX_WORKERS, thread_name_prefix='places')
+
+# Small separate pool for background refreshes and prefetches, so they never hold up a search
+background_executor = metrics.ContextThreadPoolExecutor(max_workers=settings.PLACES_BACKGROUND_WORKERS, thread_name_prefix='places-background')
+
+# Geocode results keyed by normalized location string; (None, None) marks a location Google couldn't find
+geocode_cache = TieredCache('geocode', settings.GEOCODE_CACHE_SIZE, settings.GEOCODE_CACHE_TTL)
+
+# Geocoding statuses that mean the address itself is bad, so the failure is safe to cache.
+# Quota and server errors (OVER_QUERY_LIMIT, UNKNOWN_ERROR, ...) are not cached.
+GEOCODE_NEGATIVE_STATUSES = ('ZERO_RESULTS', 'INVALID_REQUEST')
+
+# Place Details keyed by place_id. Entries are fresh for PLACES_DETAILS_TTL seconds, then served
+# stale for up to PLACES_DETAILS_STALE_TTL more while a background refresh runs.
+details_cache = TieredCache(
+    'place_details',
+    settings.PLACES_DETAILS_CACHE_SIZE,
+    settings.PLACES_DETAILS_TTL + settings.PLACES_DETAILS_STALE_TTL,
+)
+
+# Budget for Places/Geocoding calls, shared by every worker
+places_quota = RateLimiter('google_places', settings.GOOGLE_PLACES_QPS, settings.GOOGLE_PLACES_DAILY_QUOTA)
+
+# Identical geocode, text search and details lookups made at the same time share one Google call
+geocode_flight = SingleFlight('geocode')
+text_search_flight = SingleFlight('text_search')
+details_flight = SingleFlight('place_details')
+photo_flight = SingleFlight('place_photo')
+
+# Photos fetched from Google, on disk; references Google couldn't serve are remembered for a while
+photo_cache = PhotoCache(settings.PHOTO_CACHE_DIR, settings.PHOTO_CACHE_MAX_BYTES)
+missing_photos = TieredCache('missing_photos', 1024, settings.PHOTO_NEGATIVE_TTL)
+
+# place_ids with a background refresh in flight, so a stale entry is only refreshed once
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+# place_ids whose last background refresh failed (Google error or non-OK status), so searches
+# showing the stale entry don't start another refresh for it until the backoff has passed
+refresh_failures = TieredCache('details_refresh_failures', 1024, settings.PLACES_DETAILS_REFRESH_BACKOFF)
+
+# GET a Google Maps endpoint through the shared rate limiter and return its JSON.
+# Raises RateLimited when there is no budget left, or when Google itself says we're over
+# its limit - then every worker holds its calls back for a moment.
+def google_get(service, url, params):
+    places_quota.acquire()
+    with metrics.external_call(service):
+        response = http_client.get(url, params=params, timeout=settings.PLACES_REQUEST_TIMEOUT)
+    data = {'status': 'OVER_QUERY_LIMIT'} if response.status_code == 429 else response.json()
+    if data.get('status') == 'OVER_QUERY_LIMIT':
+        places_quota.penalize(settings.GOOGLE_OVER_LIMIT_COOLDOWN)
+        raise RateLimited(places_quota.name, settings.GOOGLE_OVER_LIMIT_COOLDOWN)
+    return data
 
 # Retrieve the lat and longitude from a location
 # Needed to retrieve from the user's original search location
-def get_geocode(location):
-    geocode_url = "https://maps.googleapis.com/maps/api/geocode/json"
+def get_geocode(location, deadline=None):
+    key = normalize_location(location)
+    cached = geocode_cache.get(key)
+    if cached is not MISSING:
+        return cached
+    return geocode_flight.do(key, fetch_geocode, location, key, deadline=deadline)
+
+# Geocode lookup at Google, stored in the geocode cache under the normalized key
+def fetch_geocode(location, key):
     geocode_params = {
         'address': location,
         'key': settings.GOOGLE_PLACES_API_KEY,
     }
 
-    geocode_response = requests.get(geocode_url, params=geocode_params)
-    geocode_data = geocode_response.json()
+    geocode_data = google_get('google_geocode', GEOCODE_URL, geocode_params)
 
     if geocode_data['status'] == 'OK':
         geometry = geocode_data['results'][0]['geometry']['location']
-        return geometry['lat'], geometry['lng']
+        coordinates = (geometry['lat'], geometry['lng'])
+        geocode_cache.set(key, coordinates)
+        return coordinates
     else:
+        if geocode_data['status'] in GEOCODE_NEGATIVE_STATUSES:
+            geocode_cache.set(key, (None, None), settings.GEOCODE_NEGATIVE_TTL)
         return None, None
 
-# Haversine formula - used to calculate distance from origin to each place
-def haversine(lat1, lon1, lat2, lon2):
-    # Radius of the Earth in km
-    R = 6371.0
-    # Convert latitude and longitude from degrees to radians
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
-    
-    # Differences in coordinates
+# Geocode from the cache only, MISSING if the location hasn't been looked up yet
+def get_cached_geocode(location):
+    return geocode_cache.get(normalize_location(location))
+
+# Google Places text search - returns one page of results in Google's ranking order, plus the
+# next_page_token if Google has more. A fresh next_page_token takes a moment to become valid,
+# so a page request that comes back INVALID_REQUEST is retried after a short delay.
+def text_search(query, page_token=None, deadline=None):
+    key = f'page:{page_token}' if page_token else f'query:{query}'
+    return text_search_flight.do(key, fetch_text_search, query, page_token, deadline=deadline)
+
+def fetch_text_search(query, page_token):
+    params = {
+        'query': query,
+        'key': settings.GOOGLE_PLACES_API_KEY,
+    }
+    if page_token:
+        params = {'pagetoken': page_token, 'key': settings.GOOGLE_PLACES_API_KEY}
+    attempts = settings.PLACES_PAGE_TOKEN_ATTEMPTS if page_token else 1
+    for attempt in range(attempts):
+        data = google_get('google_textsearch', TEXT_SEARCH_URL, params)
+        if data.get('status') != 'INVALID_REQUEST' or attempt == attempts - 1:
+            break
+        time.sleep(settings.PLACES_PAGE_TOKEN_DELAY)
+    return {'results': data.get('results', []), 'next_page_token': data.get('next_page_token')}
+
+# Place Details lookup for a single place_id, stored in the details cache
+def get_place_details(place_id, deadline=None):
+    return details_flight.do(place_id, fetch_place_details, place_id, deadline=deadline)
+
+def fetch_place_details(place_id):
+    details_params = {
+        'place_id': place_id,
+        'fields': DETAILS_FIELDS,
+        'key': settings.GOOGLE_PLACES_API_KEY,
+    }
+    details_json = google_get('google_details', DETAILS_URL, details_params)
+    details_data = details_json.get('result', {})
+    if details_json.get('status') == 'OK':
+        details_cache.set(place_id, {
+            'fields': DETAILS_FIELDS,
+            'fetched_at': time.time(),
+            'data': details_data,
+        })
+    return details_data
+
+# Whether a details cache entry (or MISSING) is past PLACES_DETAILS_TTL
+def details_stale(entry):
+    return entry is MISSING or time.time() - entry['fetched_at'] > settings.PLACES_DETAILS_TTL
+
+# Re-fetch a stale details entry in the background
+def refresh_place_details(place_id):
+    try:
+        with ratelimit.background():
+            get_place_details(place_id)
+    finally:
+        # Only an OK answer replaces the entry; anything else backs off instead of retrying on every search
+        if details_stale(details_cache.get(place_id)):
+            refresh_failures.set(place_id, True)
+        with refreshing_lock:
+            refreshing.discard(place_id)
+
+# Cached Place Details for a place_id, or MISSING if it has to be fetched
+# A stale entry is still returned, and a background refresh is started for it
+def get_cached_place_details(place_id):
+    entry = details_cache.get(place_id)
+    if entry is MISSING:
+        return MISSING
+    # Entries fetched with a different field list (e.g. after DETAILS_FIELDS changed) can't be used
+    if not set(DETAILS_FIELDS.split(',')) <= set(entry['fields'].split(',')):
+        details_cache.delete(place_id)
+        return MISSING
+    if details_stale(entry) and refresh_failures.get(place_id) is MISSING:
+        with refreshing_lock:
+            start_refresh = place_id not in refreshing
+            refreshing.add(place_id)
+        if start_refresh:
+            background_executor.submit(refresh_place_details, place_id)
+    return entry['data']
+
+# Build the response entry for one place from its details
+def format_place(request, details_data, distance):
+    # Get the photo_reference from the photos array
+    photo_reference = None
+    if 'photos' in details_data and len(details_data['photos']) > 0:
+        photo_reference = details_data['photos'][0].get('photo_reference')
+
+    # If a photo_reference is found, link to it through our photo cache, signed so the link can't be forged
+    # The link is absolute, so clients can load it as they did the Google URL it replaces
+    photo_url = None
+    if photo_reference:
+        photo_url = request.build_absolute_uri(f"{reverse('place_photo', args=[photo_reference])}?sig={sign_reference(photo_reference)}")
+
+    return {
+        'name': details_data.get('name'),
+        'address': details_data.get('formatted_address'),
+        'rating': details_data.get('rating'),
+        'phone_number': details_data.get('formatted_phone_number'),
+        'opening_hours': details_data.get('opening_hours', {}).get('weekday_text'),
+        'photo_url': photo_url,  # Include the photo URL
+        'price_level': details_data.get('price_level'), # Price level goes from 0 to 4, 0 being free and 4 being most expensive
+        'distance': distance, # Distance in miles
+    }
+
+# Time left (in seconds) before the search deadline, never negative
+def remaining(deadline):
+    return max(0.0, deadline - time.monotonic())
+
+# State of a paginated search, keyed by the cursor handed to the client. Google's page token never
+# leaves the server: {'query', 'business_type', 'origin', 'results' (not yet returned), 'page_token'}
+cursor_cache = TieredCache('search_cursors', settings.PLACES_CURSOR_CACHE_SIZE, settings.PLACES_CURSOR_TTL)
+
+# In-flight prefetches in this worker, by cursor
+prefetching = {}
+prefetching_lock = threading.Lock()
+
+# Store the rest of a search under a new cursor and start prefetching it; None if there is nothing left
+def save_cursor(query, business_type, origin, results, page_token, limit):
+    if not results and not page_token:
+        return None
+    cursor = uuid.uuid4().hex
+    cursor_cache.set(cursor, {
+        'query': query,
+        'business_type': business_type,
+        'origin': origin,
+        'results': results,
+        'page_token': page_token,
+    })
+    with prefetching_lock:
+        prefetching[cursor] = background_executor.submit(prefetch_page, cursor, limit)
+    return cursor
+
+# Background work for "load more": pull the next Google page if the leftover results won't fill
+# a page, and warm the details cache for the places the next page will most likely show
+def prefetch_page(cursor, limit):
+    try:
+        with ratelimit.background():
+            state = cursor_cache.get(cursor)
+            if state is MISSING:
+                return
+            if len(state['results']) < limit and state['page_token']:
+                page = text_search(state['query'], state['page_token'])
+                state = dict(state, results=state['results'] + page['results'], page_token=page['next_page_token'])
+                cursor_cache.set(cursor, state)
+            for result in state['results'][:limit]:
+                if result.get('place_id') and get_cached_place_details(result['place_id']) is MISSING:
+                    get_place_details(result['place_id'])
+    finally:
+        with prefetching_lock:
+            prefetching.pop(cursor, None)
+
+# Vectorized haversine - distances in miles from one origin to arrays of coordinates
+def haversine_many(lat, lng, lats, lngs):
+    lat1_rad = np.radians(lat)
+    lat2_rad = np.radians(np.asarray(lats, dtype=float))
     dlat = lat2_rad - lat1_rad
-    dlon = lon2_rad - lon1_rad
-    
-    # Haversine formula
-    a = math.sin(dlat / 2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    
-    # Distance in km
-    distance_km = R * c
+    dlon = np.radians(np.asarray(lngs, dtype=float)) - np.radians(lng)
+
+    a = np.sin(dlat / 2)**2 + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(dlon / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return 6371.0 * c * 0.621371
+
+SORT_OPTIONS = ('distance', 'rating', 'price')
+
+# Read and validate the optional max_distance, sort and limit search parameters
+# Returns (options, error message)
+def parse_search_options(data):
+    options = {'max_distance': None, 'sort': None, 'limit': 10}
+    try:
+        if data.get('max_distance') not in (None, ''):
+            options['max_distance'] = float(data.get('max_distance'))
+            if options['max_distance'] <= 0:
+                return None, 'max_distance must be positive'
+        if data.get('limit') not in (None, ''):
+            options['limit'] = int(data.get('limit'))
+            if not 1 <= options['limit'] <= settings.PLACES_MAX_LIMIT:
+                return None, f'limit must be between 1 and {settings.PLACES_MAX_LIMIT}'
+    except (TypeError, ValueError):
+        return None, 'max_distance and limit must be numbers'
+    if data.get('sort') not in (None, ''):
+        if data.get('sort') not in SORT_OPTIONS:
+            return None, f"sort must be one of {', '.join(SORT_OPTIONS)}"
+        options['sort'] = data.get('sort')
+    return options, None
+
+# Indices of the candidates to return: drop those beyond max_distance, order by sort
+# (distance ascending, rating descending, price ascending; unknown values last) and cut to limit.
+# Without a sort the candidates keep their incoming order.
+def rank_candidates(distances, ratings, price_levels, sort=None, max_distance=None, limit=10):
+    indices = np.arange(len(distances))
+    if max_distance is not None:
+        indices = indices[distances <= max_distance]
+    key = None
+    if sort == 'distance':
+        key = distances[indices]
+    elif sort == 'rating':
+        key = -np.array(ratings, dtype=float)[indices]
+    elif sort == 'price':
+        key = np.array(price_levels, dtype=float)[indices]
+    if key is not None:
+        key = np.where(np.isnan(key), np.inf, key)
+        indices = indices[np.argsort(key, kind='stable')]
+    return indices[:limit]
+
+# Business type as stored in Place.types, e.g. "Night Club" -> "night_club"
+def normalize_type(business_type):
+    return '_'.join((business_type or '').lower().split())
+
+# Stored places of this business type within radius_miles of the origin, with their distances
+# Only places refreshed within PLACES_LOCAL_MAX_AGE are used
+def find_local_places(origin_lat, origin_lng, business_type, radius_miles):
+    business_type = normalize_type(business_type)
+    if not business_type:
+        return [], np.empty(0)
+    fresh_since = timezone.now() - timedelta(seconds=settings.PLACES_LOCAL_MAX_AGE)
+    candidates = list(nearby_places(
+        origin_lat, origin_lng, radius_miles / 0.621371,
+        Place.objects.filter(types__contains=f",{business_type},", updated_at__gte=fresh_since),
+    ))
+    distances = haversine_many(origin_lat, origin_lng, [place.lat for place in candidates], [place.lng for place in candidates])
+    inside = np.flatnonzero(distances <= radius_miles)
+    return [candidates[i] for i in inside], distances[inside]
+
+# Store the places of a Google search (with their details) so later searches can be answered locally
+def save_places(top_results, details_by_place_id, business_type):
+    # Keep the types a place was already stored under, e.g. a bar that was also found as a restaurant
+    existing_types = dict(Place.objects.filter(place_id__in=list(details_by_place_id)).values_list('place_id', 'types'))
+    places = []
+    for result in top_results:
+        place_id = result.get('place_id')
+        details_data = details_by_place_id.get(place_id)
+        place_location = result.get('geometry', {}).get('location', {})
+        if not details_data or place_location.get('lat') is None or place_location.get('lng') is None:
+            continue
+        types = set(result.get('types', [])) | set(filter(None, existing_types.get(place_id, '').split(',')))
+        if normalize_type(business_type):
+            types.add(normalize_type(business_type))
+        places.append(Place(
+            place_id=place_id,
+            name=details_data.get('name') or result.get('name') or '',
+            lat=place_location['lat'],
+            lng=place_location['lng'],
+            geohash=geohash_encode(place_location['lat'], place_location['lng']),
+            types=f",{','.join(sorted(types))},",
+            rating=details_data.get('rating'),
+            price_level=details_data.get('price_level'),
+            details=details_data,
+        ))
+    # One upsert for the whole search
+    Place.objects.bulk_create(
+        places,
+        update_conflicts=True,
+        unique_fields=['place_id'],
+        update_fields=['name', 'lat', 'lng', 'geohash', 'types', 'rating', 'price_level', 'details', 'updated_at'],
+    )
+
+# Yield (position, place_id, details, distance) as each place's details become available:
+# cached details straight away, fetched ones in completion order until the deadline.
+# Lookups still running at the deadline are dropped, so callers get partial results.
+def resolve_details(pending, deadline):
+    futures = {}
+    for position, (place_id, details, distance) in enumerate(pending):
+        if isinstance(details, Future):
+            futures[details] = (position, place_id, distance)
+        else:
+            yield position, place_id, details, distance
+    try:
+        for future in as_completed(futures, timeout=remaining(deadline)):
+            if future.exception() is not None:
+                continue
+            position, place_id, distance = futures[future]
+            yield position, place_id, future.result(), distance
+    except FutureTimeout:
+        for future in futures:
+            future.cancel()
 
-    # Distance in mi
-    distance_miles = distance_km * 0.621371
+# Response entry for the place at `position` in a search's pending list
+def format_pending(request, position, details_data, distance):
+    return format_place(request, details_data, distance)
 
-    return distance_miles
+# NDJSON lines for a streamed search, one per place as it resolves, then a summary line
+def stream_search(request, pending, deadline, on_complete=None, next_cursor=None, format_entry=format_pending):
+    details_by_place_id = {}
+    for position, place_id, details, distance in resolve_details(pending, deadline):
+        details_by_place_id[place_id] = details
+        yield dumps({'index': position, 'place': format_entry(request, position, details, distance)}) + b'\n'
+    if on_complete is not None:
+        on_complete(details_by_place_id)
+    yield dumps({'done': True, 'count': len(details_by_place_id), 'next_cursor': next_cursor}) + b'\n'
+
+# Under ASGI Django buffers sync iterators completely, so step through the generator from a
+# worker thread and hand each line to the event loop as soon as it's produced
+async def stream_search_async(lines):
+    done = object()
+    while True:
+        line = await sync_to_async(next)(lines, done)
+        if line is done:
+            break
+        yield line
+
+# Client asked for a streamed (NDJSON) response
+def wants_stream(request):
+    return request.data.get('stream') in (True, 'true', '1') or 'application/x-ndjson' in request.headers.get('Accept', '')
+
+# 503 for a search that ran out of Google budget, telling the client when to try again
+def rate_limited_response(error):
+    response = Response({'error': 'Too many searches right now, please try again shortly'}, status=503)
+    response['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
+
+# Response for a search whose places are listed in `pending` as (place_id, details or Future, distance).
+# on_complete gets {place_id: details} of every resolved place once all are in.
+def search_response(request, pending, deadline, on_complete=None, next_cursor=None, format_entry=format_pending):
+    if wants_stream(request):
+        lines = stream_search(request, pending, deadline, on_complete, next_cursor, format_entry)
+        if isinstance(request._request, ASGIRequest):
+            lines = stream_search_async(lines)
+        response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+        response['X-Accel-Buffering'] = 'no'  # Don't let a proxy hold lines back
+        if next_cursor:
+            response['X-Next-Cursor'] = next_cursor
+        return response
+
+    # Keep the original order and return partial results if some lookups were too slow
+    resolved = sorted(resolve_details(pending, deadline), key=lambda item: item[0])
+    if on_complete is not None:
+        on_complete({place_id: details for _, place_id, details, _ in resolved})
+    response = Response([format_entry(request, position, details, distance) for position, _, details, distance in resolved])
+    if next_cursor:
+        response['X-Next-Cursor'] = next_cursor
+    return response
 
 @api_view(['POST'])
+@renderer_classes(api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer])
 def search_businesses(request):
     location = request.data.get('location')
     business_type = request.data.get('business_type')
+    options, error = parse_search_options(request.data)
+    if error:
+        return Response({'error': error}, status=400)
+
+    # Every upstream call of this search has to finish before this deadline
+    deadline = time.monotonic() + settings.PLACES_SEARCH_TIMEOUT
 
-    # Get the coordinates of the original search location
-    origin_lat, origin_lng = get_geocode(location)
+    if request.data.get('cursor'):
+        return next_page(request, request.data.get('cursor'), options, deadline)
+
+    # Several business types at once, as "business_types": [...] or a list in "business_type"
+    business_types = request.data.get('business_types')
+    if business_types is None and isinstance(business_type, list):
+        business_types = business_type
+    if business_types is not None:
+        return search_categories(request, location, business_types, options, deadline)
+
+    query = f"{business_type} in {location}"
+    search_future = None
+    origin = get_cached_geocode(location)
+    if origin is MISSING:
+        # Geocode the original search location and run the text search at the same time
+        geocode_future = executor.submit(get_geocode, location, deadline)
+        search_future = executor.submit(text_search, query, None, deadline)
+        try:
+            origin = geocode_future.result(timeout=remaining(deadline))
+        except FutureTimeout:
+            search_future.cancel()
+            return Response({'error': 'Location lookup timed out'}, status=504)
+        except RateLimited as error:
+            search_future.cancel()
+            return rate_limited_response(error)
+
+    origin_lat, origin_lng = origin
     if origin_lat is None or origin_lng is None:
+        if search_future is not None:
+            search_future.cancel()
         return Response({'error': 'Invalid location'}, status=400)
 
-    # Google Places API endpoint for text search
-    google_places_url = "https://maps.googleapis.com/maps/api/place/textsearch/json"
+    # Answer from stored places when the area is already well covered (nearest first unless sorted otherwise)
+    radius = options['max_distance'] or settings.PLACES_LOCAL_RADIUS_MILES
+    local, local_distances = find_local_places(origin_lat, origin_lng, business_type, radius)
+    if len(local) >= min(options['limit'], settings.PLACES_LOCAL_MIN_RESULTS):
+        if search_future is not None:
+            search_future.cancel()
+        chosen = rank_candidates(
+            local_distances,
+            [place.rating for place in local],
+            [place.price_level for place in local],
+            sort=options['sort'] or 'distance',
+            limit=options['limit'],
+        )
+        return search_response(request, [(local[i].place_id, local[i].details, float(local_distances[i])) for i in chosen], deadline)
+
+    # Not enough local data - fill the gap from Google
+    if search_future is None:
+        search_future = executor.submit(text_search, query, None, deadline)
+
+    try:
+        page = search_future.result(timeout=remaining(deadline))
+    except FutureTimeout:
+        return Response({'error': 'Place search timed out'}, status=504)
+    except RateLimited as error:
+        return rate_limited_response(error)
+
+    return google_page_response(request, query, business_type, origin, page['results'], page['next_page_token'], options, deadline)
+
+# "Load more" for a paginated search, served from the prefetched cursor state when it's ready
+def next_page(request, cursor, options, deadline):
+    with prefetching_lock:
+        prefetch = prefetching.get(cursor)
+    if prefetch is not None:
+        # A prefetch for this cursor is running in this worker - use it rather than asking Google again
+        try:
+            prefetch.result(timeout=remaining(deadline))
+        except Exception:
+            pass
+
+    state = cursor_cache.get(cursor)
+    if state is MISSING:
+        return Response({'error': 'Invalid or expired cursor'}, status=400)
+
+    results, page_token = state['results'], state['page_token']
+    if len(results) < options['limit'] and page_token:
+        try:
+            page = executor.submit(text_search, state['query'], page_token, deadline).result(timeout=remaining(deadline))
+        except FutureTimeout:
+            return Response({'error': 'Place search timed out'}, status=504)
+        except RateLimited as error:
+            return rate_limited_response(error)
+        results, page_token = results + page['results'], page['next_page_token']
+
+    return google_page_response(
+        request, state['query'], state['business_type'], tuple(state['origin']), results, page_token, options, deadline,
+    )
+
+# Rank a window of Google text search results, fetch details for the chosen ones and respond;
+# results that weren't returned and the next page token are kept behind a new cursor
+def google_page_response(request, query, business_type, origin, search_results, page_token, options, deadline):
+    candidates, distances, chosen = rank_search_results(search_results, origin, options)
+    top_results = [candidates[i] for i in chosen]
+
+    # Results within range that didn't make this page wait for the next one
+    returned = set(chosen.tolist())
+    leftover = [
+        candidates[i] for i in range(len(candidates))
+        if i not in returned and (options['max_distance'] is None or distances[i] <= options['max_distance'])
+    ]
+    next_cursor = save_cursor(query, business_type, origin, leftover, page_token, options['limit'])
+
+    # Perform a Place Details search for each place not already cached, all in parallel
+    pending = [(result['place_id'], details_or_lookup(result['place_id'], deadline), float(distances[i])) for result, i in zip(top_results, chosen)]
+
+    return search_response(
+        request, pending, deadline,
+        on_complete=lambda details_by_place_id: save_places(top_results, details_by_place_id, business_type),
+        next_cursor=next_cursor,
+    )
+
+# Cached details of a place, or a Future for the lookup that was started for it
+def details_or_lookup(place_id, deadline):
+    details = get_cached_place_details(place_id)
+    if details is MISSING:
+        details = executor.submit(get_place_details, place_id, deadline)
+    return details
+
+# Google text search results we can place on the map, their distances from the origin, and the
+# indices of those to return after filtering, sorting and cutting them - before fetching any details
+def rank_search_results(search_results, origin, options):
+    origin_lat, origin_lng = origin
+    candidates = [
+        result for result in search_results
+        if result.get('place_id')
+        and result.get('geometry', {}).get('location', {}).get('lat') is not None
+        and result.get('geometry', {}).get('location', {}).get('lng') is not None
+    ]
+    # Calculate distance from the original search location for every candidate at once
+    distances = haversine_many(
+        origin_lat, origin_lng,
+        [result['geometry']['location']['lat'] for result in candidates],
+        [result['geometry']['location']['lng'] for result in candidates],
+    )
+    chosen = rank_candidates(
+        distances,
+        [result.get('rating') for result in candidates],
+        [result.get('price_level') for result in candidates],
+        sort=options['sort'],
+        max_distance=options['max_distance'],
+        limit=options['limit'],
+    )
+    return candidates, distances, chosen
+
+# Search several business types in one request, e.g. ["bar", "night_club"]: the location is geocoded
+# once, the category searches run concurrently, and a place found under several categories gets one
+# details lookup and one entry. 'limit' applies per category; the merged list is ordered by 'sort'
+# (nearest first by default). There is no cursor - page through a single category instead.
+def search_categories(request, location, business_types, options, deadline):
+    if not isinstance(business_types, list) or not all(isinstance(business_type, str) and normalize_type(business_type) for business_type in business_types):
+        return Response({'error': 'business_types must be a list of business types'}, status=400)
+    # "Night Club" and "night club" are the same search
+    categories = {}
+    for business_type in business_types:
+        categories.setdefault(normalize_type(business_type), business_type)
+    categories = list(categories.values())
+    if not 1 <= len(categories) <= settings.PLACES_MAX_CATEGORIES:
+        return Response({'error': f'business_types must have between 1 and {settings.PLACES_MAX_CATEGORIES} entries'}, status=400)
+
+    queries = {business_type: f"{business_type} in {location}" for business_type in categories}
+    search_futures = {}
+    origin = get_cached_geocode(location)
+    if origin is MISSING:
+        # Geocode once while every category's text search runs
+        geocode_future = executor.submit(get_geocode, location, deadline)
+        search_futures = {business_type: executor.submit(text_search, query, None, deadline) for business_type, query in queries.items()}
+        try:
+            origin = geocode_future.result(timeout=remaining(deadline))
+        except FutureTimeout:
+            cancel_all(search_futures.values())
+            return Response({'error': 'Location lookup timed out'}, status=504)
+        except RateLimited as error:
+            cancel_all(search_futures.values())
+            return rate_limited_response(error)
 
-    # Parameters for the text search request
+    origin_lat, origin_lng = origin
+    if origin_lat is None or origin_lng is None:
+        cancel_all(search_futures.values())
+        return Response({'error': 'Invalid location'}, status=400)
+
+    # Places chosen for each category: (place_id, details or None, distance, rating, price_level, Google result or None)
+    found = {}
+    radius = options['max_distance'] or settings.PLACES_LOCAL_RADIUS_MILES
+    for business_type in categories:
+        local, local_distances = find_local_places(origin_lat, origin_lng, business_type, radius)
+        if len(local) >= min(options['limit'], settings.PLACES_LOCAL_MIN_RESULTS):
+            if business_type in search_futures:
+                search_futures.pop(business_type).cancel()
+            chosen = rank_candidates(
+                local_distances,
+                [place.rating for place in local],
+                [place.price_level for place in local],
+                sort=options['sort'] or 'distance',
+                limit=options['limit'],
+            )
+            found[business_type] = [
+                (local[i].place_id, local[i].details, float(local_distances[i]), local[i].rating, local[i].price_level, None)
+                for i in chosen
+            ]
+        elif business_type not in search_futures:
+            search_futures[business_type] = executor.submit(text_search, queries[business_type], None, deadline)
+
+    # Categories whose search timed out, ran out of budget or failed are left out of the answer
+    rate_limited = None
+    failed = False
+    for business_type, future in search_futures.items():
+        try:
+            page = future.result(timeout=remaining(deadline))
+        except FutureTimeout:
+            future.cancel()
+            continue
+        except RateLimited as error:
+            rate_limited = error
+            continue
+        except requests.RequestException:
+            failed = True
+            continue
+        candidates, distances, chosen = rank_search_results(page['results'], origin, options)
+        found[business_type] = [
+            (candidates[i]['place_id'], None, float(distances[i]), candidates[i].get('rating'), candidates[i].get('price_level'), candidates[i])
+            for i in chosen
+        ]
+    if not found:
+        if rate_limited is not None:
+            return rate_limited_response(rate_limited)
+        if failed:
+            return Response({'error': 'Place search failed'}, status=502)
+        return Response({'error': 'Place search timed out'}, status=504)
+    categories = [business_type for business_type in categories if business_type in found]
+
+    # One entry per place, with every category that found it
+    places = {}
+    for business_type in categories:
+        for place_id, details, distance, rating, price_level, result in found[business_type]:
+            place = places.setdefault(place_id, {
+                'details': details, 'distance': distance, 'rating': rating, 'price_level': price_level, 'categories': [],
+            })
+            place['categories'].append(business_type)
+    place_ids = list(places)
+    order = rank_candidates(
+        np.array([places[place_id]['distance'] for place_id in place_ids]),
+        [places[place_id]['rating'] for place_id in place_ids],
+        [places[place_id]['price_level'] for place_id in place_ids],
+        sort=options['sort'] or 'distance',
+        limit=len(place_ids),
+    )
+
+    # Stored places come with their details; Google ones are looked up once each, all in parallel
+    pending, entry_categories = [], []
+    for i in order:
+        place = places[place_ids[i]]
+        details = place['details'] if place['details'] is not None else details_or_lookup(place_ids[i], deadline)
+        pending.append((place_ids[i], details, place['distance']))
+        entry_categories.append(place['categories'])
+
+    def format_entry(request, position, details_data, distance):
+        return {**format_place(request, details_data, distance), 'categories': entry_categories[position]}
+
+    def on_complete(details_by_place_id):
+        for business_type in categories:
+            google_results = [result for *_, result in found[business_type] if result is not None]
+            if google_results:
+                save_places(google_results, details_by_place_id, business_type)
+
+    if wants_stream(request):
+        return search_response(request, pending, deadline, on_complete, format_entry=format_entry)
+
+    # Merged list in ranked order, plus the positions in it of each category's places
+    resolved = sorted(resolve_details(pending, deadline), key=lambda item: item[0])
+    on_complete({place_id: details for _, place_id, details, _ in resolved})
+    merged, by_category = [], {business_type: [] for business_type in categories}
+    for position, _, details, distance in resolved:
+        for business_type in entry_categories[position]:
+            by_category[business_type].append(len(merged))
+        merged.append(format_entry(request, position, details, distance))
+    return Response({'places': merged, 'categories': by_category})
+
+# Cancel searches whose results are no longer needed
+def cancel_all(futures):
+    for future in futures:
+        future.cancel()
+
+# Download a photo from Google into the photo cache; returns its path, None if Google has no such photo
+def fetch_photo(reference, width, key):
+    places_quota.acquire()
     params = {
-        'query': f"{business_type} in {location}",
+        'photoreference': reference,
+        'maxwidth': width,
         'key': settings.GOOGLE_PLACES_API_KEY,
     }
+    with metrics.external_call('google_photo'):
+        # Google redirects to the image itself; stream it to disk instead of holding it in memory
+        with http_client.get(PHOTO_URL, params=params, timeout=settings.PLACES_REQUEST_TIMEOUT, stream=True) as response:
+            if response.status_code == 429:
+                places_quota.penalize(settings.GOOGLE_OVER_LIMIT_COOLDOWN)
+                raise RateLimited(places_quota.name, settings.GOOGLE_OVER_LIMIT_COOLDOWN)
+            if response.status_code != 200 or not response.headers.get('Content-Type', '').startswith('image/'):
+                missing_photos.set(key, True)
+                return None
+            try:
+                return photo_cache.put(key, response.iter_content(64 * 1024))
+            except PhotoTooLarge:
+                missing_photos.set(key, True)
+                return None
 
-    response = requests.get(google_places_url, params=params)
-    data = response.json()
+# Open a photo from the cache, fetching it first if needed; None if there is no such photo
+def open_photo(reference, width, key):
+    path = photo_cache.get(key)
+    if path is None:
+        if missing_photos.get(key) is not MISSING:
+            return None
+        path = photo_flight.do(key, fetch_photo, reference, width, key)
+    try:
+        return open(path, 'rb') if path else None
+    except FileNotFoundError:
+        # Pruned since it was stored (another worker's shared result can be seconds old) - fetch it again
+        path = fetch_photo(reference, width, key)
+        return open(path, 'rb') if path else None
 
-    # Extract top 10 results
-    top_results = data.get('results', [])[:10]
+# Place photo served from the on-disk cache: GET /api/photos/<photo_reference>/?sig=<signature>&width=400
+# A reference and width always give the same image, so clients and proxies may keep it for
+# PHOTO_MAX_AGE and revalidating costs nothing but an ETag comparison
+@require_http_methods(["GET", "HEAD"])
+def place_photo(request, reference):
+    if not REFERENCE_PATTERN.match(reference):
+        return HttpResponse(status=404)
+    if not signature_valid(reference, request.GET.get('sig')):
+        return HttpResponse(status=403)  # Not a reference from one of our search results
+    width = photo_width(request.GET.get('width'))
+    key = photo_cache.key(reference, width)
+    etag = quote_etag(key)
 
-    results = []
-    for result in top_results:
-        place_id = result.get('place_id')
-        # get each place's location coordinates
-        place_location = result.get('geometry', {}).get('location', {})
-        place_lat = place_location.get('lat')
-        place_lng = place_location.get('lng')
-
-        # Calculate distance from the original search location
-        distance = haversine(origin_lat, origin_lng, place_lat, place_lng)
-
-        # Perform a Place Details search for each place
-        if place_id:
-            details_url = "https://maps.googleapis.com/maps/api/place/details/json"
-            details_params = {
-                'place_id': place_id,
-                'fields': 'name,formatted_address,rating,formatted_phone_number,opening_hours,photos,price_level',
-                'key': settings.GOOGLE_PLACES_API_KEY,
-            }
-            details_response = requests.get(details_url, params=details_params)
-            details_data = details_response.json().get('result', {})
-
-            # Get the photo_reference from the photos array
-            photo_reference = None
-            if 'photos' in details_data and len(details_data['photos']) > 0:
-                photo_reference = details_data['photos'][0].get('photo_reference')
-
-            # If a photo_reference is found, get the photo URL
-            photo_url = None
-            if photo_reference:
-                photo_url = f"https://maps.googleapis.com/maps/api/place/photo?maxwidth=400&photoreference={photo_reference}&key={settings.GOOGLE_PLACES_API_KEY}"
-
-            result_data = {
-                'name': details_data.get('name'),
-                'address': details_data.get('formatted_address'),
-                'rating': details_data.get('rating'),
-                'phone_number': details_data.get('formatted_phone_number'),
-                'opening_hours': details_data.get('opening_hours', {}).get('weekday_text'),
-                'photo_url': photo_url,  # Include the photo URL
-                'price_level': details_data.get('price_level'), # Price level goes from 0 to 4, 0 being free and 4 being most expensive
-                'distance': distance, # Distance in miles
-            }
-            results.append(result_data)
-
-    return Response(results)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        try:
+            photo = open_photo(reference, width, key)
+        except RateLimited as error:
+            response = HttpResponse('Too many photo requests right now, please try again shortly', status=503, content_type='text/plain')
+            response['Retry-After'] = str(math.ceil(error.retry_after))
+            return response
+        except requests.RequestException:
+            return HttpResponse(status=502)
+        if photo is None:
+            return HttpResponse(status=404)
+        content_type = sniff_content_type(photo.read(12))
+        photo.seek(0)
+        # Streamed by the server's file wrapper (sendfile) rather than read through Python
+        response = FileResponse(photo, content_type=content_type)
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=settings.PHOTO_MAX_AGE, immutable=True)
+    return response
+
+# Read and validate the itinerary parameters other than the origin
+# Returns (place_ids, start, stay_minutes, error message)
+def parse_itinerary_options(data):
+    place_ids = data.get('place_ids')
+    if not isinstance(place_ids, list) or not all(isinstance(place_id, str) and place_id for place_id in place_ids):
+        return None, None, None, 'place_ids must be a list of place ids'
+    place_ids = list(dict.fromkeys(place_ids))
+    if not 1 <= len(place_ids) <= settings.ITINERARY_MAX_STOPS:
+        return None, None, None, f'place_ids must have between 1 and {settings.ITINERARY_MAX_STOPS} entries'
+    # Opening hours are in the places' local time, so the start is taken as a wall clock time there;
+    # the server's clock can be hours off from it, so there is no default
+    if not data.get('start'):
+        return None, None, None, 'start is required, as an ISO date and time on the local clock of the places'
+    stay = data.get('stay_minutes')
+    try:
+        start = datetime.fromisoformat(data['start'])
+        stay = settings.ITINERARY_STAY_MINUTES if stay is None or stay == '' else int(stay)
+    except (TypeError, ValueError):
+        return None, None, None, 'start must be an ISO date and time and stay_minutes a number'
+    if not 0 < stay <= 24 * 60:
+        return None, None, None, 'stay_minutes must be between 1 and 1440'
+    return place_ids, start, stay, None
+
+# Visiting order for several places picked from earlier searches: nearest-neighbour + 2-opt over
+# their pairwise distances, keeping each visit inside the place's opening hours where possible
+@api_view(['POST'])
+def plan_itinerary(request):
+    place_ids, start, stay, error = parse_itinerary_options(request.data)
+    if error:
+        return Response({'error': error}, status=400)
+
+    origin = request.data.get('origin')
+    if isinstance(origin, dict):
+        try:
+            origin_lat, origin_lng = float(origin['lat']), float(origin['lng'])
+        except (KeyError, TypeError, ValueError):
+            return Response({'error': 'origin must have numeric lat and lng'}, status=400)
+    elif request.data.get('location'):
+        try:
+            origin_lat, origin_lng = get_geocode(request.data.get('location'))
+        except RateLimited as error:
+            return rate_limited_response(error)
+        if origin_lat is None or origin_lng is None:
+            return Response({'error': 'Invalid location'}, status=400)
+    else:
+        return Response({'error': 'origin or location is required'}, status=400)
+
+    # Stops come from the places stored by searches, which carry coordinates and opening hours
+    stored = {place.place_id: place for place in Place.objects.filter(place_id__in=place_ids).only('place_id', 'name', 'lat', 'lng', 'details')}
+    unknown = [place_id for place_id in place_ids if place_id not in stored]
+    if unknown:
+        return Response({'error': 'Unknown places, search for them first', 'place_ids': unknown}, status=400)
+    places = [stored[place_id] for place_id in place_ids]
+
+    route, distances, (closed, finish, visits) = plan_route(
+        [origin_lat] + [place.lat for place in places],
+        [origin_lng] + [place.lng for place in places],
+        [None] + [opening_windows((place.details or {}).get('opening_hours'), start, settings.ITINERARY_HORIZON_MINUTES) for place in places],
+        stay,
+        settings.ITINERARY_SPEED_MPH,
+    )
+
+    stops = []
+    position = 0
+    for stop, (arrival, begins, leave, is_open) in zip(route, visits):
+        place = places[stop - 1]
+        stops.append({
+            'place_id': place.place_id,
+            'name': place.name,
+            'distance': float(distances[position, stop]),  # Miles from the previous stop (or the origin)
+            'arrive': (start + timedelta(minutes=arrival)).isoformat(timespec='minutes'),
+            'start': (start + timedelta(minutes=begins)).isoformat(timespec='minutes'),  # Later than arrive when waiting for opening
+            'leave': (start + timedelta(minutes=leave)).isoformat(timespec='minutes'),
+            'open': is_open,  # False when the place can't be visited within its opening hours during the night
+        })
+        position = stop
+    return Response({
+        'stops': stops,
+        'total_distance': sum(stop['distance'] for stop in stops),
+        'finish': (start + timedelta(minutes=finish)).isoformat(timespec='minutes'),
+        'closed_stops': closed,  # Stops that no order could fit into their opening hours
+    })